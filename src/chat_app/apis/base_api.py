@@ -2,9 +2,8 @@ from abc import ABC
 from typing import Optional
 
 from langchain.schema import BaseMessage, Document
-from requests import Session
-
 from chat_app.solid_pod_utils import SolidPodUtils
+from chat_app.tracing import TracedSession
 
 
 class BaseRetrievalServiceAPI(ABC):
@@ -13,7 +12,7 @@ class BaseRetrievalServiceAPI(ABC):
     """
 
     def __init__(self, solid_utils: SolidPodUtils):
-        self.session = Session()
+        self.session = TracedSession()
         self.solid_utils = solid_utils
 
     def get_embedding_models(self) -> list[str]:
@@ -34,7 +33,7 @@ class BaseLLMAPI(ABC):
     """
 
     def __init__(self, solid_utils: SolidPodUtils):
-        self.session = Session()
+        self.session = TracedSession()
         self.solid_utils = solid_utils
 
     def get_llm_models(self) -> list[str]:
@@ -7,6 +7,9 @@ from langchain.schema import BaseMessage, Document, messages_to_dict
 from .base_api import BaseRetrievalServiceAPI, BaseLLMAPI
 from chat_app.solid_pod_utils import SolidPodUtils
 
+# Seconds after which the LLM provider stops generating and the request is abandoned
+LLM_REQUEST_TIMEOUT = 300
+
 
 class DemoEmbeddingsAPI(BaseRetrievalServiceAPI):
     def __init__(self, solid_utils: SolidPodUtils, embeddings_provider_url: str):
@@ -103,7 +106,12 @@ class DemoLLMAPI(BaseLLMAPI):
             json={
                 "model": selected_llm,
                 "messages": messages_to_dict(messages),
-            }
+            },
+            headers={
+                "webid": self.solid_utils.solid_auth.get_web_id(),
+                "X-Request-Timeout": str(LLM_REQUEST_TIMEOUT),
+            },
+            timeout=LLM_REQUEST_TIMEOUT,
         )
         if not response.is_redirect:
             response.raise_for_status()
@@ -119,6 +127,11 @@ class DemoLLMAPI(BaseLLMAPI):
                 "prompt": prompt,
                 "context": [doc.to_json() for doc in relevant_documents] if relevant_documents else [],
             },
+            headers={
+                "webid": self.solid_utils.solid_auth.get_web_id(),
+                "X-Request-Timeout": str(LLM_REQUEST_TIMEOUT),
+            },
+            timeout=LLM_REQUEST_TIMEOUT,
         )
         if not response.is_redirect:
             response.raise_for_status()
@@ -10,6 +10,7 @@ from chat_app.config_utils import read_config, write_config
 from chat_app.apis.base_api import BaseRetrievalServiceAPI, BaseLLMAPI
 from chat_app.apis.demo_api import DemoEmbeddingsAPI, DemoLLMAPI
 from chat_app.apis.openai_api import OpenAIEmbeddingsAPI, OpenAILLMAPI
+from chat_app.tracing import span
 
 
 def show_login_sidebar():
@@ -222,7 +223,8 @@ def main():
         show_login_sidebar()
         return
 
-    solid_utils = SolidPodUtils(st.session_state["solid_token"])
+    with span("solid.bootstrap"):
+        solid_utils = SolidPodUtils(st.session_state["solid_token"])
     st.sidebar.markdown(f"Logged in as <{solid_utils.webid}>")
 
     def logout():
@@ -275,40 +277,41 @@ def main():
         disabled=st.session_state["input_disabled"],
         # on_submit=lambda: st.session_state.update(input_disabled=True),
     ):
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        history.add_user_message(prompt)
+        with span("chat.turn", model=selected_llm):
+            with st.chat_message("user"):
+                st.markdown(prompt)
+            history.add_user_message(prompt)
+
+            if len(history.messages) > 1:
+                with st.spinner("LLM is thinking..."):
+                    condensed_prompt = llm_service.condense_prompt_with_chat_history(
+                        selected_llm, history.messages
+                    )
+                    with st.chat_message("ai"):
+                        st.markdown("Condensed prompt: " + condensed_prompt)
+            else:
+                condensed_prompt = prompt
+
+            if documents_location:
+                with st.status("Retrieving relevant documents"):
+                    relevant_documents = retrieval_service.find_relevant_context(
+                        selected_embeddings, documents_location, condensed_prompt
+                    )
+                    for idx, doc in enumerate(relevant_documents):
+                        source, content = doc.metadata["source"], doc.page_content
+                        st.divider()
+                        st.write(f"**Document {idx} from {source}**")
+                        st.markdown(content)
+            else:
+                relevant_documents = None
 
-        if len(history.messages) > 1:
             with st.spinner("LLM is thinking..."):
-                condensed_prompt = llm_service.condense_prompt_with_chat_history(
-                    selected_llm, history.messages
+                ai_msg = llm_service.chat_completion(
+                    selected_llm, condensed_prompt, relevant_documents
                 )
-                with st.chat_message("ai"):
-                    st.markdown("Condensed prompt: " + condensed_prompt)
-        else:
-            condensed_prompt = prompt
-
-        if documents_location:
-            with st.status("Retrieving relevant documents"):
-                relevant_documents = retrieval_service.find_relevant_context(
-                    selected_embeddings, documents_location, condensed_prompt
-                )
-                for idx, doc in enumerate(relevant_documents):
-                    source, content = doc.metadata["source"], doc.page_content
-                    st.divider()
-                    st.write(f"**Document {idx} from {source}**")
-                    st.markdown(content)
-        else:
-            relevant_documents = None
-
-        with st.spinner("LLM is thinking..."):
-            ai_msg = llm_service.chat_completion(
-                selected_llm, condensed_prompt, relevant_documents
-            )
-        with st.chat_message("ai"):
-            st.markdown(ai_msg)
-        history.add_ai_message(ai_msg)
+            with st.chat_message("ai"):
+                st.markdown(ai_msg)
+            history.add_ai_message(ai_msg)
         st.session_state["input_disabled"] = False
 
 
@@ -2,6 +2,8 @@ import requests
 from rdflib import Namespace, RDF, URIRef, Graph
 from solid_oidc_client import SolidAuthSession
 
+from chat_app.tracing import TracedSession
+
 
 APP_URI = "https://github.com/Vidminas/socialgenpod"
 # https://solidproject.org/TR/protocol#namespaces
@@ -33,7 +35,7 @@ class SolidPodUtils:
 
     def __init__(self, solid_token: str):
         self.solid_auth = SolidAuthSession.deserialize(solid_token)
-        self.session = requests.Session()
+        self.session = TracedSession()
 
         self.webid = self.solid_auth.get_web_id()
         profile_card_uri = self.webid.removesuffix("#me")
@@ -0,0 +1,43 @@
+import os
+from typing import Any
+from urllib.parse import urlparse
+
+import requests
+
+# spans and traceparent headers are shared with the llm_service, so that both
+# components' spans nest in one trace
+from llm_service.tracing import configure_tracing, span
+
+SERVICE_NAME = "chat_app"
+
+# selected by the GENPOD_TRACING environment variable: console, jsonl (appending to
+# GENPOD_TRACING_PATH), or none, in which case tracing is off
+configure_tracing(
+    {
+        "tracing": {
+            "exporter": os.environ.get("GENPOD_TRACING"),
+            "path": os.environ.get("GENPOD_TRACING_PATH") or "chat_app_traces.jsonl",
+        }
+    },
+    service_name=SERVICE_NAME,
+)
+
+
+class TracedSession(requests.Session):
+    """
+    Session timing every request in a span and passing the trace on to the server
+    """
+
+    def request(self, method: str, url: str, *args: Any, **kwargs: Any):
+        parsed = urlparse(url)
+        with span(f"{method} {parsed.netloc}{parsed.path}") as request_span:
+            if request_span is None:
+                # tracing is off
+                return super().request(method, url, *args, **kwargs)
+            kwargs["headers"] = {
+                **(kwargs.get("headers") or {}),
+                "traceparent": request_span.traceparent(),
+            }
+            response = super().request(method, url, *args, **kwargs)
+            request_span.set_attribute("status_code", response.status_code)
+            return response
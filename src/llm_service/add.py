@@ -1,11 +1,37 @@
-import glob
+import csv
+import fcntl
+import importlib
+import io
+import multiprocessing
 import os
-from typing import Any, Dict, List
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 
+import numpy as np
 from tqdm import tqdm
 from langchain.document_loaders.csv_loader import CSVLoader
-from langchain.document_loaders.pdf import PDFMinerLoader
+from langchain.document_loaders.pdf import (
+    PDFMinerLoader,
+    PyMuPDFLoader,
+    PyPDFium2Loader,
+)
 from langchain.document_loaders.text import TextLoader
 from langchain.document_loaders.email import UnstructuredEmailLoader
 from langchain.document_loaders.epub import UnstructuredEPubLoader
@@ -14,14 +40,37 @@ from langchain.document_loaders.markdown import UnstructuredMarkdownLoader
 from langchain.document_loaders.odt import UnstructuredODTLoader
 from langchain.document_loaders.powerpoint import UnstructuredPowerPointLoader
 from langchain.document_loaders.word_document import UnstructuredWordDocumentLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
+from langchain_core.vectorstores import VectorStore
 
-from .solid_utils import webid_to_filepath, discover_document_uris, download_resource
+from .chunking import get_splitter
+from .dedup import deduplicate_chunks, get_duplicate_index, write_dedup_report
+from .executors import get_executor
+from .solid_utils import (
+    DownloadedResource,
+    discover_document_uris,
+    download_resource,
+    get_extension,
+)
 from .embeddings import (
-    does_vectorstore_exist,
-    get_vectorstore,
-    get_vectorstore_from_documents,
+    destroy_vectorstore,
+    get_embeddings,
+    get_ingestion_embeddings,
+    get_partition_directory,
+    get_persist_directory,
+)
+from .manifest import (
+    get_configured_manifest,
+    get_rebuild_reason,
+    read_manifest,
+    write_manifest,
+)
+from .source_index import SOURCE_INDEX_FILENAME, SourceIndex, find_source_indexes
+from .tracing import span
+from .vectorstores import (
+    VECTORSTORE_BACKENDS,
+    VectorStoreBackend,
+    get_vectorstore_backend,
 )
 
 
@@ -66,112 +115,812 @@ LOADER_MAPPING = {
     # Add more mappings for other file extensions and loaders as needed
 }
 
+# Opt-in loaders that can be selected per file extension in `ingestion.loaders`
+FAST_LOADER_MAPPING = {
+    # much faster than pdfminer, requires `pip install pymupdf`
+    "pymupdf": (PyMuPDFLoader, {}),
+    # requires `pip install pypdfium2`
+    "pypdfium2": (PyPDFium2Loader, {}),
+    "pdfminer": (PDFMinerLoader, {}),
+    # e.g. for .md or .html files, to skip parsing their structure with unstructured
+    "text": (TextLoader, {"encoding": "utf8"}),
+}
+
+
+def load_text(uri: str, content: bytes, encoding: str = "utf8") -> List[Document]:
+    return [Document(page_content=content.decode(encoding), metadata={"source": uri})]
+
+
+def load_csv(uri: str, content: bytes, encoding: str = "utf8") -> List[Document]:
+    # same output as CSVLoader, one document per row
+    reader = csv.DictReader(io.StringIO(content.decode(encoding)))
+    return [
+        Document(
+            page_content="\n".join(
+                f"{key.strip()}: {(value or '').strip()}"
+                for key, value in row.items()
+                if key is not None
+            ),
+            metadata={"source": uri, "row": i},
+        )
+        for i, row in enumerate(reader)
+    ]
+
+
+# Loaders that can parse a resource from its bytes without a file
+IN_MEMORY_LOADERS = {
+    TextLoader: load_text,
+    CSVLoader: load_csv,
+}
+
+# Long-lived pool of document loader processes, created on first use
+_loader_pool: Optional[ProcessPoolExecutor] = None
+_loader_pool_lock = threading.Lock()
+
+
+def get_loader(ext: Optional[str], loaders: Dict[str, str] = {}) -> Tuple[type, dict]:
+    if ext in loaders:
+        return FAST_LOADER_MAPPING[loaders[ext]]
+    elif ext in LOADER_MAPPING:
+        return LOADER_MAPPING[ext]
+    raise ValueError(f"Unsupported file extension '{ext}'")
+
+
+def discard_resource(resource: DownloadedResource) -> None:
+    if resource.path is not None and os.path.exists(resource.path):
+        os.remove(resource.path)
+
+
+def load_resource(
+    resource: DownloadedResource, loaders: Dict[str, str] = {}
+) -> List[Document]:
+    """
+    Parses a downloaded resource, writing it to a temporary file only if its loader
+    needs a path and it was not already spilled to one while downloading. A spilled
+    file is left for the ingestion to discard, in case the resource is loaded again.
+    """
+    ext = get_extension(resource.uri, resource.content_type)
+    loader_class, loader_args = get_loader(ext, loaders)
+    if resource.content is not None and loader_class in IN_MEMORY_LOADERS:
+        return IN_MEMORY_LOADERS[loader_class](
+            resource.uri, resource.content, **loader_args
+        )
+
+    if resource.path is not None:
+        documents = loader_class(resource.path, **loader_args).load()
+    else:
+        with tempfile.NamedTemporaryFile(
+            prefix="genpod-", suffix=ext, delete=False
+        ) as f:
+            f.write(resource.content)
+        try:
+            documents = loader_class(f.name, **loader_args).load()
+        finally:
+            os.remove(f.name)
+
+    for document in documents:
+        document.metadata["source"] = resource.uri
+    return documents
+
+
+def read_text(resource: DownloadedResource, encoding: str = "utf8") -> str:
+    if resource.content is not None:
+        return resource.content.decode(encoding)
+    with open(resource.path, encoding=encoding) as f:
+        return f.read()
+
+
+def load_and_split_resource(
+    resource: DownloadedResource,
+    loaders: Dict[str, str],
+    chunking: Dict[str, Any],
+    embeddings_config: Dict[str, Any],
+    download: bool = True,
+) -> List[Document]:
+    """
+    Loads and chunks a resource, or splits its raw markup if its splitter goes by the
+    structure of the markup, which loaders flatten to plain text
+    """
+    ext = get_extension(resource.uri, resource.content_type)
+    splitter = get_splitter(ext, chunking, embeddings_config, download)
+    if splitter.splits_markup:
+        return splitter.split_markup(read_text(resource), {"source": resource.uri})
+    return splitter.split(load_resource(resource, loaders))
+
+
+def load_and_split_resources(
+    resources: List[DownloadedResource],
+    loaders: Dict[str, str],
+    chunking: Dict[str, Any],
+    embeddings_config: Dict[str, Any],
+    download: bool = True,
+) -> List[Tuple[List[Document], Optional[str]]]:
+    """
+    Loads a batch of resources in one loader task, returning the chunks of every
+    resource, or the error it failed to load with
+    """
+    results = []
+    for resource in resources:
+        try:
+            results.append(
+                (
+                    load_and_split_resource(
+                        resource, loaders, chunking, embeddings_config, download
+                    ),
+                    None,
+                )
+            )
+        except Exception as e:
+            results.append(([], repr(e)))
+    return results
+
+
+def _warm_up_loader() -> None:
+    # import the parsers once per worker process rather than while loading documents
+    for module in ["pdfminer.high_level", "unstructured.partition.auto"]:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def get_loader_context() -> multiprocessing.context.BaseContext:
+    """
+    Loader processes are not forked from the server, whose model and executor threads
+    they could inherit mid-operation. A fork server is started instead, which imports
+    this module once so that replacement workers start warm; spawn where it is missing.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def get_loader_pool(config: Dict[str, Any]) -> ProcessPoolExecutor:
+    global _loader_pool
+    with _loader_pool_lock:
+        if _loader_pool is None:
+            _loader_pool = ProcessPoolExecutor(
+                max_workers=config["ingestion"].get("loader_workers") or os.cpu_count(),
+                mp_context=get_loader_context(),
+                initializer=_warm_up_loader,
+            )
+        return _loader_pool
 
-def download_documents(uris: list[str], save_dir: str):
-    with ThreadPoolExecutor(max_workers=10) as executor:
+
+def reset_loader_pool(broken_pool: ProcessPoolExecutor) -> None:
+    """
+    Drops a pool one of whose processes died, so that the next `get_loader_pool`
+    starts a new one
+    """
+    global _loader_pool
+    with _loader_pool_lock:
+        if _loader_pool is broken_pool:
+            _loader_pool = None
+    broken_pool.shutdown(wait=False)
+
+
+# Held while a partition is being ingested
+INGESTION_LOCK_FILENAME = "ingestion.lock"
+
+# Outcomes of a resource in the ingestion journal
+INGESTED = "ingested"
+UNCHANGED = "unchanged"
+UNSUPPORTED = "unsupported"
+QUARANTINED = "quarantined"
+FAILED = "failed"
+
+
+class LoadedResource(NamedTuple):
+    uri: str
+    status: str
+    content_hash: Optional[str] = None
+    documents: List[Document] = []
+    error: Optional[str] = None
+
+
+def load_documents(
+    config: Dict[str, Any],
+    uris: List[str],
+    indexed_hashes: Dict[str, str] = {},
+    quarantined_hashes: Dict[str, str] = {},
+) -> Iterator[LoadedResource]:
+    """
+    Downloads the resources, then parses and chunks those whose content hash differs
+    from `indexed_hashes` in the loader processes, in batches of
+    `ingestion.loader_chunksize` as the downloads complete.
+    Yields the outcome of every resource as it is known: its chunks if it was loaded,
+    or why it was not. Resources still quarantined with the same content are skipped,
+    and a resource failing to download or load does not stop the others. If a loader
+    process dies, the pool is replaced and the resources it was loading are retried
+    one at a time in a process of their own, so that only a resource that kills its
+    loader again is reported as failed. Spilled resources are kept on disk until
+    their outcome is known, for such retries.
+    """
+    loaders = config["ingestion"].get("loaders") or {}
+    for ext, loader in loaders.items():
+        if loader not in FAST_LOADER_MAPPING:
+            raise ValueError(f"Unsupported loader '{loader}' for '{ext}' files")
+    spill_threshold = int(
+        config["ingestion"].get("spill_threshold_mb", 16) * 1024 * 1024
+    )
+
+    chunksize = config["ingestion"].get("loader_chunksize", 4)
+    io_executor = get_executor(config, "io")
+    load_futures = {}
+    batch = []
+    retries = deque()
+
+    def submit_load(resources: List[DownloadedResource], retry: bool = False) -> None:
+        if retry:
+            loader_pool = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=get_loader_context(),
+                initializer=_warm_up_loader,
+            )
+        else:
+            loader_pool = get_loader_pool(config)
+        load_future = loader_pool.submit(
+            load_and_split_resources,
+            resources,
+            loaders,
+            config["chunking"],
+            config["embeddings"],
+            config["download"],
+        )
+        load_futures[load_future] = (resources, loader_pool, retry)
+
+    with tqdm(
+        total=len(uris),
+        desc="Loading new documents",
+        ncols=80,
+        position=0,
+        leave=True,
+    ) as pbar:
         future_to_uri = {
-            executor.submit(download_resource, uri, save_dir): uri for uri in uris
+            io_executor.submit(download_resource, uri, spill_threshold): uri
+            for uri in uris
         }
         for future in as_completed(future_to_uri):
-            if future.done():
+            uri = future_to_uri[future]
+            try:
+                resource = future.result()
+            except Exception as e:
+                print(f"Failed to download {uri}: {e}")
+                pbar.update()
+                yield LoadedResource(uri, FAILED, error=f"Download failed: {e}")
+                continue
+
+            ext = get_extension(resource.uri, resource.content_type)
+            if ext not in loaders and ext not in LOADER_MAPPING:
+                print(f"Skipping {resource.uri}: unsupported file type")
+                discard_resource(resource)
+                pbar.update()
+                yield LoadedResource(uri, UNSUPPORTED, resource.content_hash)
+            elif indexed_hashes.get(uri) == resource.content_hash:
+                discard_resource(resource)
+                pbar.update()
+                yield LoadedResource(uri, UNCHANGED, resource.content_hash)
+            elif quarantined_hashes.get(uri) == resource.content_hash:
+                discard_resource(resource)
+                pbar.update()
+                yield LoadedResource(uri, QUARANTINED, resource.content_hash)
+            else:
+                batch.append(resource)
+                if len(batch) >= chunksize:
+                    submit_load(batch)
+                    batch = []
+        if batch:
+            submit_load(batch)
+
+        while load_futures or retries:
+            if retries and not any(retry for _, _, retry in load_futures.values()):
+                submit_load([retries.popleft()], retry=True)
+            done, _ = wait(load_futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                resources, loader_pool, retry = load_futures.pop(future)
+                if retry:
+                    loader_pool.shutdown(wait=False)
                 try:
-                    future.result()
+                    results = future.result()
+                except BrokenProcessPool as e:
+                    if not retry:
+                        reset_loader_pool(loader_pool)
+                        retries.extend(resources)
+                        continue
+                    results = [([], repr(e))]
                 except Exception as e:
-                    print(f"Failed to download {future_to_uri[future]}: {e}")
-                else:
-                    print(f"Downloaded {future_to_uri[future]}")
-            else:
-                print(f"Cancelled downloading {future_to_uri[future]}")
+                    results = [([], repr(e))] * len(resources)
+                for resource, (documents, error) in zip(resources, results):
+                    discard_resource(resource)
+                    pbar.update()
+                    if error is not None:
+                        print(f"Failed to load {resource.uri}: {error}")
+                        yield LoadedResource(
+                            resource.uri, FAILED, resource.content_hash, error=error
+                        )
+                    else:
+                        yield LoadedResource(
+                            resource.uri, INGESTED, resource.content_hash, documents
+                        )
 
 
-def load_single_document(file_path: str) -> List[Document]:
-    ext = "." + file_path.rsplit(".", 1)[-1]
-    if ext in LOADER_MAPPING:
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        loader = loader_class(file_path, **loader_args)
-        return loader.load()
+def get_centroid(vectors: List[List[float]]) -> np.ndarray:
+    """
+    Mean direction of a document's chunk embeddings
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors.mean(axis=0)
 
-    raise ValueError(f"Unsupported file extension '{ext}'")
+
+def get_chunk_ids(texts: List[Document], content_hashes: Dict[str, str]) -> List[str]:
+    """
+    Deterministic chunk ids, derived from the source, its content and the chunk position
+    """
+    positions = defaultdict(int)
+    chunk_ids = []
+    for text in texts:
+        source = text.metadata["source"]
+        chunk_ids.append(
+            str(
+                uuid.uuid5(
+                    uuid.NAMESPACE_URL,
+                    f"{source}#{content_hashes[source]}#{positions[source]}",
+                )
+            )
+        )
+        positions[source] += 1
+    return chunk_ids
+
+
+def merge_dedup_reports(
+    report: Optional[Dict[str, Any]], batch_report: Dict[str, Any]
+) -> Dict[str, Any]:
+    if report is None:
+        return batch_report
+    return {
+        key: report[key] + batch_report[key]
+        for key in ["chunks", "kept", "exact_duplicates", "near_duplicates", "removed"]
+    }
 
 
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
+def attribute_chunk(document: Document, sources: List[str]) -> None:
     """
-    Loads all documents from the source documents directory, ignoring specified files
+    Attributes a kept chunk to the given sources only, keeping the order in which its
+    metadata listed them
     """
-    all_files = glob.glob(os.path.join(source_dir, f"**/*"), recursive=True)
-    filtered_files = [
-        file_path for file_path in all_files if file_path not in ignored_files
+    listed = [
+        document.metadata["source"],
+        *filter(None, document.metadata.get("duplicate_sources", "").split(",")),
     ]
+    ordered = [source for source in listed if source in sources]
+    ordered += sorted(set(sources) - set(ordered))
+    document.metadata["source"] = ordered[0]
+    document.metadata.pop("duplicate_sources", None)
+    if len(ordered) > 1:
+        document.metadata["duplicate_sources"] = ",".join(ordered[1:])
 
-    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
-        results = []
-        with tqdm(
-            total=len(filtered_files),
-            desc="Loading new documents",
-            ncols=80,
-            position=0,
-            leave=True,
-        ) as pbar:
-            futures = {
-                executor.submit(load_single_document, file): file
-                for file in filtered_files
-            }
-            for future in as_completed(futures):
-                docs = future.result()
-                results.extend(docs)
-                pbar.update()
 
-    return results
+def remove_sources(
+    source_index: SourceIndex,
+    backend: VectorStoreBackend,
+    db: VectorStore,
+    sources: Iterable[str],
+) -> bool:
+    """
+    Forgets sources and deletes the chunks no other source refers to. Kept chunks that
+    named a removed source, being duplicates of another source's chunks, are attributed
+    to their remaining sources instead. Returns whether the store changed.
+    """
+    stale_chunk_ids = []
+    shared_chunk_ids = set()
+    for source in sources:
+        chunk_ids = source_index.get_chunk_ids(source)
+        removed = source_index.remove(source)
+        stale_chunk_ids.extend(removed)
+        shared_chunk_ids.update(set(chunk_ids) - set(removed))
+    backend.delete(db, stale_chunk_ids)
+    shared = backend.get_chunks(db, sorted(shared_chunk_ids - set(stale_chunk_ids)))
+    for chunk_id, document, _ in shared:
+        attribute_chunk(document, source_index.get_sources(chunk_id))
+    if shared:
+        ids = [chunk_id for chunk_id, _, _ in shared]
+        backend.delete(db, ids)
+        backend.add(
+            db,
+            [document for _, document, _ in shared],
+            [vector for _, _, vector in shared],
+            ids,
+        )
+    return bool(stale_chunk_ids or shared)
 
 
-def process_documents(
-    source_directory: str, ignored_files: List[str] = []
-) -> List[Document]:
+@contextmanager
+def partition_lock(persist_directory: str, docs_location: str) -> Iterator[None]:
     """
-    Load documents and split in chunks
+    Holds an exclusive lock on a partition, shared by all processes of the service
     """
-    print(f"Loading documents from {source_directory}")
-    documents = load_documents(source_directory, ignored_files)
-    if not documents:
-        print("No new documents to load")
-        return
-    print(f"Loaded {len(documents)} new documents from {source_directory}")
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-    texts = text_splitter.split_documents(documents)
-    return texts
+    os.makedirs(persist_directory, exist_ok=True)
+    with open(os.path.join(persist_directory, INGESTION_LOCK_FILENAME), "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"Waiting for another ingestion of {docs_location} to finish")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
-def add(config: Dict[str, Any], docs_location: str, webid: str) -> None:
-    persist_directory = os.path.join(
-        config["chroma"]["persist_directory"], webid_to_filepath(webid)
+def copy_sources(
+    source_index: SourceIndex,
+    backend: VectorStoreBackend,
+    db: VectorStore,
+    hashes: Dict[str, str],
+    target_index: SourceIndex,
+    target_db: VectorStore,
+) -> None:
+    """
+    Copies the chunks and embeddings of the sources with the given content hashes to
+    another store, attributing the chunks to the copied sources only
+    """
+    chunk_ids_by_source = {
+        source: source_index.get_chunk_ids(source) for source in hashes
+    }
+    chunks = backend.get_chunks(
+        db, list(dict.fromkeys(sum(chunk_ids_by_source.values(), [])))
     )
-    docs_directory = os.path.join(persist_directory, "docs")
-    os.makedirs(docs_directory, exist_ok=True)
+    for chunk_id, document, _ in chunks:
+        attribute_chunk(
+            document,
+            [
+                source
+                for source in source_index.get_sources(chunk_id)
+                if source in hashes
+            ],
+        )
+    if chunks:
+        backend.add(
+            target_db,
+            [document for _, document, _ in chunks],
+            [vector for _, _, vector in chunks],
+            [chunk_id for chunk_id, _, _ in chunks],
+        )
+    vectors_by_id = {chunk_id: vector for chunk_id, _, vector in chunks}
+    for source, chunk_ids in chunk_ids_by_source.items():
+        target_index.record(source, hashes[source], chunk_ids)
+        vectors = [vectors_by_id[id] for id in chunk_ids if id in vectors_by_id]
+        if vectors:
+            target_index.set_centroid(source, get_centroid(vectors))
 
-    docs_uris = discover_document_uris(docs_location)
-    download_documents(docs_uris, docs_directory)
-    db = None
 
-    if does_vectorstore_exist(persist_directory):
-        # Update local vectorstore
-        print(f"Appending to existing vectorstore at {persist_directory}")
-        db = get_vectorstore(config, persist_directory)
-        collection = db.get()
-        texts = process_documents(
-            docs_directory,
-            [metadata["source"] for metadata in collection["metadatas"]],
-        )
-        if texts is not None:
-            print(f"Creating embeddings. May take a few minutes...")
-            db.add_documents(texts)
+def migrate_legacy_location(
+    config: Dict[str, Any], webid: str, docs_location: str
+) -> None:
+    """
+    Moves the sources of `docs_location` out of the WebID's store mixing all locations,
+    which older versions built, into the location's own partition, keeping their chunks
+    and embeddings. The old store is deleted once no sources are left in it, or right
+    away if the configured embeddings can no longer use it.
+    """
+    webid_directory = get_persist_directory(config, webid)
+    if read_manifest(webid_directory) is None:
+        return
+    with partition_lock(webid_directory, webid):
+        legacy_manifest = read_manifest(webid_directory)
+        if legacy_manifest is None:
+            return
+        reason = get_rebuild_reason(legacy_manifest, config)
+        if reason is None and not os.path.exists(
+            os.path.join(webid_directory, SOURCE_INDEX_FILENAME)
+        ):
+            reason = "it has no source index"
+        if reason is not None:
+            print(
+                f"Removing vectorstore mixing all locations at {webid_directory}: "
+                f"{reason}"
+            )
+            destroy_vectorstore(config, webid_directory)
+            return
+
+        backend = get_vectorstore_backend(config)
+        embeddings = get_embeddings(config)
+        legacy_db = backend.load(embeddings, webid_directory)
+        persist_directory = get_partition_directory(config, webid, docs_location)
+        with SourceIndex(webid_directory) as legacy_index:
+            hashes = {
+                source: content_hash
+                for source, content_hash in legacy_index.get_hashes().items()
+                if source.startswith(docs_location)
+            }
+            if not hashes:
+                return
+            # a partition built since supersedes the old copies
+            with partition_lock(persist_directory, docs_location):
+                if read_manifest(persist_directory) is None:
+                    print(f"Moving {len(hashes)} documents to {persist_directory}")
+                    db = backend.load(embeddings, persist_directory)
+                    with SourceIndex(persist_directory) as source_index:
+                        with source_index.transaction():
+                            copy_sources(
+                                legacy_index,
+                                backend,
+                                legacy_db,
+                                hashes,
+                                source_index,
+                                db,
+                            )
+                            backend.persist(db, persist_directory)
+                        manifest = legacy_manifest.model_copy()
+                        manifest.docs_location = docs_location
+                        manifest.document_count = source_index.count()
+                    write_manifest(persist_directory, manifest)
+
+            with legacy_index.transaction():
+                if remove_sources(legacy_index, backend, legacy_db, hashes):
+                    backend.persist(legacy_db, webid_directory)
+            remaining = legacy_index.count()
+        if remaining:
+            legacy_manifest.document_count = remaining
+            write_manifest(webid_directory, legacy_manifest)
+        else:
+            print(f"Removing vectorstore mixing all locations at {webid_directory}")
+            destroy_vectorstore(config, webid_directory)
+
+
+def add(
+    config: Dict[str, Any],
+    docs_location: str,
+    webid: str,
+    docs_uris: Optional[List[str]] = None,
+    removed_uris: Optional[List[str]] = None,
+) -> None:
+    """
+    Ingests the documents in `docs_location` into the WebID's partition for it.
+    `docs_uris` are the documents found in `docs_location`, discovered if not given.
+
+    With `removed_uris`, the update is incremental: only `docs_uris` (the changed
+    documents) are loaded and only `removed_uris` are deleted, leaving the other
+    indexed documents as they are. A store that has to be rebuilt is ingested in
+    full instead.
+
+    Loaded resources are embedded and committed in checkpoints of
+    `ingestion.checkpoint_resources` resources, each journaled with the outcome of its
+    resources, so that a retry or a resumed job skips the resources already committed.
+    Resources that fail to load are quarantined with their error, keeping any version
+    ingested before, and are retried once their content changes.
+
+    Ingestions of the same partition, e.g. by different service workers, run one
+    after the other.
+    """
+    webid_directory = get_persist_directory(config, webid)
+    # downloaded copies used to be kept here, resources are now parsed from memory
+    shutil.rmtree(os.path.join(webid_directory, "docs"), ignore_errors=True)
+    migrate_legacy_location(config, webid, docs_location)
+    persist_directory = get_partition_directory(config, webid, docs_location)
+    with partition_lock(persist_directory, docs_location):
+        _add(config, docs_location, webid, persist_directory, docs_uris, removed_uris)
+
+
+def _add(
+    config: Dict[str, Any],
+    docs_location: str,
+    webid: str,
+    persist_directory: str,
+    docs_uris: Optional[List[str]],
+    removed_uris: Optional[List[str]],
+) -> None:
+    backend = get_vectorstore_backend(config)
+    manifest = read_manifest(persist_directory)
+    if manifest is not None:
+        rebuild_reason = get_rebuild_reason(manifest, config)
+    elif any(
+        get_vectorstore_backend(config, name).exists(persist_directory)
+        for name in VECTORSTORE_BACKENDS
+    ):
+        rebuild_reason = "the store has no manifest"
     else:
+        rebuild_reason = None
+    if rebuild_reason is not None:
+        print(f"Rebuilding vectorstore at {persist_directory}: {rebuild_reason}")
+        destroy_vectorstore(config, persist_directory)
+        manifest = None
+    if manifest is None and removed_uris is not None:
+        print(f"Ingesting all of {docs_location} instead of the changed documents")
+        docs_uris = removed_uris = None
+
+    if docs_uris is None:
+        docs_uris = discover_document_uris(docs_location)
+    embeddings = get_ingestion_embeddings(config)
+    db = backend.load(embeddings, persist_directory)
+    if manifest is None:
         # Create and store a local vectorstore
         print("Creating new vectorstore")
-        texts = process_documents(docs_directory)
-        if texts is not None:
-            print(f"Creating embeddings. May take a few minutes...")
-            db = get_vectorstore_from_documents(config, persist_directory, texts)
-
-    if db is not None:
-        db.persist()
-        db = None
+        manifest = get_configured_manifest(config)
+        manifest.docs_location = docs_location
+    else:
+        # Update local vectorstore
+        print(f"Appending to existing vectorstore at {persist_directory}")
+
+    checkpoint_resources = config["ingestion"].get("checkpoint_resources") or 50
+    dedup_enabled = (config.get("dedup") or {}).get("enabled", False)
+    with SourceIndex(persist_directory) as source_index:
+        job_id = source_index.start_job(webid, docs_location, len(docs_uris))
+        indexed_hashes = source_index.get_hashes()
+        dedup_report = None
+        # duplicates are also looked for among the chunks of earlier checkpoints
+        duplicate_index = get_duplicate_index(config) if dedup_enabled else None
+
+        def checkpoint(batch: List[LoadedResource]) -> None:
+            nonlocal dedup_report
+            texts = [text for resource in batch for text in resource.documents]
+            content_hashes = {
+                resource.uri: resource.content_hash
+                for resource in batch
+                if resource.status == INGESTED
+            }
+            # sources to replace, and those no longer supported since they changed
+            replaced = [
+                resource.uri
+                for resource in batch
+                if resource.uri in indexed_hashes
+                and resource.status in (INGESTED, UNSUPPORTED)
+            ]
+
+            with source_index.transaction():
+                remove_sources(source_index, backend, db, replaced)
+
+                if texts:
+                    chunk_ids = get_chunk_ids(texts, content_hashes)
+                    if dedup_enabled:
+                        with span("ingestion.dedup", chunks=len(texts)):
+                            texts, chunk_ids, sources_by_id, report = (
+                                deduplicate_chunks(
+                                    config, texts, chunk_ids, duplicate_index
+                                )
+                            )
+                            dedup_report = merge_dedup_reports(dedup_report, report)
+                            write_dedup_report(persist_directory, dedup_report)
+                    else:
+                        sources_by_id = {
+                            chunk_id: [text.metadata["source"]]
+                            for text, chunk_id in zip(texts, chunk_ids)
+                        }
+                    vectors_by_id = {}
+                    if texts:
+                        # makes retrying after a crash between the two writes
+                        # idempotent
+                        backend.delete(db, chunk_ids)
+                        print(f"Creating embeddings for {len(texts)} chunks...")
+                        with span("ingestion.embed", chunks=len(texts)):
+                            vectors = embeddings.embed_documents(
+                                [text.page_content for text in texts]
+                            )
+                        with span("ingestion.store", chunks=len(texts)):
+                            backend.add(db, texts, vectors, chunk_ids)
+                        manifest.dimension = len(vectors[0])
+                        vectors_by_id = dict(zip(chunk_ids, vectors))
+
+                    # chunks of earlier checkpoints that new sources duplicate
+                    earlier = backend.get_chunks(
+                        db, [id for id in sources_by_id if id not in vectors_by_id]
+                    )
+                    for chunk_id, document, vector in earlier:
+                        attribute_chunk(
+                            document,
+                            [
+                                *source_index.get_sources(chunk_id),
+                                *sources_by_id[chunk_id],
+                            ],
+                        )
+                        vectors_by_id[chunk_id] = vector
+                    if earlier:
+                        ids = [chunk_id for chunk_id, _, _ in earlier]
+                        backend.delete(db, ids)
+                        backend.add(
+                            db,
+                            [document for _, document, _ in earlier],
+                            [vector for _, _, vector in earlier],
+                            ids,
+                        )
+
+                    chunk_ids_by_source = defaultdict(list)
+                    for chunk_id, sources in sources_by_id.items():
+                        for source in sources:
+                            chunk_ids_by_source[source].append(chunk_id)
+                    for source, source_chunk_ids in chunk_ids_by_source.items():
+                        source_index.record(
+                            source, content_hashes[source], source_chunk_ids
+                        )
+                        source_index.set_centroid(
+                            source,
+                            get_centroid(
+                                [vectors_by_id[id] for id in source_chunk_ids]
+                            ),
+                        )
+
+                for resource in batch:
+                    if resource.status == FAILED and resource.content_hash is not None:
+                        source_index.quarantine(
+                            resource.uri, resource.content_hash, resource.error
+                        )
+                    elif resource.status in (INGESTED, UNCHANGED, UNSUPPORTED):
+                        source_index.release(resource.uri)
+                    source_index.log(
+                        job_id, resource.uri, resource.status, resource.error
+                    )
+                if replaced or any(resource.documents for resource in batch):
+                    backend.persist(db, persist_directory)
+            manifest.document_count = source_index.count()
+            # a store interrupted after this checkpoint is resumed rather than rebuilt
+            write_manifest(persist_directory, manifest)
+
+        try:
+            with source_index.transaction():
+                # sources no longer present in the location
+                if removed_uris is None:
+                    removed_uris = {
+                        *indexed_hashes,
+                        *source_index.get_quarantined(),
+                    } - set(docs_uris)
+                for source in removed_uris:
+                    source_index.release(source)
+                if remove_sources(
+                    source_index,
+                    backend,
+                    db,
+                    [source for source in removed_uris if source in indexed_hashes],
+                ):
+                    backend.persist(db, persist_directory)
+
+            print(f"Loading {len(docs_uris)} documents")
+            batch = []
+            with span("ingestion.load", resources=len(docs_uris)):
+                for resource in load_documents(
+                    config,
+                    docs_uris,
+                    indexed_hashes,
+                    source_index.get_quarantined(),
+                ):
+                    batch.append(resource)
+                    if len(batch) >= checkpoint_resources:
+                        checkpoint(batch)
+                        batch = []
+            checkpoint(batch)
+
+            with source_index.transaction():
+                # sources ingested before centroids were recorded
+                for source in source_index.get_sources_without_centroid():
+                    chunks = backend.get_chunks(db, source_index.get_chunk_ids(source))
+                    if chunks:
+                        source_index.set_centroid(
+                            source, get_centroid([vector for _, _, vector in chunks])
+                        )
+        except BaseException as e:
+            source_index.finish_job(job_id, "failed", repr(e))
+            raise
+        source_index.finish_job(job_id, "completed")
+        manifest.document_count = source_index.count()
+        quarantined = len(source_index.get_quarantined())
+        if quarantined:
+            print(f"{quarantined} documents are quarantined, see the ingestion report")
+
+    manifest.last_sync = datetime.now(timezone.utc)
+    write_manifest(persist_directory, manifest)
+
+
+def resume_interrupted_jobs(config: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """
+    Claims the ingestion jobs whose process stopped before they finished, returning
+    the WebID and docs location of each to be added again
+    """
+    jobs = []
+    for directory in find_source_indexes(config["chroma"]["persist_directory"]):
+        with SourceIndex(directory) as source_index:
+            for job_id, webid, docs_location in source_index.get_interrupted_jobs():
+                if source_index.claim_job(job_id):
+                    jobs.append((webid, docs_location))
+    return jobs
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+
+from .config import get_config
+
+
+def validate_onnx(args: argparse.Namespace) -> None:
+    from .embeddings import load_embeddings
+    from .onnx_embeddings import VALIDATION_TEXTS, validate_onnx_embeddings
+
+    config = get_config(args.config)
+    embeddings_config = {**config["embeddings"], "backend": "onnx"}
+    texts = VALIDATION_TEXTS
+    if args.texts_file:
+        with open(args.texts_file) as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    reference = load_embeddings({**embeddings_config, "backend": "torch"})
+    embeddings = load_embeddings(embeddings_config)
+    print(json.dumps(validate_onnx_embeddings(reference, embeddings, texts), indent=2))
+
+
+def find_vectorstores(config: dict, backend_name: str, root: str) -> list[str]:
+    from .vectorstores import get_vectorstore_backend
+
+    backend = get_vectorstore_backend(config, backend_name)
+    return [directory for directory, _, _ in os.walk(root) if backend.exists(directory)]
+
+
+def migrate_vectorstores(args: argparse.Namespace) -> None:
+    from .embeddings import get_embeddings, get_persist_directory
+    from .vectorstores import migrate_vectorstore
+
+    config = get_config(args.config)
+    roots = [get_persist_directory(config, webid) for webid in args.webid or []] or [
+        config["chroma"]["persist_directory"]
+    ]
+    directories = [
+        directory
+        for root in roots
+        for directory in find_vectorstores(config, args.source, root)
+    ]
+
+    embeddings = get_embeddings(config)
+    for directory in directories:
+        migrated = migrate_vectorstore(
+            config, embeddings, directory, args.source, args.target
+        )
+        print(f"Migrated {migrated} chunks in {directory}")
+
+
+def recall_report(args: argparse.Namespace) -> None:
+    import numpy as np
+
+    from .embeddings import get_embeddings, get_partition_directory, get_vectorstore
+    from .vectorstores import get_vectorstore_backend, precision_recall_report
+
+    config = get_config(args.config)
+    embeddings = get_embeddings(config)
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    backend = get_vectorstore_backend(config)
+    store = get_vectorstore(
+        config, get_partition_directory(config, args.webid, args.docs_location)
+    )
+    vectors = np.array([vector for _, _, vector in backend.iter_chunks(store)])
+    exact_baseline = backend.has_exact_vectors(store)
+    if not exact_baseline:
+        print(
+            "WARNING: the store only keeps quantized vectors, so there is no exact "
+            "float32 baseline and the recall below is overestimated"
+        )
+    report = precision_recall_report(
+        vectors,
+        np.array([embeddings.embed_query(query) for query in queries]),
+        k=args.k,
+        rescore_factor=args.rescore_factor,
+        exact_baseline=exact_baseline,
+    )
+    print(json.dumps(report, indent=2))
+
+
+def ingestion_report(args: argparse.Namespace) -> None:
+    from .embeddings import get_partition_directory
+    from .source_index import SourceIndex
+
+    config = get_config(args.config)
+    with SourceIndex(
+        get_partition_directory(config, args.webid, args.docs_location)
+    ) as source_index:
+        report = {
+            "jobs": source_index.get_jobs(args.jobs),
+            "quarantine": source_index.get_quarantine(),
+        }
+    print(json.dumps(report, indent=2))
+
+
+def report_memory(args: argparse.Namespace) -> None:
+    import requests
+
+    from .serving import memory_report
+
+    if args.requests:
+        config = get_config(args.config)
+        url = (
+            args.url
+            or f"http://{config.get('host', '127.0.0.1')}:{config.get('port', 5000)}"
+        )
+        model = args.model or config["llms"][0]["model"]
+        for i in range(args.requests):
+            # each request is accepted by whichever worker is free
+            requests.post(
+                f"{url}/completions/",
+                json={"model": model, "prompt": f"Count to {i + 3}.", "context": []},
+            ).raise_for_status()
+    print(json.dumps(memory_report(args.pid), indent=2))
+
+
+def profile_service(args: argparse.Namespace) -> None:
+    import requests
+
+    config = get_config(args.config)
+    url = (
+        args.url
+        or f"http://{config.get('host', '127.0.0.1')}:{config.get('port', 5000)}"
+    )
+    request = {"duration": args.duration, "format": args.format}
+    if args.requests:
+        request.update(endpoint=args.endpoint, requests=args.requests)
+    res = requests.post(
+        f"{url}/admin/profile/",
+        json=request,
+        headers={"X-Admin-Token": args.token or config["admin"]["token"]},
+    )
+    res.raise_for_status()
+    output = args.output or (
+        "profile.speedscope.json" if args.format == "speedscope" else "profile.txt"
+    )
+    with open(output, "wb") as f:
+        f.write(res.content)
+    print(f"Wrote {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="genpod-admin", description="Maintenance tools for the LLM service"
+    )
+    parser.add_argument("--config", help="Path to genpod.yml", default=None)
+    subparsers = parser.add_subparsers(required=True)
+
+    validate_onnx_parser = subparsers.add_parser(
+        "validate-onnx",
+        help="Compare the ONNX embeddings model with the reference model",
+    )
+    validate_onnx_parser.add_argument(
+        "--texts-file", help="File with one validation text per line"
+    )
+    validate_onnx_parser.set_defaults(func=validate_onnx)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate-vectorstore",
+        help="Copy vector stores to another backend without re-embedding",
+    )
+    migrate_parser.add_argument("source", help="Backend to migrate from")
+    migrate_parser.add_argument("target", help="Backend to migrate to")
+    migrate_parser.add_argument(
+        "--webid",
+        action="append",
+        help="Only migrate the stores of this WebID (default: all stores)",
+    )
+    migrate_parser.set_defaults(func=migrate_vectorstores)
+
+    recall_parser = subparsers.add_parser(
+        "recall-report",
+        help="Compare reduced precision vector search with float32 search",
+    )
+    recall_parser.add_argument("webid", help="WebID whose vector store to evaluate")
+    recall_parser.add_argument(
+        "docs_location", help="Location the WebID added the documents from"
+    )
+    recall_parser.add_argument("queries", help="File with one held-out query per line")
+    recall_parser.add_argument("-k", type=int, default=4)
+    recall_parser.add_argument("--rescore-factor", type=int, default=4)
+    recall_parser.set_defaults(func=recall_report)
+
+    ingestion_parser = subparsers.add_parser(
+        "ingestion-report",
+        help="Show the latest ingestion jobs of a location and its quarantined files",
+    )
+    ingestion_parser.add_argument("webid", help="WebID that added the documents")
+    ingestion_parser.add_argument(
+        "docs_location", help="Location the WebID added the documents from"
+    )
+    ingestion_parser.add_argument(
+        "--jobs", type=int, default=10, help="Number of jobs to show"
+    )
+    ingestion_parser.set_defaults(func=ingestion_report)
+
+    memory_parser = subparsers.add_parser(
+        "memory-report",
+        help="Report the memory shared and used by each worker of a running service",
+    )
+    memory_parser.add_argument("pid", type=int, help="Process id of the service")
+    memory_parser.add_argument(
+        "--requests",
+        type=int,
+        default=0,
+        help="Completion requests to send before measuring, to warm up the workers",
+    )
+    memory_parser.add_argument("--url", help="Service URL (default: from the config)")
+    memory_parser.add_argument("--model", help="Model to request completions from")
+    memory_parser.set_defaults(func=report_memory)
+
+    profile_parser = subparsers.add_parser(
+        "profile",
+        help="Take a sampling profile of a running service (needs profiling.enabled)",
+    )
+    profile_parser.add_argument(
+        "--duration", type=float, help="Seconds to sample (default: max_duration)"
+    )
+    profile_parser.add_argument(
+        "--requests",
+        type=int,
+        help="Only profile the next N requests to --endpoint",
+    )
+    profile_parser.add_argument("--endpoint", default="/completions/")
+    profile_parser.add_argument(
+        "--format", choices=["speedscope", "collapsed"], default="speedscope"
+    )
+    profile_parser.add_argument("-o", "--output", help="File to write the profile to")
+    profile_parser.add_argument("--url", help="Service URL (default: from the config)")
+    profile_parser.add_argument(
+        "--token", help="Admin token (default: from the config)"
+    )
+    profile_parser.set_defaults(func=profile_service)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+from fastapi import HTTPException, Request
+from langchain_core.callbacks import BaseCallbackHandler
+
+CLIENT_DISCONNECTED = "client disconnected"
+DEADLINE_EXCEEDED = "deadline exceeded"
+
+# Seconds between checks whether the client of a request is still connected
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+class RequestCancelled(Exception):
+    """
+    The client of a request disconnected or its deadline passed before it completed
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+
+    @property
+    def deadline_exceeded(self) -> bool:
+        return self.reason == DEADLINE_EXCEEDED
+
+
+class CancellationToken:
+    """
+    Signals blocking work running in executor threads that its request was cancelled.
+    The work checks the token between steps, e.g. generated tokens, and stops early.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str) -> None:
+        if self._event.is_set():
+            return
+        self.reason = reason
+        self._event.set()
+        for callback in self._callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """Calls `callback` (from the thread cancelling the token) on cancellation"""
+        self._callbacks.append(callback)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def exception(self) -> RequestCancelled:
+        return RequestCancelled(self.reason or CLIENT_DISCONNECTED)
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise self.exception()
+
+
+class CancellationCallback(BaseCallbackHandler):
+    """
+    Stops LLMs that stream their tokens to callbacks (e.g. CTransformers) by raising
+    from the first token generated after the request was cancelled
+    """
+
+    # exceptions of other callbacks are only logged
+    raise_error = True
+
+    def __init__(self, token: CancellationToken):
+        self.token = token
+
+    def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        self.token.raise_if_cancelled()
+
+    def on_llm_new_token(self, *args: Any, **kwargs: Any) -> None:
+        self.token.raise_if_cancelled()
+
+
+def parse_timeout(timeout: Optional[str]) -> Optional[float]:
+    """
+    Parses an `X-Request-Timeout` header, the seconds after which the client no
+    longer needs the response. Being relative, it does not depend on the client's
+    clock agreeing with the server's.
+    """
+    if timeout is None:
+        return None
+    try:
+        return float(timeout)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid X-Request-Timeout: {timeout}"
+        )
+
+
+@asynccontextmanager
+async def request_cancellation(
+    request: Request, timeout: Optional[str] = None
+) -> AsyncIterator[CancellationToken]:
+    """
+    Cancellation token of a request, cancelled when its client disconnects or when
+    its timeout, counted from now, passes
+    """
+    token = CancellationToken()
+    loop = asyncio.get_running_loop()
+
+    deadline_handle = None
+    timeout_seconds = parse_timeout(timeout)
+    if timeout_seconds is not None:
+        deadline_handle = loop.call_later(
+            max(timeout_seconds, 0), token.cancel, DEADLINE_EXCEEDED
+        )
+
+    async def watch_disconnect() -> None:
+        while not token.cancelled:
+            if await request.is_disconnected():
+                token.cancel(CLIENT_DISCONNECTED)
+                return
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        yield token
+    finally:
+        watcher.cancel()
+        if deadline_handle is not None:
+            deadline_handle.cancel()
@@ -0,0 +1,230 @@
+import json
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from langchain.docstore.document import Document
+from langchain.text_splitter import (
+    HTMLHeaderTextSplitter,
+    Language,
+    MarkdownHeaderTextSplitter,
+    RecursiveCharacterTextSplitter,
+)
+
+# Used when the tokenizer does not declare a maximum sequence length
+DEFAULT_MAX_TOKENS = 512
+
+# Headings Markdown and HTML resources are split at before splitting them by size
+MARKDOWN_HEADERS = [("#" * level, f"h{level}") for level in range(1, 7)]
+HTML_HEADERS = [(f"h{level}", f"h{level}") for level in range(1, 7)]
+MARKDOWN_SEPARATORS = RecursiveCharacterTextSplitter.get_separators_for_language(
+    Language.MARKDOWN
+)
+
+# Splitters already created in this process, by their chunking options
+_splitters: Dict[str, "DocumentSplitter"] = {}
+_tokenizers: Dict[str, Any] = {}
+
+
+def get_chunking_options(
+    chunking: Dict[str, Any], ext: Optional[str]
+) -> Dict[str, Any]:
+    """
+    The default chunking options overridden by those configured for the file extension
+    """
+    options = {key: value for key, value in chunking.items() if key != "by_extension"}
+    options.update((chunking.get("by_extension") or {}).get(ext) or {})
+    return options
+
+
+def get_tokenizer(model_name: str, download: bool = True):
+    from transformers import AutoTokenizer
+
+    if model_name not in _tokenizers:
+        _tokenizers[model_name] = AutoTokenizer.from_pretrained(
+            model_name, local_files_only=not download
+        )
+    return _tokenizers[model_name]
+
+
+def get_max_tokens(tokenizer, embeddings_config: Dict[str, Any]) -> int:
+    """
+    Number of tokens of a chunk that the embedding model reads before truncating it,
+    leaving room for the special tokens and the embedding instruction
+    """
+    max_tokens = embeddings_config.get("max_seq_length") or tokenizer.model_max_length
+    if max_tokens > 100_000:
+        max_tokens = DEFAULT_MAX_TOKENS
+    reserved = tokenizer.num_special_tokens_to_add()
+    if embeddings_config["model"].startswith("hkunlp/"):
+        from langchain_community.embeddings.huggingface import (
+            DEFAULT_EMBED_INSTRUCTION,
+        )
+
+        instruction = embeddings_config.get(
+            "embed_instruction", DEFAULT_EMBED_INSTRUCTION
+        )
+        reserved += len(tokenizer.encode(instruction, add_special_tokens=False))
+    return max_tokens - reserved
+
+
+class DocumentSplitter:
+    """
+    Splits the documents loaded from one resource into chunks. Chunks are never longer
+    than the embedding model reads, whichever length function sizes them.
+
+    The markdown and html splitters split the raw markup of a resource at its headings
+    (see `split_markup`), recording the headings of every section in its metadata,
+    before splitting the sections that are still too long.
+
+    Args:
+        options: Chunking options for the resource's file extension
+        embeddings_config: Configuration of the embedding model, whose tokenizer measures
+            chunks when `length_function` is "tokens"
+        download: Whether the tokenizer may be downloaded if it is not cached
+    """
+
+    def __init__(
+        self,
+        options: Dict[str, Any],
+        embeddings_config: Dict[str, Any],
+        download: bool = True,
+    ):
+        self.splitter = options.get("splitter", "recursive")
+        if self.splitter not in ["recursive", "rows", "markdown", "html"]:
+            raise ValueError(f"Unsupported chunking splitter: {self.splitter}")
+        length_function_name = options.get("length_function", "characters")
+        if length_function_name not in ["characters", "tokens"]:
+            raise ValueError(
+                f"Unsupported chunking length function: {length_function_name}"
+            )
+
+        tokenizer = get_tokenizer(
+            options.get("tokenizer") or embeddings_config["model"], download
+        )
+        self.max_tokens = get_max_tokens(tokenizer, embeddings_config)
+        self.count_tokens: Callable[[str], int] = lambda text: len(
+            tokenizer.encode(text, add_special_tokens=False)
+        )
+        chunk_size = options.get("chunk_size")
+        if length_function_name == "tokens":
+            chunk_size = min(chunk_size or self.max_tokens, self.max_tokens)
+            length_function = self.count_tokens
+        else:
+            length_function = len
+
+        chunk_overlap = options.get("chunk_overlap", 50)
+        self.chunk_size = chunk_size or 500
+        self.length_function = length_function
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            # markdown sections keep their markup, unlike html ones
+            separators=MARKDOWN_SEPARATORS if self.splitter == "markdown" else None,
+            is_separator_regex=self.splitter == "markdown",
+            chunk_size=self.chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=length_function,
+        )
+        # re-splits chunks sized in characters that still have too many tokens
+        self.token_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=self.max_tokens,
+            chunk_overlap=min(chunk_overlap, self.max_tokens // 4),
+            length_function=self.count_tokens,
+        )
+
+    @property
+    def splits_markup(self) -> bool:
+        return self.splitter in ["markdown", "html"]
+
+    def split_markup(self, text: str, metadata: Dict[str, Any]) -> List[Document]:
+        """
+        Splits the raw Markdown or HTML of a resource at its headings, then by size
+        """
+        if self.splitter == "markdown":
+            sections = MarkdownHeaderTextSplitter(
+                MARKDOWN_HEADERS, strip_headers=False
+            ).split_text(text)
+        else:
+            sections = HTMLHeaderTextSplitter(HTML_HEADERS).split_text(text)
+        for section in sections:
+            section.metadata = {**metadata, **section.metadata}
+        return self.cap_tokens(self.text_splitter.split_documents(sections))
+
+    def cap_tokens(self, chunks: List[Document]) -> List[Document]:
+        """
+        Splits the chunks the embedding model would otherwise truncate
+        """
+        if self.length_function is self.count_tokens:
+            return chunks
+        capped = []
+        for chunk in chunks:
+            if self.count_tokens(chunk.page_content) > self.max_tokens:
+                capped.extend(self.token_splitter.split_documents([chunk]))
+            else:
+                capped.append(chunk)
+        return capped
+
+    def split(self, documents: List[Document]) -> List[Document]:
+        if self.splitter == "rows":
+            return self.cap_tokens(self.split_rows(documents))
+        return self.cap_tokens(self.text_splitter.split_documents(documents))
+
+    @staticmethod
+    def _rows(documents: List[Document]) -> Iterator[Document]:
+        for document in documents:
+            if "row" in document.metadata:
+                # e.g. CSVLoader already loads every row as a document
+                yield document
+                continue
+            for i, line in enumerate(document.page_content.splitlines()):
+                if line.strip():
+                    yield Document(
+                        page_content=line, metadata={**document.metadata, "row": i}
+                    )
+
+    def split_rows(self, documents: List[Document]) -> List[Document]:
+        """
+        Packs consecutive rows into chunks, only splitting rows that are too long by
+        themselves. Rows are not repeated across chunks.
+        """
+        separator = "\n\n"
+        separator_length = self.length_function(separator)
+        chunks = []
+        rows: List[Document] = []
+        length = 0
+
+        def flush():
+            if rows:
+                chunks.append(
+                    Document(
+                        page_content=separator.join(row.page_content for row in rows),
+                        metadata={**rows[0].metadata},
+                    )
+                )
+                rows.clear()
+
+        for row in self._rows(documents):
+            row_length = self.length_function(row.page_content)
+            if row_length > self.chunk_size:
+                flush()
+                length = 0
+                chunks.extend(self.text_splitter.split_documents([row]))
+                continue
+            if rows and length + separator_length + row_length > self.chunk_size:
+                flush()
+                length = 0
+            length += row_length + (separator_length if rows else 0)
+            rows.append(row)
+        flush()
+        return chunks
+
+
+def get_splitter(
+    ext: Optional[str],
+    chunking: Dict[str, Any],
+    embeddings_config: Dict[str, Any],
+    download: bool = True,
+) -> DocumentSplitter:
+    options = get_chunking_options(chunking, ext)
+    key = json.dumps([options, embeddings_config, download], sort_keys=True)
+    if key not in _splitters:
+        _splitters[key] = DocumentSplitter(options, embeddings_config, download)
+    return _splitters[key]
+
@@ -24,4 +24,91 @@ def get_config(path: Optional[Union[Path, str]] = None) -> Dict[str, Any]:
         if not path.is_file():
             return default_config
     config = _get_config(path)
+    # lists are appended when merging, so the user's models replace the default
+    # models of the same name instead of being configured twice
+    user_models = {spec.get("model") for spec in config.get("llms") or []}
+    default_config["llms"] = [
+        spec for spec in default_config["llms"] if spec["model"] not in user_models
+    ]
     return merge(default_config, config)
+
+
+# Model frameworks load_llm supports
+MODEL_FRAMEWORKS = ("ctransformers", "openai", "huggingface")
+
+# Search types of retriever.search_type
+SEARCH_TYPES = ("similarity", "similarity_score_threshold", "mmr")
+
+# Sections only read at startup, whose changes need a restart to take effect
+RESTART_SECTIONS = ("host", "port", "serving", "executors", "notifications")
+
+
+def validate_config(config: Dict[str, Any]) -> None:
+    """
+    Checks that a configuration can be served, raising ValueError if not
+    """
+    if not (config.get("embeddings") or {}).get("model"):
+        raise ValueError("embeddings.model is required")
+    llms = config.get("llms") or []
+    if not llms:
+        raise ValueError("At least one model is required under llms")
+    rephrase_llms = (config.get("rephrase") or {}).get("llms") or []
+    for spec in [*llms, *rephrase_llms]:
+        if not spec.get("model"):
+            raise ValueError(f"Model without a name: {spec}")
+        if spec.get("model_framework") not in MODEL_FRAMEWORKS:
+            raise ValueError(
+                f"Unsupported model framework of {spec['model']}: "
+                f"{spec.get('model_framework')}"
+            )
+    names = [spec["model"] for spec in llms]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Models configured more than once: {sorted(duplicates)}")
+    if not isinstance(config.get("retriever"), dict):
+        raise ValueError("retriever must be a mapping")
+    search_type = config["retriever"].get("search_type", "similarity")
+    if search_type not in SEARCH_TYPES:
+        raise ValueError(f"Unsupported retriever.search_type: {search_type}")
+    notifications = config.get("notifications") or {}
+    workers = (config.get("serving") or {}).get("workers") or 1
+    if (
+        notifications.get("enabled")
+        and notifications.get("webhook_url")
+        and workers > 1
+    ):
+        raise ValueError(
+            "notifications.webhook_url needs serving.workers: 1, as only one worker "
+            "knows the webhooks"
+        )
+
+
+def diff_config(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Differences between two configurations: the models added, removed and changed
+    (by name), the other changed sections, and those of them that need a restart
+    """
+
+    def models(config):
+        rephrase_llms = (config.get("rephrase") or {}).get("llms") or []
+        return {spec["model"]: spec for spec in [*config["llms"], *rephrase_llms]}
+
+    old_models, new_models = models(old), models(new)
+    changed_sections = sorted(
+        key
+        for key in set(old) | set(new)
+        if key != "llms" and old.get(key) != new.get(key)
+    )
+    return {
+        "added_models": sorted(set(new_models) - set(old_models)),
+        "removed_models": sorted(set(old_models) - set(new_models)),
+        "changed_models": sorted(
+            name
+            for name in set(old_models) & set(new_models)
+            if old_models[name] != new_models[name]
+        ),
+        "changed_sections": changed_sections,
+        "requires_restart": [
+            key for key in changed_sections if key in RESTART_SECTIONS
+        ],
+    }
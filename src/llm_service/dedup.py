@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+
+DEDUP_REPORT_FILENAME = "dedup_report.json"
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def get_shingles(text: str, shingle_size: int) -> set[str]:
+    words = normalize_text(text).split()
+    return {
+        " ".join(words[i : i + shingle_size])
+        for i in range(max(1, len(words) - shingle_size + 1))
+    }
+
+
+def minhash_signatures(
+    texts: List[str], num_perm: int, shingle_size: int, seed: int = 1
+) -> np.ndarray:
+    """
+    MinHash signatures of the texts' word shingles, one row per text
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+    b = rng.randint(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        hashes = np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(shingle.encode(), digest_size=4).digest(), "little"
+                )
+                for shingle in get_shingles(text, shingle_size)
+            ],
+            dtype=np.uint64,
+        )
+        # overflowing multiplications wrap around, which is fine for hashing
+        with np.errstate(over="ignore"):
+            signatures[i] = ((np.outer(hashes, a) + b) % MERSENNE_PRIME).min(axis=0)
+    return signatures
+
+
+def get_lsh_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Number of LSH bands and rows per band, so that pairs from about `threshold`
+    similarity upwards become candidates, erring on the side of more candidates
+    """
+    options = [
+        (num_perm // rows, rows)
+        for rows in range(1, num_perm + 1)
+        if num_perm % rows == 0
+    ]
+    below = [
+        (bands, rows)
+        for bands, rows in options
+        if (1 / bands) ** (1 / rows) <= threshold
+    ]
+    return max(
+        below or options[:1], key=lambda option: (1 / option[0]) ** (1 / option[1])
+    )
+
+
+class DuplicateIndex:
+    """
+    Exact hashes and LSH band buckets of the texts kept so far, which later texts are
+    checked against. An ingestion keeps one for all of its checkpoints, so that
+    duplicates are found across checkpoints too.
+
+    Args:
+        threshold: Estimated Jaccard similarity from which texts are near-duplicates
+        num_perm: Number of MinHash permutations
+        shingle_size: Number of words per shingle
+    """
+
+    def __init__(
+        self, threshold: float = 0.85, num_perm: int = 128, shingle_size: int = 5
+    ):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = get_lsh_bands(num_perm, threshold)
+        self._first_by_hash: Dict[str, Any] = {}
+        self._buckets = [defaultdict(list) for _ in range(self.bands)]
+        self._signatures: Dict[Any, np.ndarray] = {}
+        # source of each kept text, for the dedup report
+        self.sources: Dict[Any, str] = {}
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+
+    def find_duplicates(
+        self, texts: List[str], keys: List[Any]
+    ) -> Dict[int, Tuple[Any, str, float]]:
+        """
+        Finds the texts that duplicate a text seen before, in this call or an earlier
+        one, and remembers the others under their keys. Returns, for each duplicate,
+        the key of the text it duplicates, the kind of duplicate and the estimated
+        Jaccard similarity of their shingles.
+        """
+        duplicates = {}
+        digests = [
+            hashlib.sha256(normalize_text(text).encode()).hexdigest() for text in texts
+        ]
+        for i, digest in enumerate(digests):
+            if digest in self._first_by_hash:
+                duplicates[i] = (self._first_by_hash[digest], "exact", 1.0)
+            else:
+                self._first_by_hash[digest] = keys[i]
+
+        candidates = [i for i in range(len(texts)) if i not in duplicates]
+        signatures = minhash_signatures(
+            [texts[i] for i in candidates], self.num_perm, self.shingle_size
+        )
+        for signature, i in zip(signatures, candidates):
+            band_keys = self._band_keys(signature)
+            matches = set()
+            for bucket, key in zip(self._buckets, band_keys):
+                matches.update(bucket.get(key, ()))
+            best = None
+            for match in matches:
+                similarity = float(np.mean(signature == self._signatures[match]))
+                if similarity >= self.threshold and (
+                    best is None or similarity > best[1]
+                ):
+                    best = (match, similarity)
+            if best is not None:
+                duplicates[i] = (best[0], "near", best[1])
+                # later exact copies of this text duplicate its representative
+                self._first_by_hash[digests[i]] = best[0]
+                continue
+            # only representatives are matched against, so that clusters do not drift
+            self._signatures[keys[i]] = signature
+            for bucket, key in zip(self._buckets, band_keys):
+                bucket[key].append(keys[i])
+
+        # exact duplicates of a text that turned out to be a near-duplicate itself
+        positions = {key: i for i, key in enumerate(keys)}
+        for i, (representative, kind, similarity) in duplicates.items():
+            while positions.get(representative) in duplicates:
+                representative = duplicates[positions[representative]][0]
+            duplicates[i] = (representative, kind, similarity)
+        return duplicates
+
+
+def find_duplicates(
+    texts: List[str], threshold: float, num_perm: int = 128, shingle_size: int = 5
+) -> Dict[int, Tuple[int, str, float]]:
+    """
+    Finds exact (after normalising case and whitespace) and near-duplicate texts.
+    Returns, for each duplicate, the index of the earlier text it duplicates, the kind
+    of duplicate and the estimated Jaccard similarity of their shingles.
+    """
+    index = DuplicateIndex(threshold, num_perm, shingle_size)
+    return index.find_duplicates(texts, list(range(len(texts))))
+
+
+def get_duplicate_index(config: Dict[str, Any]) -> DuplicateIndex:
+    dedup = config["dedup"]
+    return DuplicateIndex(
+        threshold=dedup.get("threshold", 0.85),
+        num_perm=dedup.get("num_perm", 128),
+        shingle_size=dedup.get("shingle_size", 5),
+    )
+
+
+def deduplicate_chunks(
+    config: Dict[str, Any],
+    texts: List[Document],
+    chunk_ids: List[str],
+    index: Optional[DuplicateIndex] = None,
+) -> Tuple[List[Document], List[str], Dict[str, List[str]], Dict[str, Any]]:
+    """
+    Keeps one representative of every group of duplicate chunks, listing the sources
+    of the removed duplicates in its `duplicate_sources` metadata. With `index`, the
+    chunks are also checked against the chunks kept before with it.
+    Returns the kept chunks, their ids, the sources referring to every kept chunk id
+    and a report of the removed chunks. Chunks kept before that got duplicates are
+    included in the sources, with the sources of their new duplicates only.
+    """
+    if index is None:
+        index = get_duplicate_index(config)
+    duplicates = index.find_duplicates([text.page_content for text in texts], chunk_ids)
+
+    sources_by_id = {
+        chunk_id: [text.metadata["source"]] for text, chunk_id in zip(texts, chunk_ids)
+    }
+    for text, chunk_id in zip(texts, chunk_ids):
+        index.sources.setdefault(chunk_id, text.metadata["source"])
+    removed = []
+    for i, (representative, kind, similarity) in sorted(duplicates.items()):
+        source = texts[i].metadata["source"]
+        sources = sources_by_id.setdefault(representative, [])
+        if source not in sources and source != index.sources[representative]:
+            sources.append(source)
+        del sources_by_id[chunk_ids[i]]
+        removed.append(
+            {
+                "source": source,
+                "duplicate_of": index.sources[representative],
+                "kind": kind,
+                "similarity": round(similarity, 4),
+            }
+        )
+
+    kept_texts = []
+    kept_ids = []
+    for i, (text, chunk_id) in enumerate(zip(texts, chunk_ids)):
+        if i in duplicates:
+            del index.sources[chunk_id]
+            continue
+        other_sources = sources_by_id[chunk_id][1:]
+        if other_sources:
+            # vector store metadata values have to be scalars
+            text.metadata["duplicate_sources"] = ",".join(other_sources)
+        kept_texts.append(text)
+        kept_ids.append(chunk_id)
+    # chunks kept before without new duplicates
+    sources_by_id = {
+        chunk_id: sources for chunk_id, sources in sources_by_id.items() if sources
+    }
+
+    report = {
+        "chunks": len(texts),
+        "kept": len(kept_texts),
+        "exact_duplicates": sum(
+            1 for _, kind, _ in duplicates.values() if kind == "exact"
+        ),
+        "near_duplicates": sum(
+            1 for _, kind, _ in duplicates.values() if kind == "near"
+        ),
+        "removed": removed,
+    }
+    return kept_texts, kept_ids, sources_by_id, report
+
+
+def write_dedup_report(persist_directory: str, report: Dict[str, Any]) -> None:
+    print(
+        f"Removed {report['exact_duplicates']} exact and {report['near_duplicates']} "
+        f"near-duplicate chunks, keeping {report['kept']} of {report['chunks']}"
+    )
+    with open(os.path.join(persist_directory, DEDUP_REPORT_FILENAME), "w") as f:
+        json.dump(report, f, indent=2, default=str)
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+EMBEDDING_CACHE_FILENAME = "embedding_cache.sqlite3"
+
+
+class EmbeddingCache:
+    """
+    Size-bounded, content-addressed store of chunk embeddings shared by all tenants.
+    Least recently used entries are evicted once the cache grows beyond `max_bytes`.
+
+    Args:
+        path: SQLite database file
+        max_bytes: Maximum total size of the cached vectors
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """)
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_by_access "
+            "ON embeddings (last_access)"
+        )
+        # running total of the vector sizes, kept by triggers so that every process
+        # sharing the cache sees the same total without summing the whole table
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_size (bytes INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "INSERT INTO cache_size SELECT COALESCE(SUM(LENGTH(vector)), 0) "
+            "FROM embeddings WHERE NOT EXISTS (SELECT 1 FROM cache_size)"
+        )
+        self.connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS embeddings_inserted AFTER INSERT ON embeddings
+            BEGIN
+                UPDATE cache_size SET bytes = bytes + LENGTH(NEW.vector);
+            END
+            """)
+        self.connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS embeddings_deleted AFTER DELETE ON embeddings
+            BEGIN
+                UPDATE cache_size SET bytes = bytes - LENGTH(OLD.vector);
+            END
+            """)
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            # stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                rows = self.connection.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+            self.connection.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(time.time(), key) for key in found],
+            )
+            self.connection.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries: Dict[str, List[float]]) -> None:
+        now = time.time()
+        with self._lock:
+            # keys are content addressed, so a stored vector never needs replacing
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?)",
+                [
+                    (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                    for key, vector in entries.items()
+                ],
+            )
+            self.connection.commit()
+            self._evict()
+
+    def _size(self) -> int:
+        return self.connection.execute("SELECT bytes FROM cache_size").fetchone()[0]
+
+    def _evict(self) -> None:
+        excess = self._size() - self.max_bytes
+        while excess > 0:
+            rows = self.connection.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings "
+                "ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                evicted.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            self.connection.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self.connection.commit()
+            self.evictions += len(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self.connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+            size = self._size()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Looks up document embeddings in an `EmbeddingCache` and only computes the missing ones.
+
+    Args:
+        embeddings: Embeddings computing the cache misses
+        cache: The shared embedding cache
+        namespace: Identifies the embedding model and chunking parameters
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, namespace: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.namespace = namespace
+
+    def _key(self, text: str) -> str:
+        return self.namespace + ":" + hashlib.sha256(text.encode()).hexdigest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        found = self.cache.get_many(list(set(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+# Embedding caches opened by this process, by path
+embedding_caches: Dict[str, EmbeddingCache] = {}
+
+
+def get_cache_namespace(config: Dict[str, Any]) -> str:
+    embeddings_config = config["embeddings"]
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "model": embeddings_config["model"],
+                "backend": embeddings_config.get("backend", "torch"),
+                "embed_instruction": embeddings_config.get("embed_instruction"),
+                "chunking": config["chunking"],
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()[:16]
+
+
+def get_embedding_cache(config: Dict[str, Any]) -> EmbeddingCache:
+    cache_config = config.get("embedding_cache") or {}
+    path = cache_config.get("path") or os.path.join(
+        config["chroma"]["persist_directory"], EMBEDDING_CACHE_FILENAME
+    )
+    if path not in embedding_caches:
+        embedding_caches[path] = EmbeddingCache(
+            path, int(cache_config.get("max_size_mb", 1024) * 1024 * 1024)
+        )
+    return embedding_caches[path]
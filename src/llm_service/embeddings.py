@@ -1,21 +1,62 @@
-import glob
+import contextvars
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
-from typing import Any, Dict, List
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
-from chromadb.config import Settings
+import numpy as np
 from langchain.docstore.document import Document
-from langchain.vectorstores.chroma import Chroma
 from langchain.embeddings.base import Embeddings
+from langchain_core.vectorstores import VectorStore
 from langchain_community.embeddings import (
     HuggingFaceInstructEmbeddings,
     HuggingFaceEmbeddings,
 )
 
 from .solid_utils import webid_to_filepath
+from .embedding_cache import (
+    CachedEmbeddings,
+    get_cache_namespace,
+    get_embedding_cache,
+)
+from .manifest import MANIFEST_FILENAME, check_query_compatibility, read_manifest
+from .dedup import DEDUP_REPORT_FILENAME
+from .source_index import SOURCE_INDEX_FILENAME, SourceIndex
+from .profiler import track_thread
+from .tracing import span
+from .vectorstores import (
+    VECTORSTORE_BACKENDS,
+    exact_similarities,
+    get_vectorstore_backend,
+)
 
+# Embedding models loaded in this process, by their configuration
+_loaded_embeddings: Dict[str, Embeddings] = {}
+_ingestion_embeddings: Dict[str, Embeddings] = {}
+# Embedding model of an embedding worker process
+_worker_embeddings: Optional[Embeddings] = None
+
+
+def load_embeddings(embeddings_config: Dict[str, Any]) -> Embeddings:
+    config = {**embeddings_config}
+    config.pop("parallel", None)
+    config.pop("onnx", None)
+    backend = config.pop("backend", "torch")
+    if backend == "onnx":
+        from .onnx_embeddings import get_onnx_embeddings
+
+        return get_onnx_embeddings(
+            embeddings_config,
+            lambda: load_embeddings({**embeddings_config, "backend": "torch"}),
+        )
+    elif backend != "torch":
+        raise ValueError(f"Unsupported embeddings backend: {backend}")
 
-def get_embeddings(config: Dict[str, Any]) -> Embeddings:
-    config = {**config["embeddings"]}
     config["model_name"] = config.pop("model")
     if config["model_name"].startswith("hkunlp/"):
         Provider = HuggingFaceInstructEmbeddings
@@ -24,52 +65,308 @@ def get_embeddings(config: Dict[str, Any]) -> Embeddings:
     return Provider(**config)
 
 
-def does_vectorstore_exist(persist_directory: str) -> bool:
+def get_embeddings(config: Dict[str, Any]) -> Embeddings:
+    key = json.dumps(config["embeddings"], sort_keys=True)
+    if key not in _loaded_embeddings:
+        _loaded_embeddings[key] = load_embeddings(config["embeddings"])
+    return _loaded_embeddings[key]
+
+
+def unload_embeddings(config: Dict[str, Any]) -> None:
     """
-    Checks if vectorstore exists
+    Forgets the embedding models of configurations other than `config`, so that they
+    are freed once the requests still using them finish
     """
-    if os.path.exists(os.path.join(persist_directory, "index")):
-        if os.path.exists(
-            os.path.join(persist_directory, "chroma-collections.parquet")
-        ) and os.path.exists(
-            os.path.join(persist_directory, "chroma-embeddings.parquet")
-        ):
-            list_index_files = glob.glob(os.path.join(persist_directory, "index/*.bin"))
-            list_index_files += glob.glob(
-                os.path.join(persist_directory, "index/*.pkl")
+    current_key = json.dumps(config["embeddings"], sort_keys=True)
+    for key in list(_loaded_embeddings):
+        if key != current_key:
+            del _loaded_embeddings[key]
+    for key in list(_ingestion_embeddings):
+        if json.loads(key)[0] != config["embeddings"]:
+            del _ingestion_embeddings[key]
+
+
+def _init_embedding_worker(embeddings_config: Dict[str, Any], threads: int) -> None:
+    import torch
+
+    global _worker_embeddings
+    torch.set_num_threads(threads)
+    _worker_embeddings = load_embeddings(embeddings_config)
+
+
+def _embed_batch(texts: List[str]) -> List[List[float]]:
+    return _worker_embeddings.embed_documents(texts)
+
+
+class ParallelEmbeddings(Embeddings):
+    """
+    Embeds documents in batches spread across a pool of worker processes.
+
+    The workers are started with "spawn" and load their own copy of the model: the pool
+    is created lazily from an executor thread, after torch has started its own threads,
+    which forked children could deadlock on. Queries are embedded in the calling process.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        embeddings_config: Dict[str, Any],
+        workers: int,
+        threads_per_worker: int = 1,
+        batch_size: int = 32,
+        start_method: str = "spawn",
+    ):
+        self.embeddings = embeddings
+        self.embeddings_config = embeddings_config
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.batch_size = batch_size
+        self.start_method = start_method
+        self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_init_embedding_worker,
+                initargs=(self.embeddings_config, self.threads_per_worker),
+            )
+        return self._executor
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = [
+            texts[i : i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        if len(batches) <= 1:
+            return self.embeddings.embed_documents(texts)
+
+        embeddings = []
+        # map returns the results in the order of the batches
+        for batch_embeddings in self._get_executor().map(_embed_batch, batches):
+            embeddings.extend(batch_embeddings)
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+def get_ingestion_embeddings(config: Dict[str, Any]) -> Embeddings:
+    """
+    Returns the embeddings used for ingesting documents, which are looked up in the shared
+    embedding cache if `embedding_cache.enabled` is set, and spread across worker processes
+    if `embeddings.parallel.workers` is configured
+    """
+    cache_config = config.get("embedding_cache") or {}
+    key = json.dumps(
+        [config["embeddings"], config["chunking"], cache_config], sort_keys=True
+    )
+    if key not in _ingestion_embeddings:
+        embeddings = get_embeddings(config)
+        parallel = config["embeddings"].get("parallel") or {}
+        if parallel.get("workers", 0) > 1:
+            embeddings = ParallelEmbeddings(
+                embeddings, config["embeddings"], **parallel
             )
-            # At least 3 documents are needed in a working vectorstore
-            if len(list_index_files) > 3:
-                return True
-    return False
-
-
-def get_vectorstore(config: Dict[str, Any], persist_directory: str) -> Chroma:
-    embeddings = get_embeddings(config)
-    config = {**config["chroma"], "persist_directory": persist_directory}
-    return Chroma(
-        embedding_function=embeddings,
-        client_settings=Settings(**config),
+        if cache_config.get("enabled", False):
+            embeddings = CachedEmbeddings(
+                embeddings, get_embedding_cache(config), get_cache_namespace(config)
+            )
+        _ingestion_embeddings[key] = embeddings
+    return _ingestion_embeddings[key]
+
+
+def get_persist_directory(config: Dict[str, Any], webid: str) -> str:
+    return os.path.join(config["chroma"]["persist_directory"], webid_to_filepath(webid))
+
+
+def get_partition_directory(
+    config: Dict[str, Any], webid: str, docs_location: str
+) -> str:
+    """
+    Directory of the vector store holding the documents a WebID added from one location
+    """
+    return os.path.join(
+        get_persist_directory(config, webid),
+        "partitions",
+        hashlib.sha256(docs_location.encode()).hexdigest()[:16],
     )
 
 
+def does_vectorstore_exist(config: Dict[str, Any], persist_directory: str) -> bool:
+    """
+    Checks if vectorstore exists
+    """
+    return read_manifest(persist_directory) is not None
+
+
+def destroy_vectorstore(config: Dict[str, Any], persist_directory: str) -> None:
+    """
+    Deletes the vector store in `persist_directory`, whichever backend it was built with
+    """
+    for name in VECTORSTORE_BACKENDS:
+        get_vectorstore_backend(config, name).destroy(persist_directory)
+    for filename in [MANIFEST_FILENAME, SOURCE_INDEX_FILENAME, DEDUP_REPORT_FILENAME]:
+        if os.path.exists(os.path.join(persist_directory, filename)):
+            os.remove(os.path.join(persist_directory, filename))
+
+
+def get_vectorstore(
+    config: Dict[str, Any],
+    persist_directory: str,
+    embeddings: Optional[Embeddings] = None,
+) -> VectorStore:
+    embeddings = embeddings or get_embeddings(config)
+    return get_vectorstore_backend(config).load(embeddings, persist_directory)
+
+
 def get_vectorstore_from_documents(
     config: Dict[str, Any],
     persist_directory: str,
     documents: List[Document],
-) -> Chroma:
-    embeddings = get_embeddings(config)
-    config = {**config["chroma"], "persist_directory": persist_directory}
-    return Chroma.from_documents(
-        documents,
-        embeddings,
-        client_settings=Settings(**config),
-    )
+    embeddings: Optional[Embeddings] = None,
+) -> VectorStore:
+    embeddings = embeddings or get_embeddings(config)
+    backend = get_vectorstore_backend(config)
+    db = backend.load(embeddings, persist_directory)
+    vectors = embeddings.embed_documents([doc.page_content for doc in documents])
+    backend.add(db, documents, vectors, [str(uuid.uuid4()) for _ in documents])
+    return db
 
 
-def get_retriever_for_webid(config: Dict[str, Any], webid: str):
-    persist_directory = os.path.join(
-        config["chroma"]["persist_directory"], webid_to_filepath(webid)
-    )
+def persist_vectorstore(
+    config: Dict[str, Any], db: VectorStore, persist_directory: str
+) -> None:
+    get_vectorstore_backend(config).persist(db, persist_directory)
+
+
+def get_retriever_for_webid(config: Dict[str, Any], webid: str, docs_location: str):
+    persist_directory = get_partition_directory(config, webid, docs_location)
+    check_query_compatibility(read_manifest(persist_directory), config)
     db = get_vectorstore(config, persist_directory)
     return db.as_retriever(**config["retriever"])
+
+
+def hierarchical_search(
+    config: Dict[str, Any], persist_directory: str, db: VectorStore, query: str, k: int
+) -> Optional[List[Tuple[Document, float]]]:
+    """
+    Shortlists the documents whose centroid embeddings are closest to the query, then
+    ranks only their chunks, taking at most `max_chunks_per_document` from each.
+    Chunks are scored with the store's relevance score function, like a flat search.
+    Returns None for partitions too small to benefit, which are searched flat.
+    """
+    options = config.get("hierarchical_retrieval") or {}
+    with SourceIndex(persist_directory) as source_index:
+        if source_index.count_chunks() < options.get("min_chunks", 0):
+            return None
+        sources, centroids = source_index.get_centroids()
+        if not sources:
+            return None
+        query_vector = np.asarray(get_embeddings(config).embed_query(query))
+        scores = exact_similarities(centroids, query_vector)
+        shortlist = [
+            sources[i] for i in np.argsort(-scores)[: options.get("documents", 8)]
+        ]
+        chunk_ids = list(
+            dict.fromkeys(
+                chunk_id
+                for source in shortlist
+                for chunk_id in source_index.get_chunk_ids(source)
+            )
+        )
+
+    backend = get_vectorstore_backend(config)
+    chunks = backend.get_chunks(db, chunk_ids)
+    if not chunks:
+        return []
+    distances = backend.distances(
+        db, np.array([vector for _, _, vector in chunks]), query_vector
+    )
+    relevance_score_fn = db._select_relevance_score_fn()
+    scores = np.array([relevance_score_fn(float(distance)) for distance in distances])
+    max_chunks_per_document = options.get("max_chunks_per_document", 2)
+    chunks_per_document = defaultdict(int)
+    results = []
+    for i in np.argsort(-scores):
+        document = chunks[i][1]
+        if chunks_per_document[document.metadata["source"]] >= max_chunks_per_document:
+            continue
+        chunks_per_document[document.metadata["source"]] += 1
+        results.append((document, float(scores[i])))
+        if len(results) == k:
+            break
+    return results
+
+
+def retrieve_documents(
+    config: Dict[str, Any], webid: str, docs_locations: List[str], query: str
+) -> List[Document]:
+    """
+    Searches the partitions of the given locations, in parallel if there are several,
+    and merges their results by relevance score. Maximal marginal relevance results,
+    which have no scores, are interleaved in the order each partition ranked them.
+    """
+    docs_locations = [
+        docs_location
+        for docs_location in dict.fromkeys(docs_locations)
+        if does_vectorstore_exist(
+            config, get_partition_directory(config, webid, docs_location)
+        )
+    ]
+    if not docs_locations:
+        return []
+    search_kwargs = {**(config["retriever"].get("search_kwargs") or {})}
+    k = search_kwargs.pop("k", 4)
+    score_threshold = search_kwargs.pop("score_threshold", None)
+    mmr = config["retriever"].get("search_type", "similarity") == "mmr"
+    # two-stage retrieval only ranks by relevance, other searches are done flat
+    hierarchical = (
+        (config.get("hierarchical_retrieval") or {}).get("enabled", False)
+        and not mmr
+        and not search_kwargs
+    )
+    if len(docs_locations) == 1 and not hierarchical:
+        return get_retriever_for_webid(config, webid, docs_locations[0]).invoke(query)
+
+    def search(docs_location: str) -> List[Any]:
+        # the copied context carries the request's span and profile to this thread
+        with (
+            track_thread(),
+            span("retrieval.search_partition", docs_location=docs_location),
+        ):
+            persist_directory = get_partition_directory(config, webid, docs_location)
+            check_query_compatibility(read_manifest(persist_directory), config)
+            db = get_vectorstore(config, persist_directory)
+            if mmr:
+                return db.max_marginal_relevance_search(query, k=k, **search_kwargs)
+            if hierarchical:
+                results = hierarchical_search(config, persist_directory, db, query, k)
+                if results is not None:
+                    return results
+            return db.similarity_search_with_relevance_scores(
+                query, k=k, **search_kwargs
+            )
+
+    with ThreadPoolExecutor(max_workers=len(docs_locations)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, search, docs_location)
+            for docs_location in docs_locations
+        ]
+        partition_results = [future.result() for future in futures]
+    if mmr:
+        # each partition's results are diverse already, take them in turns
+        return [
+            doc
+            for docs in itertools.zip_longest(*partition_results)
+            for doc in docs
+            if doc is not None
+        ][:k]
+    results = [result for results in partition_results for result in results]
+    results.sort(key=lambda result: result[1], reverse=True)
+    return [
+        doc
+        for doc, score in results[:k]
+        if score_threshold is None or score >= score_threshold
+    ]
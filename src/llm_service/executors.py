@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+
+from .profiler import track_thread
+
+T = TypeVar("T")
+
+# Default number of threads per workload class, overridden by `executors.<name>.workers`
+DEFAULT_WORKERS = {
+    # LLM generation and rephrasing
+    "generation": 2,
+    # retrieval queries and ingestion (parsing, embedding, vector store writes), of
+    # which the scheduler keeps ingestion to `scheduler.max_bulk_workers` threads
+    "embedding": 2,
+    # crawling and downloading from Solid pods
+    "io": 16,
+}
+
+
+class MonitoredExecutor:
+    """
+    Thread pool for one class of blocking work, which keeps track of how busy it is
+
+    Args:
+        name: Workload class
+        max_workers: Number of threads
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"{name}-worker"
+        )
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def submit(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> "Future[T]":
+        submitted_at = time.monotonic()
+        with self._lock:
+            self.queued += 1
+
+        def run() -> T:
+            wait = time.monotonic() - submitted_at
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.total_wait_seconds += wait
+                self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            try:
+                with track_thread():
+                    result = fn(*args, **kwargs)
+            except BaseException:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+            return result
+
+        # run in the context of the caller, e.g. as a child of its current trace span
+        return self._executor.submit(contextvars.copy_context().run, run)
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Runs blocking work in the pool without blocking the event loop"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "running": self.running,
+                "queued": self.queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "saturation": self.running / self.max_workers,
+                "mean_wait_seconds": (
+                    self.total_wait_seconds / self.completed if self.completed else None
+                ),
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+# Executors of this process, by workload class
+executors: Dict[str, MonitoredExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(config: Dict[str, Any], name: str) -> MonitoredExecutor:
+    with _executors_lock:
+        if name not in executors:
+            options = (config.get("executors") or {}).get(name) or {}
+            workers = options.get("workers") or DEFAULT_WORKERS[name]
+            if name == "generation":
+                # enough threads to keep every model replica busy
+                workers = max(
+                    workers, sum(llm.get("replicas", 1) for llm in config["llms"])
+                )
+            executors[name] = MonitoredExecutor(name, workers)
+        return executors[name]
@@ -1,3 +1,5 @@
+import re
+import threading
 from typing import Any, Optional
 
 from langchain import hub
@@ -7,28 +9,134 @@ from langchain_core.runnables import RunnableSequence
 from langchain_community.llms.ctransformers import CTransformers
 from langchain_community.llms.huggingface_pipeline import HuggingFacePipeline
 from langchain_community.llms.openai import OpenAI
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    pipeline,
+)
 
+from .cancellation import CancellationCallback, CancellationToken
 from .utils import merge
 
-
 rephrase_prompt = hub.pull("langchain-ai/chat-langchain-rephrase")
 rag_prompt = hub.pull("rlm/rag-prompt")
 
 
+class SpeculativeDecodingStats:
+    """
+    Counters for assisted (speculative) generation with a draft model.
+
+    Every forward pass of the main model verifies the tokens proposed by the draft model and
+    contributes one token of its own, so the acceptance rate is estimated as
+    (generated tokens - main model passes) / draft model passes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.generations = 0
+        self.generated_tokens = 0
+        self.target_forward_passes = 0
+        self.draft_forward_passes = 0
+
+    def count_target_pass(self, *args) -> None:
+        with self._lock:
+            self.target_forward_passes += 1
+
+    def count_draft_pass(self, *args) -> None:
+        with self._lock:
+            self.draft_forward_passes += 1
+
+    def count_generation(self, new_tokens: int) -> None:
+        with self._lock:
+            self.generations += 1
+            self.generated_tokens += new_tokens
+
+    def as_dict(self) -> dict[str, Any]:
+        with self._lock:
+            accepted_tokens = self.generated_tokens - self.target_forward_passes
+            return {
+                "generations": self.generations,
+                "generated_tokens": self.generated_tokens,
+                "target_forward_passes": self.target_forward_passes,
+                "draft_forward_passes": self.draft_forward_passes,
+                "tokens_per_target_pass": (
+                    self.generated_tokens / self.target_forward_passes
+                    if self.target_forward_passes
+                    else None
+                ),
+                "acceptance_rate": (
+                    max(accepted_tokens, 0) / self.draft_forward_passes
+                    if self.draft_forward_passes
+                    else None
+                ),
+            }
+
+
+# Speculative decoding counters of the loaded models, by model name
+speculative_decoding_stats: dict[str, SpeculativeDecodingStats] = {}
+
+
+def enable_assisted_generation(
+    model_name: str, model: Any, draft_model: Any
+) -> SpeculativeDecodingStats:
+    """
+    Makes `model.generate` use `draft_model` for assisted generation: the draft model proposes
+    tokens and the main model verifies them in a single forward pass. With greedy decoding the
+    output is the same as without the draft model.
+    """
+    stats = speculative_decoding_stats.setdefault(
+        model_name, SpeculativeDecodingStats()
+    )
+    model.register_forward_hook(stats.count_target_pass)
+    draft_model.register_forward_hook(stats.count_draft_pass)
+
+    generate = model.generate
+
+    def assisted_generate(*args, **kwargs):
+        kwargs.setdefault("assistant_model", draft_model)
+        output = generate(*args, **kwargs)
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is not None:
+            stats.count_generation(output.shape[-1] - input_ids.shape[-1])
+        return output
+
+    model.generate = assisted_generate
+    return stats
+
+
 def get_llm(
     config: dict[str, Any],
     *,
     selected_llm_index: int = 0,
 ) -> LLM:
-    local_files_only = not config["download"]
+    return load_llm(config["llms"][selected_llm_index], download=config["download"])
+
+
+# Model options handled by the LLMRegistry rather than the model framework
+REPLICA_OPTIONS = ("replicas", "threads_per_replica", "cpu_affinity")
+
 
-    selection = config["llms"][selected_llm_index].copy()
+def load_llm(spec: dict[str, Any], *, download: bool) -> LLM:
+    local_files_only = not download
+
+    selection = {
+        key: value for key, value in spec.items() if key not in REPLICA_OPTIONS
+    }
     model_framework = selection.pop("model_framework")
+    draft_model_name = selection.pop("draft_model", None)
+    if draft_model_name is not None and model_framework != "huggingface":
+        raise ValueError(
+            f"draft_model is only supported for huggingface models, not {model_framework}"
+        )
     config = {**selection}
 
     if model_framework == "ctransformers":
         config = merge(config, {"config": {"local_files_only": local_files_only}})
+        # map GGML weights from the page cache instead of copying them, so that forked
+        # workers (and other processes loading the same file) share one copy
+        config["config"] = {"mmap": True, **config["config"]}
         llm = CTransformers(**config)
     elif model_framework == "openai":
         llm = OpenAI(**config)
@@ -43,6 +151,12 @@ def get_llm(
         )
         if not tokenizer.pad_token_id:
             tokenizer.pad_token_id = model.config.eos_token_id
+        if draft_model_name is not None:
+            # the draft model must share the tokenizer (vocabulary) of the main model
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_name, **config["model_kwargs"]
+            )
+            enable_assisted_generation(config["model"], model, draft_model)
         pipe = pipeline(
             "text-generation",
             model=model,
@@ -56,17 +170,115 @@ def get_llm(
     return llm
 
 
+# Words that usually refer back to something said earlier in the conversation
+ANAPHORIC_WORDS = set(
+    "it its this that these those they them their he him his she her there "
+    "above previous earlier former latter same else more again".split()
+)
+FOLLOW_UP_OPENERS = (
+    "and ",
+    "but ",
+    "also ",
+    "so ",
+    "what about",
+    "how about",
+    "what else",
+    "tell me more",
+    "go on",
+    "continue",
+)
+QUESTION_WORDS = {"why", "how", "what", "when", "where", "who", "which"}
+
+
+def needs_rephrasing(prompt: str, chat_history: list) -> bool:
+    """
+    Cheap heuristic deciding whether a query has to be rewritten using the chat history.
+    First-turn queries and self-contained (e.g. keyword-style) queries are used as they are.
+    """
+    if not chat_history:
+        return False
+
+    lowered = prompt.lower().strip()
+    words = re.findall(r"[a-z']+", lowered)
+    if not words:
+        return False
+    if lowered.startswith(FOLLOW_UP_OPENERS):
+        return True
+    if len(words) == 1 and words[0] in QUESTION_WORDS:
+        # e.g. "why?"
+        return True
+    return any(word in ANAPHORIC_WORDS for word in words)
+
+
+class CancellationStoppingCriteria(StoppingCriteria):
+    """
+    Stops HuggingFace generation after the next token once the request is cancelled
+    """
+
+    def __init__(self, token: CancellationToken):
+        self.token = token
+
+    def __call__(self, input_ids: Any, scores: Any, **kwargs: Any) -> bool:
+        return self.token.cancelled
+
+
+def _invoke_cancellable(
+    prompt: Any, llm: LLM, inputs: Any, cancellation: Optional[CancellationToken]
+) -> str:
+    """
+    Runs `prompt | llm`, stopping generation early if `cancellation` is cancelled.
+    Raises RequestCancelled instead of returning the partial output of a cancelled
+    generation.
+    """
+    runnable = llm
+    run_config = None
+    if cancellation is not None:
+        cancellation.raise_if_cancelled()
+        if isinstance(llm, HuggingFacePipeline):
+            # the pipeline does not stream tokens to the callbacks
+            runnable = llm.bind(
+                pipeline_kwargs={
+                    **(llm.pipeline_kwargs or {}),
+                    "stopping_criteria": StoppingCriteriaList(
+                        [CancellationStoppingCriteria(cancellation)]
+                    ),
+                }
+            )
+        run_config = {"callbacks": [CancellationCallback(cancellation)]}
+
+    if prompt is not None:
+        chain = RunnableSequence(prompt | runnable | StrOutputParser())
+    else:
+        chain = RunnableSequence(runnable | StrOutputParser())
+    output = chain.invoke(inputs, config=run_config)
+    if cancellation is not None:
+        cancellation.raise_if_cancelled()
+    return output
+
+
 def llm_rephrase_question_with_history(
-    llm: LLM, prompt: str, chat_history: list
+    llm: LLM,
+    prompt: str,
+    chat_history: list,
+    cancellation: Optional[CancellationToken] = None,
 ) -> str:
-    chain = RunnableSequence(rephrase_prompt | llm | StrOutputParser())
-    return chain.invoke({"input": prompt, "chat_history": chat_history})
+    return _invoke_cancellable(
+        rephrase_prompt,
+        llm,
+        {"input": prompt, "chat_history": chat_history},
+        cancellation,
+    )
 
 
-def llm_respond(llm: LLM, prompt: str, context: Optional[list[str]]) -> str:
+def llm_respond(
+    llm: LLM,
+    prompt: str,
+    context: Optional[list[str]],
+    cancellation: Optional[CancellationToken] = None,
+) -> str:
     if context is not None:
-        chain = RunnableSequence(rag_prompt | llm | StrOutputParser())
-        return chain.invoke({"question": prompt, "context": context})
+        return _invoke_cancellable(
+            rag_prompt, llm, {"question": prompt, "context": context}, cancellation
+        )
     else:
-        chain = RunnableSequence(llm | StrOutputParser())
-        return chain.invoke(prompt)
+        return _invoke_cancellable(None, llm, prompt, cancellation)
@@ -1,18 +1,50 @@
-from typing import Optional
+import asyncio
+import gc
+import os
+import secrets
+import signal
+import threading
+import time
+from typing import List, Optional, Union
 
 import requests
 from fastapi import FastAPI, Depends, Header, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 import uvicorn
 from langchain.schema import messages_from_dict, Document
 from langchain_core.load import load
 
-from .config import get_config
-from .add import add
-from .embeddings import get_retriever_for_webid
-from .llms import get_llm, llm_rephrase_question_with_history, llm_respond
-from .solid_utils import check_uri_access
+from .config import diff_config, get_config, validate_config
+from .add import add, migrate_legacy_location, resume_interrupted_jobs
+from .cancellation import RequestCancelled, request_cancellation
+from .embedding_cache import embedding_caches
+from .executors import executors, get_executor
+from .embeddings import get_embeddings, retrieve_documents, unload_embeddings
+from .manifest import IncompatibleVectorStoreError
+from .llms import (
+    needs_rephrasing,
+    llm_rephrase_question_with_history,
+    llm_respond,
+    speculative_decoding_stats,
+)
+from .profiler import ProfilingMiddleware, start_profile, stop_profile
+from .registry import LLMRegistry
+from .scheduler import TenantLimitExceeded, get_scheduler, schedulers
+from .serving import (
+    get_parent_pid,
+    get_worker_states,
+    publish_worker_state,
+    serve_forked,
+)
+from .tracing import TracingMiddleware, configure_tracing, span
+from .notifications import NotificationManager
+from .solid_utils import (
+    check_uri_access,
+    discover_document_uris,
+    register_retrieval_service,
+)
 
 ############
 ### Main ###
@@ -24,6 +56,8 @@ origins = [
     "*",
 ]
 
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(TracingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -33,18 +67,69 @@ app.add_middleware(
 )
 
 config = get_config()
+# fail at startup on what a reload would reject
+validate_config(config)
+configure_tracing(config)
+llm_registry = LLMRegistry(config)
+# register once in the server process; spawned worker processes import
+# solid_utils without needing the identity provider
+register_retrieval_service()
+
+
+@app.on_event("startup")
+def preload_rephrase_models():
+    # keep the dedicated rephrase models resident next to the answer models
+    for spec in llm_registry.rephrase_specs():
+        try:
+            llm_registry.load(spec)
+        except Exception as e:
+            print(f"Failed to preload rephrase model {spec['model']}: {e}")
+
+
+@app.exception_handler(TenantLimitExceeded)
+async def tenant_limit_exceeded(request: Request, exc: TenantLimitExceeded):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(RequestCancelled)
+async def request_cancelled(request: Request, exc: RequestCancelled):
+    # 499 (client closed request) is only logged, the client is gone
+    return JSONResponse(
+        status_code=504 if exc.deadline_exceeded else 499,
+        content={"detail": str(exc)},
+    )
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"Hello": "World"}
 
 
+@app.get("/metrics/")
+async def get_metrics() -> dict:
+    return {
+        "executors": {name: executor.stats() for name, executor in executors.items()},
+        "replicas": {name: pool.stats() for name, pool in llm_registry.pools().items()},
+        "tenants": {name: scheduler.stats() for name, scheduler in schedulers.items()},
+        "speculative_decoding": {
+            model: stats.as_dict()
+            for model, stats in speculative_decoding_stats.items()
+        },
+        "embedding_cache": {
+            path: cache.stats() for path, cache in embedding_caches.items()
+        },
+    }
+
+
 #########################
 ### Retrieval service ###
 #########################
 @app.get("/embeddings/models/")
-def get_embedding_models() -> list[str]:
+async def get_embedding_models() -> list[str]:
     return [config["embeddings"]["model"]]
 
 
@@ -54,12 +139,13 @@ class EmbeddingsAddData(BaseModel):
 
 
 @app.post("/embeddings/add/")
-def add_documents(data: EmbeddingsAddData, webid: Optional[str] = Header(None)):
+async def add_documents(data: EmbeddingsAddData, webid: Optional[str] = Header(None)):
     if webid is None:
         raise HTTPException(status_code=400, detail="No webid supplied!")
 
+    io_executor = get_executor(config, "io")
     try:
-        if not check_uri_access(data.docs_location):
+        if not await io_executor.run(check_uri_access, data.docs_location):
             raise HTTPException(
                 status_code=400,
                 detail="Retrieval service cannot access " + data.docs_location,
@@ -73,25 +159,116 @@ def add_documents(data: EmbeddingsAddData, webid: Optional[str] = Header(None)):
             + str(e),
         )
 
-    add(config, data.docs_location, webid)
+    docs_uris = await io_executor.run(discover_document_uris, data.docs_location)
+    # ingestion is bulk work, which must not hold up interactive queries
+    await get_scheduler(config, "embedding").run(
+        webid, add, config, data.docs_location, webid, docs_uris, bulk=True
+    )
+    if notifications is not None:
+        start_background_task(watch_location(webid, data.docs_location))
+
+
+# Tasks started in the background, referenced until they finish
+_background_tasks = set()
+
+
+def start_background_task(coroutine) -> None:
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+@app.on_event("startup")
+async def resume_ingestion():
+    if not config["ingestion"].get("resume_on_startup", True):
+        return
+
+    async def resume(webid: str, docs_location: str) -> None:
+        print(f"Resuming interrupted ingestion of {docs_location} for {webid}")
+        try:
+            await get_scheduler(config, "embedding").run(
+                webid, add, config, docs_location, webid, bulk=True
+            )
+        except Exception as e:
+            print(f"Resumed ingestion of {docs_location} for {webid} failed: {e}")
+
+    jobs = await get_executor(config, "io").run(resume_interrupted_jobs, config)
+    for webid, docs_location in jobs:
+        start_background_task(resume(webid, docs_location))
+
+
+# Watches the added locations for Solid Notifications, in one worker of the service
+notifications: Optional[NotificationManager] = None
+
+
+async def watch_location(webid: str, docs_location: str) -> None:
+    try:
+        await notifications.watch(webid, docs_location)
+    except Exception as e:
+        print(f"Failed to watch {docs_location} for {webid}: {e}")
+
+
+@app.on_event("startup")
+async def start_notifications():
+    global notifications
+    if not (config.get("notifications") or {}).get("enabled", False):
+        return
+    manager = NotificationManager(config)
+    if await manager.start():
+        notifications = manager
+    else:
+        print("Solid Notifications are handled by another worker")
+
+
+@app.on_event("shutdown")
+async def stop_notifications():
+    if notifications is not None:
+        await notifications.stop()
+
+
+@app.post("/notifications/webhook/{token}")
+async def receive_notification(token: str, request: Request):
+    try:
+        notification = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid notification body")
+    if not isinstance(notification, dict):
+        raise HTTPException(status_code=400, detail="Invalid notification body")
+    if notifications is None or not notifications.handle_webhook(token, notification):
+        raise HTTPException(status_code=404, detail="Unknown notification channel")
 
 
 class EmbeddingsRequestData(BaseModel):
     model: str
-    docs_location: str
+    # several locations are searched in parallel, merging their top results
+    docs_location: Union[str, List[str]]
     query: str
 
 
 @app.post("/embeddings/query/")
-def retrieve_relevant_documents(
+async def retrieve_relevant_documents(
     data: EmbeddingsRequestData,
     webid: Optional[str] = Header(None),
 ):
     if webid is None:
         raise HTTPException(status_code=400, detail="No webid supplied!")
 
-    retriever = get_retriever_for_webid(config, webid)
-    docs = retriever.invoke(data.query)
+    docs_locations = (
+        [data.docs_location]
+        if isinstance(data.docs_location, str)
+        else data.docs_location
+    )
+
+    def retrieve() -> List[Document]:
+        with span("retrieval", locations=len(docs_locations)):
+            for docs_location in docs_locations:
+                migrate_legacy_location(config, webid, docs_location)
+            return retrieve_documents(config, webid, docs_locations, data.query)
+
+    try:
+        docs = await get_scheduler(config, "embedding").run(webid, retrieve)
+    except IncompatibleVectorStoreError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     return docs
 
 
@@ -99,8 +276,8 @@ def retrieve_relevant_documents(
 ### LLM service ###
 ###################
 @app.get("/models/")
-def get_llm_models() -> list[str]:
-    return list(map(lambda llm: llm.get("model"), config["llms"]))
+async def get_llm_models() -> list[str]:
+    return llm_registry.model_names()
 
 
 class ChatRephraseRequestData(BaseModel):
@@ -109,18 +286,46 @@ class ChatRephraseRequestData(BaseModel):
 
 
 @app.post("/rephrase/")
-def rephrase_prompt_with_chat_history(data: ChatRephraseRequestData) -> str:
-    try:
-        selected_model_idx = [llm["model"] for llm in config["llms"]].index(data.model)
-    except ValueError:
+async def rephrase_prompt_with_chat_history(
+    data: ChatRephraseRequestData,
+    request: Request,
+    webid: Optional[str] = Header(None),
+    x_request_timeout: Optional[str] = Header(None),
+) -> str:
+    if data.model not in llm_registry.model_names():
         raise HTTPException(status_code=400, detail="Invalid model selection")
 
     messages = messages_from_dict(data.messages)
-    llm = get_llm(config, selected_llm_index=selected_model_idx)
-    response = llm_rephrase_question_with_history(
-        llm, prompt=messages[-1].content, chat_history=messages[:-1]
-    )
-    return response
+    prompt, chat_history = messages[-1].content, messages[:-1]
+    if config.get("rephrase", {}).get("fast_path", True) and not needs_rephrasing(
+        prompt, chat_history
+    ):
+        return prompt
+
+    async with request_cancellation(request, x_request_timeout) as cancellation:
+
+        def rephrase() -> Optional[str]:
+            for pool in llm_registry.rephrase_candidates(data.model):
+                try:
+                    with span("rephrase", model=pool.name), pool.acquire() as llm:
+                        return llm_rephrase_question_with_history(
+                            llm,
+                            prompt=prompt,
+                            chat_history=chat_history,
+                            cancellation=cancellation,
+                        )
+                except RequestCancelled:
+                    raise
+                except Exception as e:
+                    print(f"Rephrasing failed, trying next model: {e}")
+            return None
+
+        rephrased = await get_scheduler(config, "generation").run(
+            webid, rephrase, cancellation=cancellation
+        )
+    if rephrased is None:
+        raise HTTPException(status_code=500, detail="No model could rephrase the query")
+    return rephrased
 
 
 class ChatCompletionRequestData(BaseModel):
@@ -130,22 +335,245 @@ class ChatCompletionRequestData(BaseModel):
 
 
 @app.post("/completions/")
-def chat_completion(data: ChatCompletionRequestData) -> str:
-    try:
-        selected_model_idx = [llm["model"] for llm in config["llms"]].index(data.model)
-    except ValueError:
+async def chat_completion(
+    data: ChatCompletionRequestData,
+    request: Request,
+    webid: Optional[str] = Header(None),
+    x_request_timeout: Optional[str] = Header(None),
+) -> str:
+    if data.model not in llm_registry.model_names():
         raise HTTPException(status_code=400, detail="Invalid model selection")
-    
-    llm = get_llm(config, selected_llm_index=selected_model_idx)
+
     context = [load(doc) for doc in data.context]
-    response = llm_respond(llm, data.prompt, context)
-    return response
+
+    async with request_cancellation(request, x_request_timeout) as cancellation:
+
+        def respond() -> str:
+            # loading the model on first use is blocking work too
+            with span("generate", model=data.model, documents=len(context)):
+                with llm_registry.acquire(data.model) as llm:
+                    return llm_respond(llm, data.prompt, context, cancellation)
+
+        return await get_scheduler(config, "generation").run(
+            webid, respond, cancellation=cancellation
+        )
+
+
+#############
+### Admin ###
+#############
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    token = (config.get("admin") or {}).get("token")
+    if not token:
+        raise HTTPException(
+            status_code=403, detail="Admin endpoints are disabled, set admin.token"
+        )
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, token):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+# State of the last configuration reload, reported by GET /admin/reload/
+reload_status: dict = {"state": "idle"}
+_reload_lock = threading.Lock()
+
+
+def _update_reload_status(**fields) -> None:
+    reload_status.update(fields)
+    if get_parent_pid() is not None:
+        # for GET /admin/reload/ requests served by the other workers
+        publish_worker_state("reload", reload_status)
+
+
+def check_config() -> dict:
+    """
+    Re-reads genpod.yml and validates it, raising ValueError if it cannot be served.
+    Returns the differences to the running configuration.
+    """
+    new_config = get_config()
+    validate_config(new_config)
+    return diff_config(config, new_config)
+
+
+def reload_config() -> dict:
+    """
+    Re-reads genpod.yml and, if it is valid, switches to it in the background without
+    interrupting requests: new models are loaded first, then requests are routed by
+    the new configuration, and removed models are unloaded once their requests finish.
+    Returns the differences to the running configuration.
+    """
+    if not _reload_lock.acquire(blocking=False):
+        raise RuntimeError("A configuration reload is already in progress")
+    try:
+        new_config = get_config()
+        validate_config(new_config)
+    except Exception:
+        _reload_lock.release()
+        raise
+
+    diff = diff_config(config, new_config)
+    reload_status.clear()
+    _update_reload_status(state="loading", diff=diff, started_at=time.time())
+    threading.Thread(target=_apply_config, args=(new_config,), daemon=True).start()
+    return diff
+
+
+def _apply_config(new_config: dict) -> None:
+    global config
+    switched = False
+    try:
+        get_embeddings(new_config)
+        llm_registry.prepare(new_config)
+
+        # nothing blocks between these assignments
+        removed = llm_registry.switch(new_config)
+        for scheduler in schedulers.values():
+            scheduler.config = new_config
+        if notifications is not None:
+            # its own options only change on a restart
+            notifications.config = new_config
+        config = new_config
+        switched = True
+        configure_tracing(new_config)
+
+        _update_reload_status(state="unloading")
+        unload_embeddings(new_config)
+        for pool in removed:
+            pool.wait_idle()
+            print(f"Unloaded model {pool.name}")
+        del removed
+        gc.collect()
+        _update_reload_status(state="done", finished_at=time.time())
+    except Exception as e:
+        print(f"Configuration reload failed: {e}")
+        if not switched:
+            # forget the models loaded for the new configuration
+            llm_registry.switch(config)
+        _update_reload_status(state="failed", error=str(e), finished_at=time.time())
+    finally:
+        _reload_lock.release()
+
+
+@app.post("/admin/reload/", dependencies=[Depends(require_admin)])
+async def reload_configuration() -> dict:
+    parent_pid = get_parent_pid()
+    try:
+        if parent_pid is None:
+            diff = await get_executor(config, "io").run(reload_config)
+            return {**reload_status, "diff": diff}
+        # the parent forwards SIGHUP to every worker, this one included, and each
+        # worker reloads the configuration itself
+        diff = await get_executor(config, "io").run(check_config)
+    except (RuntimeError, ValueError) as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    os.kill(parent_pid, signal.SIGHUP)
+    return {"state": "signalled", "diff": diff}
+
+
+@app.get("/admin/reload/", dependencies=[Depends(require_admin)])
+async def get_reload_status() -> dict:
+    if get_parent_pid() is None:
+        return reload_status
+    # states of the workers that have not reloaded since they started are not published
+    return {
+        "workers": {
+            pid: state or {"state": "idle"}
+            for pid, state in get_worker_states("reload").items()
+        }
+    }
+
+
+class ProfileRequestData(BaseModel):
+    # seconds to sample for, or to wait for the profiled requests at most
+    duration: Optional[float] = None
+    # profile only the next `requests` requests to `endpoint`
+    endpoint: Optional[str] = None
+    requests: Optional[int] = None
+    # speedscope or collapsed (flamegraph.pl)
+    format: str = "speedscope"
+
+
+@app.post("/admin/profile/", dependencies=[Depends(require_admin)])
+async def profile(data: ProfileRequestData):
+    options = config.get("profiling") or {}
+    if not options.get("enabled", False):
+        raise HTTPException(
+            status_code=403, detail="Profiling is disabled, set profiling.enabled"
+        )
+    if data.format not in ("speedscope", "collapsed"):
+        raise HTTPException(status_code=400, detail=f"Invalid format: {data.format}")
+    if (data.endpoint is None) != (data.requests is None):
+        raise HTTPException(status_code=400, detail="endpoint and requests go together")
+    max_duration = options.get("max_duration", 60)
+    duration = min(data.duration or max_duration, max_duration)
+
+    try:
+        profile = start_profile(
+            options.get("interval", 0.01), data.endpoint, data.requests
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        await profile.wait(duration)
+    finally:
+        stop_profile(profile)
+
+    filename = f"llm_service-{time.strftime('%Y%m%d-%H%M%S')}"
+    if data.format == "collapsed":
+        return PlainTextResponse(
+            profile.collapsed(),
+            headers={"Content-Disposition": f'attachment; filename="{filename}.txt"'},
+        )
+    return JSONResponse(
+        profile.speedscope(),
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}.speedscope.json"'
+        },
+    )
+
+
+@app.on_event("startup")
+async def reload_on_sighup():
+    if not hasattr(signal, "SIGHUP"):
+        return
+
+    def on_sighup():
+        try:
+            print("SIGHUP received, reloading configuration:", reload_config())
+        except Exception as e:
+            print(f"Configuration reload failed: {e}")
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, on_sighup)
+    except (NotImplementedError, RuntimeError, ValueError) as e:
+        # e.g. when the server does not run in the main thread
+        print(f"Not reloading the configuration on SIGHUP: {e}")
 
 
 ############
 ### Main ###
 ############
+def preload_models():
+    """
+    Loads the embedding model and all LLMs, so that forked workers share them
+    """
+    get_embeddings(config)
+    for model in llm_registry.model_names():
+        llm_registry.get(model)
+    preload_rephrase_models()
+
+
 def main():
+    serving = config.get("serving") or {}
+    if serving.get("workers", 1) > 1:
+        serve_forked(
+            app,
+            host=config.get("host", "127.0.0.1"),
+            port=config.get("port", 5000),
+            workers=serving["workers"],
+            preload=preload_models if serving.get("preload", True) else lambda: None,
+        )
+        return
+
     uvicorn.run(
         "llm_service.main:app",
         host=config.get("host", "127.0.0.1"),
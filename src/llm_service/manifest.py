@@ -0,0 +1,132 @@
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+class IncompatibleVectorStoreError(RuntimeError):
+    pass
+
+
+class VectorStoreManifest(BaseModel):
+    """
+    Describes how the vector store of a WebID's documents from one location was built.
+    A store only exists if it has a manifest, and it is only appended to if it was
+    built the same way as configured now.
+    """
+
+    version: int = MANIFEST_VERSION
+    docs_location: Optional[str] = None
+    backend: str
+    embedding_model: str
+    embedding_backend: str
+    # instruction and encode_kwargs (e.g. normalize_embeddings) the chunks were embedded
+    # with, unknown for stores built before they were recorded
+    embed_instruction: Optional[str] = None
+    encode_kwargs: Dict[str, Any] = {}
+    dimension: Optional[int] = None
+    chunking: Dict[str, Any]
+    document_count: int = 0
+    last_sync: Optional[datetime] = None
+
+
+def get_configured_manifest(config: Dict[str, Any]) -> VectorStoreManifest:
+    return VectorStoreManifest(
+        backend=(config.get("vectorstore") or {}).get("backend", "chroma"),
+        embedding_model=config["embeddings"]["model"],
+        embedding_backend=config["embeddings"].get("backend", "torch"),
+        embed_instruction=config["embeddings"].get("embed_instruction"),
+        encode_kwargs=config["embeddings"].get("encode_kwargs") or {},
+        chunking=config["chunking"],
+    )
+
+
+def read_manifest(persist_directory: str) -> Optional[VectorStoreManifest]:
+    path = os.path.join(persist_directory, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return VectorStoreManifest.model_validate_json(f.read())
+
+
+def write_manifest(persist_directory: str, manifest: VectorStoreManifest) -> None:
+    path = os.path.join(persist_directory, MANIFEST_FILENAME)
+    os.makedirs(persist_directory, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        # keep what older manifests did not record unknown
+        f.write(
+            manifest.model_dump_json(
+                indent=2,
+                exclude={
+                    field
+                    for field in ["embed_instruction", "encode_kwargs"]
+                    if field not in manifest.model_fields_set
+                },
+            )
+        )
+    os.replace(path + ".tmp", path)
+
+
+# Fields of the manifest that must match the configuration to query a store
+EMBEDDING_FIELDS = [
+    "backend",
+    "embedding_model",
+    "embedding_backend",
+    "embed_instruction",
+    "encode_kwargs",
+]
+
+
+def _changed_fields(
+    manifest: VectorStoreManifest, expected: VectorStoreManifest, fields: List[str]
+) -> List[str]:
+    return [
+        field
+        for field in fields
+        # fields missing from older manifests are not compared
+        if field in manifest.model_fields_set
+        and getattr(manifest, field) != getattr(expected, field)
+    ]
+
+
+def get_rebuild_reason(
+    manifest: VectorStoreManifest, config: Dict[str, Any]
+) -> Optional[str]:
+    """
+    Returns why a store with this manifest cannot be appended to with the current
+    configuration, or None if it can
+    """
+    expected = get_configured_manifest(config)
+    if manifest.version != MANIFEST_VERSION:
+        return f"manifest version {manifest.version} is not {MANIFEST_VERSION}"
+    changed = _changed_fields(manifest, expected, [*EMBEDDING_FIELDS, "chunking"])
+    if not changed:
+        return None
+    field = changed[0]
+    return (
+        f"{field} changed from {getattr(manifest, field)} "
+        f"to {getattr(expected, field)}"
+    )
+
+
+def check_query_compatibility(
+    manifest: Optional[VectorStoreManifest], config: Dict[str, Any]
+) -> None:
+    """
+    Raises if the store was built with other embeddings than the ones used for queries
+    """
+    if manifest is None:
+        return
+    expected = get_configured_manifest(config)
+    changed = _changed_fields(manifest, expected, EMBEDDING_FIELDS)
+    if changed:
+        field = changed[0]
+        raise IncompatibleVectorStoreError(
+            f"The vector store was built with {field} {getattr(manifest, field)}, "
+            f"but {getattr(expected, field)} is configured. "
+            "Add the documents again."
+        )
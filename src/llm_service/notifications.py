@@ -0,0 +1,412 @@
+import asyncio
+import fcntl
+import json
+import os
+import secrets
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .add import add
+from .embeddings import get_partition_directory
+from .executors import get_executor
+from .scheduler import get_scheduler
+from .solid_utils import crawl, find_subscription_services, subscribe, unsubscribe
+from .source_index import SourceIndex, find_source_indexes
+
+WEBSOCKET_CHANNEL = "WebSocketChannel2023"
+WEBHOOK_CHANNEL = "WebhookChannel2023"
+
+# Activity types of the notifications that a resource was created, changed or removed
+CHANGE_TYPES = {"Create", "Update", "Add"}
+REMOVAL_TYPES = {"Delete", "Remove"}
+
+# Held by the worker that subscribes, when the service runs several workers
+LOCK_FILENAME = "notifications.lock"
+
+
+class PendingChanges:
+    """Changes to a location notified since its last update"""
+
+    def __init__(self):
+        self.changed: Set[str] = set()
+        self.removed: Set[str] = set()
+        # containers whose members changed, to be crawled again
+        self.rescan: Set[str] = set()
+        self.first_at: Optional[float] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def __bool__(self) -> bool:
+        return bool(self.changed or self.removed or self.rescan)
+
+
+class Watch:
+    """
+    Notification channels on the containers (and documents) of a location a WebID
+    added, and the changes notified on them that are waiting to be re-indexed
+    """
+
+    def __init__(self, webid: str, docs_location: str):
+        self.webid = webid
+        self.docs_location = docs_location
+        # channel descriptions, by topic
+        self.channels: Dict[str, Dict[str, Any]] = {}
+        self.listeners: Dict[str, asyncio.Task] = {}
+        self.pending = PendingChanges()
+        self.updating: Optional[asyncio.Task] = None
+
+
+def get_activity_type(notification: Dict[str, Any]) -> Optional[str]:
+    activity_type = notification.get("type")
+    if isinstance(activity_type, list):
+        activity_type = next(iter(activity_type), None)
+    if not isinstance(activity_type, str):
+        return None
+    # e.g. as:Update or https://www.w3.org/ns/activitystreams#Update
+    return activity_type.replace("#", ":").rsplit(":", 1)[-1]
+
+
+def get_object(notification: Dict[str, Any]) -> Optional[str]:
+    obj = notification.get("object")
+    if isinstance(obj, dict):
+        obj = obj.get("id") or obj.get("@id")
+    return obj if isinstance(obj, str) else None
+
+
+def find_watched_locations(config: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """The WebIDs and docs locations that were added, from their source indexes"""
+    locations = []
+    for directory in find_source_indexes(config["chroma"]["persist_directory"]):
+        with SourceIndex(directory) as source_index:
+            location = source_index.get_location()
+        if location is not None:
+            locations.append(tuple(location))
+    return locations
+
+
+def get_container(watch: Watch, topic: str) -> str:
+    container = topic.rstrip("/").rsplit("/", 1)[0] + "/"
+    return (
+        container if container.startswith(watch.docs_location) else watch.docs_location
+    )
+
+
+def resolve_changes(
+    config: Dict[str, Any], watch: Watch, changes: PendingChanges
+) -> Tuple[Set[str], Set[str], List[str], List[str]]:
+    """
+    Crawls the containers to rescan, returning the changed and removed documents, the
+    resources found on the way and the containers crawled
+    """
+    changed = set(changes.changed)
+    removed = set(changes.removed)
+    found = []
+    rescanned = []
+    if changes.rescan:
+        with SourceIndex(
+            get_partition_directory(config, watch.webid, watch.docs_location)
+        ) as source_index:
+            indexed = set(source_index.get_hashes())
+        for container in changes.rescan:
+            try:
+                documents, containers = crawl(container)
+            except Exception as e:
+                print(f"Failed to crawl {container}: {e}")
+                continue
+            # containers that can no longer be read, e.g. because they were deleted
+            documents = [uri for uri in documents if not uri.endswith("/")]
+            changed.update(documents)
+            removed.update(
+                source
+                for source in indexed
+                if source.startswith(container) and source not in documents
+            )
+            found.extend([*containers, *documents])
+            rescanned.append(container)
+        removed -= changed
+    return changed, removed, found, rescanned
+
+
+class NotificationManager:
+    """
+    Subscribes to Solid Notifications on the locations added by WebIDs and re-indexes
+    the documents they report as created, changed or deleted. Notifications arriving
+    in quick succession are coalesced into one incremental update per location.
+
+    Must be used from the event loop.
+
+    Args:
+        config: The llm_service configuration
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.options = config.get("notifications") or {}
+        self.watches: Dict[Tuple[str, str], Watch] = {}
+        self._webhooks: Dict[str, Tuple[Watch, str]] = {}
+        self._lock_file = None
+        self._refresher: Optional[asyncio.Task] = None
+        self._services: Dict[str, str] = {}
+
+    @property
+    def channel_type(self) -> str:
+        if self.options.get("webhook_url"):
+            return WEBHOOK_CHANNEL
+        return WEBSOCKET_CHANNEL
+
+    async def start(self) -> bool:
+        """
+        Watches the locations added so far, unless another worker of the service
+        already does. Returns whether this process watches them.
+        """
+        persist_directory = self.config["chroma"]["persist_directory"]
+        os.makedirs(persist_directory, exist_ok=True)
+        lock_file = open(os.path.join(persist_directory, LOCK_FILENAME), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self._refresher = asyncio.create_task(self._refresh_periodically())
+        return True
+
+    async def stop(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+        for watch in list(self.watches.values()):
+            await self._drop(watch, list(watch.channels))
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _refresh_periodically(self) -> None:
+        # locations may be added by other workers of the service
+        while True:
+            try:
+                locations = await get_executor(self.config, "io").run(
+                    find_watched_locations, self.config
+                )
+            except Exception as e:
+                print(f"Failed to look for locations to watch: {e}")
+                locations = []
+            for webid, docs_location in locations:
+                if (webid, docs_location) in self.watches:
+                    continue
+                try:
+                    await self.watch(webid, docs_location)
+                except Exception as e:
+                    print(f"Failed to watch {docs_location} for {webid}: {e}")
+            await asyncio.sleep(self.options.get("refresh_seconds", 60))
+
+    async def watch(self, webid: str, docs_location: str) -> None:
+        """Subscribes to the containers (and documents) of a location"""
+        documents, containers = await get_executor(self.config, "io").run(
+            crawl, docs_location
+        )
+        watch = self.watches.get((webid, docs_location))
+        if watch is None:
+            watch = self.watches[webid, docs_location] = Watch(webid, docs_location)
+        await self._subscribe(watch, [*containers, *documents])
+
+    async def _subscribe(self, watch: Watch, topics: List[str]) -> None:
+        if not self.options.get("subscribe_documents", True):
+            topics = [topic for topic in topics if topic.endswith("/")]
+        topics = [topic for topic in topics if topic not in watch.channels]
+        if not topics:
+            return
+        io_executor = get_executor(self.config, "io")
+        try:
+            service = await io_executor.run(self._get_service, watch.docs_location)
+        except Exception as e:
+            print(f"Cannot subscribe to notifications on {watch.docs_location}: {e}")
+            return
+
+        for topic in topics:
+            try:
+                channel = await io_executor.run(
+                    self._open_channel, watch, topic, service
+                )
+            except Exception as e:
+                print(f"Failed to subscribe to notifications on {topic}: {e}")
+                continue
+            watch.channels[topic] = channel
+            if self.channel_type == WEBSOCKET_CHANNEL:
+                watch.listeners[topic] = asyncio.create_task(
+                    self._listen(watch, topic, service)
+                )
+
+    def _get_service(self, uri: str) -> str:
+        if self.options.get("subscription_service"):
+            return self.options["subscription_service"]
+        if uri not in self._services:
+            services = find_subscription_services(uri)
+            if self.channel_type not in services:
+                raise RuntimeError(f"The pod offers no {self.channel_type} channels")
+            self._services[uri] = services[self.channel_type]
+        return self._services[uri]
+
+    def _open_channel(self, watch: Watch, topic: str, service: str) -> Dict[str, Any]:
+        if self.channel_type == WEBSOCKET_CHANNEL:
+            return subscribe(service, WEBSOCKET_CHANNEL, topic)
+        token = secrets.token_urlsafe(16)
+        channel = subscribe(
+            service,
+            WEBHOOK_CHANNEL,
+            topic,
+            send_to=f"{self.options['webhook_url'].rstrip('/')}"
+            f"/notifications/webhook/{token}",
+        )
+        channel["token"] = token
+        self._webhooks[token] = (watch, topic)
+        return channel
+
+    async def _listen(self, watch: Watch, topic: str, service: str) -> None:
+        # installed with uvicorn[standard]
+        import websockets
+
+        channel = watch.channels[topic]
+        while True:
+            try:
+                async with websockets.connect(channel["receiveFrom"]) as websocket:
+                    async for message in websocket:
+                        self.notify(watch, json.loads(message))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Notification channel on {topic} closed: {e}")
+            await asyncio.sleep(self.options.get("reconnect_seconds", 10))
+            io_executor = get_executor(self.config, "io")
+            try:
+                # the pod may keep the channel open although the connection closed
+                await io_executor.run(unsubscribe, channel["id"])
+            except Exception:
+                pass
+            try:
+                channel = watch.channels[topic] = await io_executor.run(
+                    subscribe, service, WEBSOCKET_CHANNEL, topic
+                )
+            except Exception as e:
+                print(f"Failed to subscribe to notifications on {topic} again: {e}")
+                # e.g. the topic was deleted, which a rescan of its container finds
+                watch.pending.rescan.add(get_container(watch, topic))
+            else:
+                # notifications sent while disconnected are lost, so check for them
+                if topic.endswith("/"):
+                    watch.pending.rescan.add(topic)
+                else:
+                    watch.pending.changed.add(topic)
+            self._schedule(watch)
+
+    async def _drop(self, watch: Watch, topics: List[str]) -> None:
+        io_executor = get_executor(self.config, "io")
+        for topic in topics:
+            listener = watch.listeners.pop(topic, None)
+            if listener is not None:
+                listener.cancel()
+            channel = watch.channels.pop(topic, None)
+            if channel is None:
+                continue
+            self._webhooks.pop(channel.get("token"), None)
+            if channel.get("id"):
+                try:
+                    await io_executor.run(unsubscribe, channel["id"])
+                except Exception as e:
+                    print(f"Failed to unsubscribe from {topic}: {e}")
+
+    def handle_webhook(self, token: str, notification: Dict[str, Any]) -> bool:
+        """Handles a notification sent to a webhook, if the webhook is known"""
+        webhook = self._webhooks.get(token)
+        if webhook is None:
+            return False
+        self.notify(webhook[0], notification)
+        return True
+
+    def notify(self, watch: Watch, notification: Dict[str, Any]) -> None:
+        """Records the change a notification reports, to re-index it shortly"""
+        activity_type = get_activity_type(notification)
+        obj = get_object(notification)
+        if obj is None or not obj.startswith(watch.docs_location):
+            return
+        pending = watch.pending
+        if obj.endswith("/"):
+            if activity_type not in CHANGE_TYPES | REMOVAL_TYPES:
+                return
+            pending.rescan.add(obj)
+        elif activity_type in REMOVAL_TYPES:
+            pending.changed.discard(obj)
+            pending.removed.add(obj)
+        elif activity_type in CHANGE_TYPES:
+            pending.removed.discard(obj)
+            pending.changed.add(obj)
+        else:
+            return
+        self._schedule(watch)
+
+    def _schedule(self, watch: Watch) -> None:
+        """
+        Updates the index once no change was notified for `debounce_seconds`, or
+        `max_delay_seconds` after the first change, whichever comes first
+        """
+        loop = asyncio.get_running_loop()
+        pending = watch.pending
+        now = loop.time()
+        if pending.first_at is None:
+            pending.first_at = now
+        if pending.timer is not None:
+            pending.timer.cancel()
+        delay = min(
+            self.options.get("debounce_seconds", 2),
+            max(pending.first_at + self.options.get("max_delay_seconds", 30) - now, 0),
+        )
+        pending.timer = loop.call_later(delay, self._flush, watch)
+
+    def _flush(self, watch: Watch) -> None:
+        if watch.updating is not None:
+            # changes notified meanwhile are flushed once the running update ends
+            return
+        changes = watch.pending
+        watch.pending = PendingChanges()
+        watch.updating = asyncio.create_task(self._update(watch, changes))
+
+        def done(task: asyncio.Task) -> None:
+            watch.updating = None
+            if watch.pending:
+                self._schedule(watch)
+
+        watch.updating.add_done_callback(done)
+
+    async def _update(self, watch: Watch, changes: PendingChanges) -> None:
+        try:
+            changed, removed, found, rescanned = await get_executor(
+                self.config, "io"
+            ).run(resolve_changes, self.config, watch, changes)
+            if changed or removed:
+                print(
+                    f"Re-indexing {len(changed)} changed and {len(removed)} removed "
+                    f"documents of {watch.docs_location}"
+                )
+                # re-indexing is bulk work, which must not hold up interactive queries
+                await get_scheduler(self.config, "embedding").run(
+                    watch.webid,
+                    add,
+                    self.config,
+                    watch.docs_location,
+                    watch.webid,
+                    sorted(changed),
+                    removed_uris=sorted(removed),
+                    bulk=True,
+                )
+            await self._drop(
+                watch,
+                [
+                    topic
+                    for topic in watch.channels
+                    if topic in removed
+                    or any(
+                        topic.startswith(container) and topic not in found
+                        for container in rescanned
+                    )
+                ],
+            )
+            await self._subscribe(watch, [*found, *changed])
+        except Exception as e:
+            print(f"Failed to re-index {watch.docs_location} for {watch.webid}: {e}")
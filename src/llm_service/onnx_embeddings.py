@@ -0,0 +1,308 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+EXPORT_INFO_FILENAME = "export.json"
+VALIDATION_FILENAME = "validation.json"
+
+# Used to compare the exported model with the reference model
+VALIDATION_TEXTS = [
+    "Solid is a specification that lets people store their data securely in decentralized data stores called Pods.",
+    "The meeting was moved to Thursday afternoon because half of the team is travelling.",
+    "What are the side effects of taking ibuprofen together with coffee?",
+    "Retrieval augmented generation grounds the answers of a language model in retrieved documents.",
+    "def merge(a, b):\n    return {**a, **b}",
+    "Turtles can live for more than a hundred years.",
+]
+
+
+# Bumped whenever exports made by an older version can no longer be loaded correctly
+EXPORT_VERSION = 2
+# Pooling modes of sentence-transformers, in the order it concatenates them
+POOLING_MODES = ["cls_token", "max_tokens", "mean_tokens", "mean_sqrt_len_tokens"]
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError(
+            "The onnx embeddings backend requires onnx and onnxruntime: "
+            "pip install onnx onnxruntime"
+        ) from e
+    return onnxruntime
+
+
+def get_pooling_modes(pooling: Any) -> List[str]:
+    """
+    Pooling modes enabled in a sentence-transformers (or INSTRUCTOR) Pooling module
+    """
+    pooling_config = pooling.get_config_dict()
+    modes = [
+        mode
+        for mode, enabled in pooling_config.items()
+        if mode.startswith("pooling_mode_") and enabled
+    ]
+    unsupported = [
+        mode
+        for mode in modes
+        if mode.removeprefix("pooling_mode_") not in POOLING_MODES
+    ]
+    if unsupported:
+        raise ValueError(
+            f"Unsupported pooling modes for the ONNX export: {unsupported}"
+        )
+    return [mode for mode in POOLING_MODES if "pooling_mode_" + mode in modes]
+
+
+def export_onnx_model(reference: Embeddings, export_dir: Path, quantize: bool) -> Path:
+    """
+    Exports the sentence-transformers (or INSTRUCTOR) model behind `reference` to ONNX,
+    including its configured pooling, any dense/normalisation layers and the
+    normalisation requested by `normalize_embeddings`, and optionally quantizes its
+    weights to int8.
+    """
+    import torch
+
+    _import_onnxruntime()
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    client = reference.client
+    modules = list(client)
+    transformer, head = modules[0].auto_model, torch.nn.Sequential(*modules[2:])
+    pooling_modes = get_pooling_modes(modules[1])
+    encode_kwargs = getattr(reference, "encode_kwargs", None) or {}
+    normalize = bool(encode_kwargs.get("normalize_embeddings", False))
+    # INSTRUCTOR leaves the instruction tokens out of the pooled embedding, while
+    # other models embed the instruction as part of the text
+    pool_instruction = type(client).__name__ != "INSTRUCTOR"
+
+    class PooledEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+            self.head = head
+
+        def forward(self, input_ids, attention_mask, pooling_mask):
+            token_embeddings = self.transformer(
+                input_ids=input_ids, attention_mask=attention_mask
+            )[0]
+            mask = pooling_mask.unsqueeze(-1).to(token_embeddings.dtype)
+            token_count = mask.sum(1).clamp(min=1e-9)
+            pooled = []
+            for mode in pooling_modes:
+                if mode == "cls_token":
+                    pooled.append(token_embeddings[:, 0])
+                elif mode == "max_tokens":
+                    masked = token_embeddings.masked_fill(mask == 0, -1e9)
+                    pooled.append(masked.max(1).values)
+                elif mode == "mean_tokens":
+                    pooled.append((token_embeddings * mask).sum(1) / token_count)
+                else:
+                    pooled.append((token_embeddings * mask).sum(1) / token_count.sqrt())
+            embeddings = self.head({"sentence_embedding": torch.cat(pooled, 1)})[
+                "sentence_embedding"
+            ]
+            if normalize:
+                embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+            return embeddings
+
+    export_dir.mkdir(parents=True, exist_ok=True)
+    model_path = export_dir / "model.onnx"
+    sample = client.tokenizer(["Hello world"], return_tensors="pt")
+    dynamic_axes = {"batch": 0, "sequence": 1}
+    with torch.no_grad():
+        torch.onnx.export(
+            PooledEncoder().eval(),
+            (sample["input_ids"], sample["attention_mask"], sample["attention_mask"]),
+            str(model_path),
+            input_names=["input_ids", "attention_mask", "pooling_mask"],
+            output_names=["embeddings"],
+            dynamic_axes={
+                "input_ids": dynamic_axes,
+                "attention_mask": dynamic_axes,
+                "pooling_mask": dynamic_axes,
+                "embeddings": {"batch": 0},
+            },
+            opset_version=14,
+        )
+    if quantize:
+        quantized_path = export_dir / "model.int8.onnx"
+        quantize_dynamic(
+            str(model_path), str(quantized_path), weight_type=QuantType.QInt8
+        )
+        model_path = quantized_path
+
+    client.tokenizer.save_pretrained(str(export_dir))
+    with open(export_dir / EXPORT_INFO_FILENAME, "w") as f:
+        json.dump(
+            {
+                "version": EXPORT_VERSION,
+                "model_file": model_path.name,
+                "max_seq_length": client.max_seq_length,
+                "embed_instruction": getattr(reference, "embed_instruction", None),
+                "query_instruction": getattr(reference, "query_instruction", None),
+                "pool_instruction": pool_instruction,
+            },
+            f,
+            indent=2,
+        )
+    return model_path
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Embeddings computed with an exported (and possibly int8 quantized) model on ONNX Runtime
+
+    Args:
+        export_dir: Directory created by `export_onnx_model`
+        batch_size: Number of texts to embed in one inference call
+        threads: Number of intra-op threads, or None for the ONNX Runtime default
+    """
+
+    def __init__(
+        self, export_dir: Path, batch_size: int = 32, threads: Optional[int] = None
+    ):
+        onnxruntime = _import_onnxruntime()
+        from transformers import AutoTokenizer
+
+        with open(export_dir / EXPORT_INFO_FILENAME) as f:
+            info = json.load(f)
+        self.max_seq_length = info["max_seq_length"]
+        self.embed_instruction = info["embed_instruction"]
+        self.query_instruction = info["query_instruction"]
+        self.pool_instruction = info.get("pool_instruction", False)
+        self.batch_size = batch_size
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            str(export_dir / info["model_file"]),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(str(export_dir))
+
+    def _embed(self, texts: List[str], instruction: Optional[str]) -> List[List[float]]:
+        instruction_length = 0
+        if instruction:
+            texts = [instruction + text for text in texts]
+            if not self.pool_instruction:
+                # the tokenized instruction ends with an end of sequence token
+                instruction_length = len(self.tokenizer(instruction)["input_ids"]) - 1
+
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[i : i + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            pooling_mask = encoded["attention_mask"].copy()
+            pooling_mask[:, :instruction_length] = 0
+            (batch_embeddings,) = self.session.run(
+                None,
+                {
+                    "input_ids": encoded["input_ids"].astype(np.int64),
+                    "attention_mask": encoded["attention_mask"].astype(np.int64),
+                    "pooling_mask": pooling_mask.astype(np.int64),
+                },
+            )
+            embeddings.extend(batch_embeddings.tolist())
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, self.embed_instruction)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], self.query_instruction)[0]
+
+
+def validate_onnx_embeddings(
+    reference: Embeddings, embeddings: Embeddings, texts: List[str] = VALIDATION_TEXTS
+) -> Dict[str, float]:
+    """
+    Reports the cosine similarity between the reference and exported model embeddings
+    """
+    expected = np.array(reference.embed_documents(texts))
+    actual = np.array(embeddings.embed_documents(texts))
+    similarities = (expected * actual).sum(1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    )
+    return {
+        "texts": len(texts),
+        "mean_cosine_similarity": float(similarities.mean()),
+        "min_cosine_similarity": float(similarities.min()),
+    }
+
+
+def get_export_dir(embeddings_config: Dict[str, Any]) -> Path:
+    """
+    Cache directory of the export of a configuration. The export bakes in the
+    instructions and encode_kwargs (e.g. normalize_embeddings), so it is keyed by
+    them too.
+    """
+    onnx_config = embeddings_config.get("onnx") or {}
+    quantize = onnx_config.get("quantize", True)
+    settings = {
+        key: value
+        for key, value in embeddings_config.items()
+        if key not in ("model", "backend", "onnx", "parallel")
+    }
+    settings_hash = hashlib.sha256(
+        json.dumps(settings, sort_keys=True).encode()
+    ).hexdigest()[:8]
+    return Path(onnx_config.get("cache_dir", "onnx_models")) / (
+        embeddings_config["model"].replace("/", "--")
+        + f"-{settings_hash}"
+        + ("-int8" if quantize else "")
+    )
+
+
+def _read_export_version(export_dir: Path) -> Optional[int]:
+    try:
+        with open(export_dir / EXPORT_INFO_FILENAME) as f:
+            return json.load(f).get("version")
+    except FileNotFoundError:
+        return None
+
+
+def get_onnx_embeddings(
+    embeddings_config: Dict[str, Any], load_reference: Callable[[], Embeddings]
+) -> OnnxEmbeddings:
+    """
+    Loads the ONNX version of the configured embeddings model, exporting and validating it
+    against the reference model first if it is not cached yet (or was exported by an
+    older version)
+    """
+    onnx_config = embeddings_config.get("onnx") or {}
+    export_dir = get_export_dir(embeddings_config)
+    kwargs = {
+        "batch_size": onnx_config.get("batch_size", 32),
+        "threads": onnx_config.get("threads"),
+    }
+    if _read_export_version(export_dir) == EXPORT_VERSION:
+        return OnnxEmbeddings(export_dir, **kwargs)
+
+    print(f"Exporting {embeddings_config['model']} to ONNX at {export_dir}")
+    reference = load_reference()
+    export_onnx_model(reference, export_dir, onnx_config.get("quantize", True))
+    embeddings = OnnxEmbeddings(export_dir, **kwargs)
+
+    report = validate_onnx_embeddings(reference, embeddings)
+    with open(export_dir / VALIDATION_FILENAME, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"ONNX embeddings validation: {report}")
+    if report["min_cosine_similarity"] < onnx_config.get("min_cosine_similarity", 0.98):
+        print(
+            "WARNING: ONNX embeddings differ noticeably from the reference model, "
+            "consider disabling quantization"
+        )
+    return embeddings
@@ -0,0 +1,235 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# Deepest stack recorded per sample, counted from the outermost frame
+MAX_STACK_DEPTH = 256
+
+
+def format_frame(frame: Any) -> str:
+    code = frame.f_code
+    # the package and module are enough to tell frames apart
+    filename = os.sep.join(code.co_filename.split(os.sep)[-2:])
+    return f"{code.co_name} ({filename}:{frame.f_lineno})"
+
+
+class Profile:
+    """
+    Sampling profile of the threads of this process, taken every `interval` seconds
+    from sys._current_frames().
+
+    Without `endpoint`, every thread is sampled. With `endpoint`, only the threads
+    running work of the next `requests` requests to that path are sampled (see
+    ProfilingMiddleware and track_thread).
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        endpoint: Optional[str] = None,
+        requests: Optional[int] = None,
+    ):
+        self.interval = interval
+        self.endpoint = endpoint
+        self.remaining_requests = requests
+        self.in_flight = 0
+        self.samples: Counter[Tuple[str, ...]] = Counter()
+        self._lock = threading.Lock()
+        self._threads: Counter[int] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.started_at = time.time()
+        self.duration = 0.0
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.time() - self.started_at
+
+    @property
+    def done(self) -> bool:
+        """Whether the profiled requests have all finished"""
+        with self._lock:
+            return self.remaining_requests == 0 and self.in_flight == 0
+
+    def claim_request(self, path: str) -> bool:
+        """Whether to profile a request to `path`, counting it if so"""
+        with self._lock:
+            if self.endpoint is None or path != self.endpoint:
+                return False
+            if not self.remaining_requests:
+                return False
+            self.remaining_requests -= 1
+            self.in_flight += 1
+            return True
+
+    def finish_request(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def add_thread(self, ident: int) -> None:
+        with self._lock:
+            self._threads[ident] += 1
+
+    def remove_thread(self, ident: int) -> None:
+        with self._lock:
+            self._threads[ident] -= 1
+            if not self._threads[ident]:
+                del self._threads[ident]
+
+    def _sample(self) -> None:
+        own_ident = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with self._lock:
+            threads = set(self._threads) if self.endpoint is not None else None
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or (threads is not None and ident not in threads):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(format_frame(frame))
+                frame = frame.f_back
+            stack = stack[::-1][:MAX_STACK_DEPTH]
+            self.samples[(names.get(ident, str(ident)), *stack)] += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    async def wait(self, timeout: float) -> None:
+        """
+        Waits for `timeout` seconds, or until the profiled requests finish if the
+        profile is of an endpoint
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.endpoint is not None and self.done:
+                return
+            await asyncio.sleep(min(0.1, self.interval * 10))
+
+    def collapsed(self) -> str:
+        """
+        Stacks in the collapsed format of flamegraph.pl (also read by speedscope), one
+        line per stack with its frames separated by semicolons and its sample count,
+        rooted at the thread name
+        """
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in self.samples.items()
+        )
+
+    def speedscope(self) -> Dict[str, Any]:
+        """
+        Profile in the speedscope file format, one sampled profile per thread
+        (https://www.speedscope.app/file-format-schema.json)
+        """
+        frame_indices: Dict[str, int] = {}
+        profiles: Dict[str, Dict[str, Any]] = {}
+        for (thread_name, *stack), count in self.samples.items():
+            profile = profiles.setdefault(
+                thread_name,
+                {
+                    "type": "sampled",
+                    "name": thread_name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": 0,
+                    "samples": [],
+                    "weights": [],
+                },
+            )
+            profile["samples"].append(
+                [frame_indices.setdefault(frame, len(frame_indices)) for frame in stack]
+            )
+            profile["weights"].append(count * self.interval)
+            profile["endValue"] += count * self.interval
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "genpod llm_service",
+            "name": f"llm_service profile ({self.duration:.1f}s)",
+            "activeProfileIndex": 0,
+            "shared": {"frames": [{"name": frame} for frame in frame_indices]},
+            "profiles": list(profiles.values()),
+        }
+
+
+# The profile being taken, if any, and the profile of the request being served
+_active_profile: Optional[Profile] = None
+_active_profile_lock = threading.Lock()
+_request_profile: ContextVar[Optional[Profile]] = ContextVar(
+    "request_profile", default=None
+)
+
+
+def start_profile(
+    interval: float, endpoint: Optional[str] = None, requests: Optional[int] = None
+) -> Profile:
+    """Starts a profile, raising RuntimeError if another one is being taken"""
+    global _active_profile
+    with _active_profile_lock:
+        if _active_profile is not None:
+            raise RuntimeError("A profile is already being taken")
+        _active_profile = Profile(interval, endpoint, requests)
+        _active_profile.start()
+        return _active_profile
+
+
+def stop_profile(profile: Profile) -> None:
+    global _active_profile
+    profile.stop()
+    with _active_profile_lock:
+        if _active_profile is profile:
+            _active_profile = None
+
+
+@contextmanager
+def track_thread() -> Iterator[None]:
+    """
+    Makes the profile of the request the calling thread works for, if any, sample
+    the thread until the block exits
+    """
+    profile = _request_profile.get()
+    if profile is None:
+        yield
+        return
+    ident = threading.get_ident()
+    profile.add_thread(ident)
+    try:
+        yield
+    finally:
+        profile.remove_thread(ident)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware marking the requests an endpoint profile is waiting for, so that
+    the executor threads serving them are sampled
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        profile = _active_profile
+        if (
+            profile is None
+            or scope["type"] != "http"
+            or not profile.claim_request(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        token = _request_profile.set(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_profile.reset(token)
+            profile.finish_request()
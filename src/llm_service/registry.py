@@ -0,0 +1,233 @@
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain.llms.base import LLM
+
+from .llms import REPLICA_OPTIONS, load_llm
+from .utils import merge
+
+
+def _spec_key(spec: Dict[str, Any]) -> str:
+    return json.dumps(spec, sort_keys=True, default=str)
+
+
+def get_replica_cores(spec: Dict[str, Any]) -> List[Optional[List[int]]]:
+    """
+    CPU cores each replica of a model is pinned to (None for no pinning). `cpu_affinity`
+    is either a list of core lists, one per replica, or true to give every replica its
+    own block of `threads_per_replica` cores.
+    """
+    replicas = spec.get("replicas", 1)
+    affinity = spec.get("cpu_affinity")
+    if not affinity or not hasattr(os, "sched_setaffinity"):
+        return [None] * replicas
+    if isinstance(affinity, list):
+        if len(affinity) != replicas:
+            raise ValueError(
+                f"cpu_affinity of {spec['model']} lists {len(affinity)} core sets "
+                f"for {replicas} replicas"
+            )
+        return [list(cores) for cores in affinity]
+
+    available = sorted(os.sched_getaffinity(0))
+    per_replica = spec.get("threads_per_replica") or max(len(available) // replicas, 1)
+    return [
+        [available[(i * per_replica + j) % len(available)] for j in range(per_replica)]
+        for i in range(replicas)
+    ]
+
+
+class ReplicaPool:
+    """
+    Copies of one model, each used by one request at a time and optionally pinned to
+    its own CPU cores, so that concurrent requests do not compete for the same threads.
+
+    Args:
+        name: Model name
+        llms: The loaded replicas
+        cores: CPU cores of each replica, or None to leave its threads unpinned
+    """
+
+    def __init__(
+        self, name: str, llms: List[LLM], cores: List[Optional[List[int]]]
+    ) -> None:
+        self.name = name
+        self.size = len(llms)
+        self._idle: queue.Queue = queue.Queue()
+        for llm, replica_cores in zip(llms, cores):
+            self._idle.put((llm, replica_cores))
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.acquired = 0
+        self.total_wait_seconds = 0.0
+
+    @contextmanager
+    def acquire(self) -> Iterator[LLM]:
+        """
+        Waits for an idle replica. While it is in use, the calling thread (and the threads
+        the model starts from it) run on the replica's cores.
+        """
+        started = time.monotonic()
+        llm, cores = self._idle.get()
+        with self._lock:
+            self.busy += 1
+            self.acquired += 1
+            self.total_wait_seconds += time.monotonic() - started
+        previous_cores = None
+        if cores is not None:
+            previous_cores = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, cores)
+        try:
+            yield llm
+        finally:
+            if previous_cores is not None:
+                os.sched_setaffinity(0, previous_cores)
+            with self._lock:
+                self.busy -= 1
+            self._idle.put((llm, cores))
+
+    def wait_idle(self, poll_interval: float = 1.0) -> None:
+        """Waits for the requests using the replicas to finish"""
+        while self.busy:
+            time.sleep(poll_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "replicas": self.size,
+                "busy": self.busy,
+                "acquired": self.acquired,
+                "mean_wait_seconds": (
+                    self.total_wait_seconds / self.acquired if self.acquired else None
+                ),
+            }
+
+
+class LLMRegistry:
+    """
+    Keeps loaded LLMs resident in memory, so that requests reuse already loaded models
+    instead of loading them again. Each model is loaded as a pool of `replicas` copies.
+
+    Args:
+        config: The llm_service configuration
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self._pools: Dict[str, ReplicaPool] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def model_names(self) -> List[str]:
+        return [llm["model"] for llm in self.config["llms"]]
+
+    def get_spec(self, model: str) -> Dict[str, Any]:
+        for spec in self.config["llms"]:
+            if spec["model"] == model:
+                return spec
+        raise KeyError(model)
+
+    def get(self, model: str) -> ReplicaPool:
+        return self.load(self.get_spec(model))
+
+    @contextmanager
+    def acquire(self, model: str) -> Iterator[LLM]:
+        with self.get(model).acquire() as llm:
+            yield llm
+
+    def load(
+        self, spec: Dict[str, Any], download: Optional[bool] = None
+    ) -> ReplicaPool:
+        key = _spec_key(spec)
+        if key in self._pools:
+            return self._pools[key]
+
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            # another request may have loaded the model while we were waiting
+            if key not in self._pools:
+                self._pools[key] = self._load_pool(
+                    spec, self.config["download"] if download is None else download
+                )
+        return self._pools[key]
+
+    def _load_pool(self, spec: Dict[str, Any], download: bool) -> ReplicaPool:
+        replicas = spec.get("replicas", 1)
+        replica_spec = {
+            key: value for key, value in spec.items() if key not in REPLICA_OPTIONS
+        }
+        # only ctransformers threads are started per request and follow the pinning
+        ctransformers = spec["model_framework"] == "ctransformers"
+        cores = get_replica_cores(spec) if ctransformers else [None] * replicas
+
+        print(f"Loading model {spec['model']} ({replicas} replicas)")
+        llms = []
+        for replica_cores in cores:
+            # a pinned replica runs one thread per core it is pinned to
+            threads = (
+                len(replica_cores) if replica_cores else spec.get("threads_per_replica")
+            )
+            if ctransformers and threads:
+                llms.append(
+                    load_llm(
+                        merge(replica_spec, {"config": {"threads": threads}}),
+                        download=download,
+                    )
+                )
+            else:
+                llms.append(load_llm(replica_spec, download=download))
+        return ReplicaPool(spec["model"], llms, cores)
+
+    def prepare(self, config: Dict[str, Any]) -> None:
+        """
+        Loads the models of `config` that are not loaded yet, while the current
+        configuration keeps serving requests
+        """
+        for spec in [
+            *config["llms"],
+            *((config.get("rephrase") or {}).get("llms") or []),
+        ]:
+            self.load(spec, download=config["download"])
+
+    def switch(self, config: Dict[str, Any]) -> List[ReplicaPool]:
+        """
+        Routes requests by `config`, whose models must have been loaded by `prepare`.
+        Returns the pools of the models `config` no longer uses, for the caller to
+        unload once their in-flight requests finish.
+        """
+        keys = {
+            _spec_key(spec)
+            for spec in [
+                *config["llms"],
+                *((config.get("rephrase") or {}).get("llms") or []),
+            ]
+        }
+        self.config = config
+        removed = [pool for key, pool in self._pools.items() if key not in keys]
+        self._pools = {key: pool for key, pool in self._pools.items() if key in keys}
+        return removed
+
+    def pools(self) -> Dict[str, ReplicaPool]:
+        return {pool.name: pool for pool in self._pools.values()}
+
+    def rephrase_specs(self) -> List[Dict[str, Any]]:
+        return self.config.get("rephrase", {}).get("llms") or []
+
+    def rephrase_candidates(self, selected_model: str) -> Iterator[ReplicaPool]:
+        """
+        Yields the LLMs to try for query rephrasing: the dedicated rephrase models (in order of
+        the configured fallback chain) followed by the model selected for completion.
+        """
+        for spec in [*self.rephrase_specs(), self.get_spec(selected_model)]:
+            try:
+                pool = self.load(spec)
+            except Exception as e:
+                print(f"Failed to load rephrase model {spec['model']}: {e}")
+                continue
+            yield pool
@@ -0,0 +1,259 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from .cancellation import CancellationToken
+from .executors import MonitoredExecutor, get_executor
+from .tracing import span
+
+T = TypeVar("T")
+
+# Tenant of requests without a webid header
+ANONYMOUS_TENANT = "anonymous"
+
+
+class TenantLimitExceeded(Exception):
+    """
+    A tenant sent more requests than its rate or queue limit allows
+
+    Args:
+        detail: Which limit was exceeded
+        retry_after: Seconds after which the request may succeed
+    """
+
+    def __init__(self, detail: str, retry_after: int = 1):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def get_tenant_policy(config: Dict[str, Any], tenant: str) -> Dict[str, Any]:
+    scheduler_config = config.get("scheduler") or {}
+    return {
+        "weight": 1,
+        "max_concurrent": 2,
+        "max_queued": 20,
+        "rate_limit_per_minute": None,
+        **(scheduler_config.get("default_tenant") or {}),
+        **((scheduler_config.get("tenants") or {}).get(tenant) or {}),
+    }
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `per_minute` requests per minute, in bursts of up to as many
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> Optional[float]:
+        """Takes a token, or returns the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(
+            self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) * 60 / self.per_minute
+
+
+class _QueuedTask:
+    def __init__(self, tenant: str, tag: float, bulk: bool, future: asyncio.Future):
+        self.tenant = tenant
+        self.tag = tag
+        self.bulk = bulk
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class TenantStats:
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        started = self.completed + self.running
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+            "mean_wait_seconds": (
+                self.total_wait_seconds / started if started else None
+            ),
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+class FairScheduler:
+    """
+    Admits the work of one workload class to its executor with weighted fair queuing
+    across tenants (WebIDs): every task gets a virtual finish time advancing by
+    1 / weight of its tenant, and the queued task with the earliest one runs next.
+    Interactive tasks go before bulk ones, and bulk tasks never occupy all workers.
+
+    Must be used from the event loop.
+
+    Args:
+        config: The llm_service configuration
+        executor: Executor running the admitted tasks
+    """
+
+    def __init__(self, config: Dict[str, Any], executor: MonitoredExecutor):
+        self.config = config
+        self.executor = executor
+        self.capacity = executor.max_workers
+        bulk_share = (config.get("scheduler") or {}).get("max_bulk_workers")
+        self.max_bulk = bulk_share or max(self.capacity - 1, 1)
+        self._queue: List[_QueuedTask] = []
+        self._virtual_time = 0.0
+        self._last_tags: Dict[str, float] = defaultdict(float)
+        self._running = 0
+        self._running_bulk = 0
+        self._running_by_tenant: Dict[str, int] = defaultdict(int)
+        self.tenant_stats: Dict[str, TenantStats] = defaultdict(TenantStats)
+
+    def _eligible(self, task: _QueuedTask) -> bool:
+        policy = get_tenant_policy(self.config, task.tenant)
+        if self._running_by_tenant[task.tenant] >= policy["max_concurrent"]:
+            return False
+        return not task.bulk or self._running_bulk < self.max_bulk
+
+    def _dispatch(self) -> None:
+        while self._running < self.capacity:
+            eligible = [task for task in self._queue if self._eligible(task)]
+            if not eligible:
+                return
+            task = min(eligible, key=lambda task: (task.bulk, task.tag))
+            self._queue.remove(task)
+            self._virtual_time = max(self._virtual_time, task.tag)
+            self._running += 1
+            self._running_bulk += task.bulk
+            self._running_by_tenant[task.tenant] += 1
+            stats = self.tenant_stats[task.tenant]
+            stats.queued -= 1
+            stats.running += 1
+            wait = time.monotonic() - task.enqueued_at
+            stats.total_wait_seconds += wait
+            stats.max_wait_seconds = max(stats.max_wait_seconds, wait)
+            task.future.set_result(None)
+
+    def _release(self, task: _QueuedTask) -> None:
+        self._running -= 1
+        self._running_bulk -= task.bulk
+        self._running_by_tenant[task.tenant] -= 1
+        stats = self.tenant_stats[task.tenant]
+        stats.running -= 1
+        stats.completed += 1
+        self._dispatch()
+
+    async def run(
+        self,
+        tenant: Optional[str],
+        fn: Callable[..., T],
+        *args: Any,
+        bulk: bool = False,
+        cancellation: Optional[CancellationToken] = None,
+        **kwargs: Any,
+    ) -> T:
+        """
+        Queues `fn` for the tenant and runs it in the executor once admitted.
+        Raises TenantLimitExceeded if the tenant is over its rate or queue limit, and
+        RequestCancelled if `cancellation` is cancelled before the task is admitted.
+        """
+        if cancellation is not None:
+            cancellation.raise_if_cancelled()
+        tenant = tenant or ANONYMOUS_TENANT
+        policy = get_tenant_policy(self.config, tenant)
+        stats = self.tenant_stats[tenant]
+        if stats.queued >= policy["max_queued"]:
+            stats.rejected += 1
+            raise TenantLimitExceeded(f"Too many queued requests for {tenant}")
+        retry_after = check_rate_limit(self.config, tenant)
+        if retry_after is not None:
+            stats.rejected += 1
+            raise TenantLimitExceeded(
+                f"Rate limit exceeded for {tenant}", retry_after=int(retry_after) + 1
+            )
+
+        tag = max(self._virtual_time, self._last_tags[tenant]) + 1 / policy["weight"]
+        self._last_tags[tenant] = tag
+        task = _QueuedTask(
+            tenant, tag, bulk, asyncio.get_running_loop().create_future()
+        )
+        self._queue.append(task)
+        stats.queued += 1
+        if cancellation is not None:
+
+            def drop() -> None:
+                # the cancelled task leaves the queue without ever starting
+                if task in self._queue:
+                    self._queue.remove(task)
+                    stats.queued -= 1
+                    stats.cancelled += 1
+                    task.future.set_exception(cancellation.exception())
+
+            cancellation.add_callback(drop)
+        self._dispatch()
+        try:
+            with span("scheduler.queue", pool=self.executor.name, tenant=tenant):
+                await task.future
+        except asyncio.CancelledError:
+            if task in self._queue:
+                self._queue.remove(task)
+                stats.queued -= 1
+            else:
+                self._release(task)
+            raise
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release(task)
+            raise
+        # a cancelled caller stops waiting, but the slot stays taken until the thread
+        # is done with the work
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release, task)
+        )
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict[str, Any]:
+        return {tenant: stats.as_dict() for tenant, stats in self.tenant_stats.items()}
+
+
+# Rate limiters shared by the schedulers of this process, by tenant
+_rate_limiters: Dict[str, RateLimiter] = {}
+
+
+def check_rate_limit(config: Dict[str, Any], tenant: str) -> Optional[float]:
+    per_minute = get_tenant_policy(config, tenant)["rate_limit_per_minute"]
+    if not per_minute:
+        return None
+    limiter = _rate_limiters.get(tenant)
+    if limiter is None or limiter.per_minute != per_minute:
+        limiter = _rate_limiters[tenant] = RateLimiter(per_minute)
+    return limiter.try_acquire()
+
+
+# Schedulers of this process, by workload class
+schedulers: Dict[str, FairScheduler] = {}
+
+
+def get_scheduler(config: Dict[str, Any], name: str) -> FairScheduler:
+    if name not in schedulers:
+        schedulers[name] = FairScheduler(config, get_executor(config, name))
+    return schedulers[name]
@@ -0,0 +1,191 @@
+import gc
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+from typing import Any, Callable, Dict, List, Optional
+
+import uvicorn
+
+# Fields of /proc/<pid>/smaps_rollup reported by memory_report, in kB
+SMAPS_FIELDS = [
+    "Rss",
+    "Pss",
+    "Shared_Clean",
+    "Shared_Dirty",
+    "Private_Clean",
+    "Private_Dirty",
+]
+
+# pid of the serving parent process, in the workers forked by serve_forked
+_parent_pid: Optional[int] = None
+
+
+def get_parent_pid() -> Optional[int]:
+    """The serving parent process, or None if this process is not a forked worker"""
+    return _parent_pid
+
+
+def _get_state_directory(parent_pid: int) -> str:
+    return os.path.join(tempfile.gettempdir(), f"llm_service-{parent_pid}")
+
+
+def publish_worker_state(name: str, state: Dict[str, Any]) -> None:
+    """Shares a state of this worker with the other workers of its parent"""
+    directory = _get_state_directory(_parent_pid)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}-{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def get_worker_states(name: str) -> Dict[int, Optional[Dict[str, Any]]]:
+    """
+    The `name` states published by the running workers of this worker's parent, by
+    pid (None for workers that did not publish it)
+    """
+    states = {}
+    for pid in get_child_pids(_parent_pid):
+        try:
+            with open(
+                os.path.join(_get_state_directory(_parent_pid), f"{name}-{pid}.json")
+            ) as f:
+                states[pid] = json.load(f)
+        except (OSError, ValueError):
+            states[pid] = None
+    return states
+
+
+def serve_forked(
+    app: Any, host: str, port: int, workers: int, preload: Callable[[], None]
+) -> None:
+    """
+    Loads the models once with `preload`, then forks `workers` uvicorn servers accepting
+    connections on a shared socket. The workers share the loaded weights copy-on-write.
+    Workers that exit unexpectedly are replaced.
+    """
+    preload()
+
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # keep the garbage collector from writing to (and so un-sharing) the pages of
+    # objects created while loading the models
+    gc.freeze()
+
+    def spawn() -> int:
+        global _parent_pid
+        parent_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            _parent_pid = parent_pid
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if hasattr(signal, "SIGHUP"):
+                # until the worker installs its own configuration reload handler
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+            server.run(sockets=[sock])
+            os._exit(0)
+        return pid
+
+    children = {spawn() for _ in range(workers)}
+    print(f"Serving on {host}:{port} with {workers} workers (parent pid {os.getpid()})")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    if hasattr(signal, "SIGHUP"):
+        # every worker reloads the configuration itself
+        signal.signal(signal.SIGHUP, forward)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, starting a new one")
+            children.add(spawn())
+    sock.close()
+    shutil.rmtree(_get_state_directory(os.getpid()), ignore_errors=True)
+
+
+def get_child_pids(pid: int) -> List[int]:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may contain spaces, the fields after it do not
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def get_memory_usage(pid: int) -> Dict[str, int]:
+    """
+    Memory of a process in kB, from /proc/<pid>/smaps_rollup (Linux only).
+    Pss divides shared pages between the processes sharing them, and Private_* is what
+    the process would free when it exits.
+    """
+    usage = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in SMAPS_FIELDS:
+                usage[name] = int(value.split()[0])
+    usage["Private"] = usage.get("Private_Clean", 0) + usage.get("Private_Dirty", 0)
+    return usage
+
+
+def memory_report(pid: int) -> Dict[str, Any]:
+    """
+    Memory of a serving parent process and its workers. `per_worker_overhead_kb` is the
+    average private memory of a worker, i.e. the cost of every additional worker, while
+    `unshared_estimate_kb` is what the workers would use if each loaded its own models.
+    """
+    parent = get_memory_usage(pid)
+    workers = {child: get_memory_usage(child) for child in get_child_pids(pid)}
+    total_pss = parent["Pss"] + sum(usage["Pss"] for usage in workers.values())
+    report = {
+        "parent": parent,
+        "workers": workers,
+        "total_pss_kb": total_pss,
+    }
+    if workers:
+        report["per_worker_overhead_kb"] = sum(
+            usage["Private"] for usage in workers.values()
+        ) // len(workers)
+        report["unshared_estimate_kb"] = sum(usage["Rss"] for usage in workers.values())
+    return report
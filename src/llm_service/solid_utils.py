@@ -1,6 +1,9 @@
 from collections import deque
 from functools import cache
+import hashlib
+import io
 import os
+import tempfile
 from typing import Optional
 from urllib.parse import urlparse
 
@@ -11,6 +14,8 @@ import requests
 from dotenv import load_dotenv
 from solid_client_credentials import SolidClientCredentialsAuth, DpopTokenProvider
 
+from .tracing import span
+
 
 class ClientCredentials:
     def __init__(self, client_id: str, client_secret: str) -> None:
@@ -131,7 +136,6 @@ def register_retrieval_service() -> requests.Session:
 
 
 ldp_ns = Namespace("http://www.w3.org/ns/ldp#")
-session = register_retrieval_service()
 
 
 def as_header(cls):
@@ -160,60 +164,214 @@ class WebIdDPoPInfoHeader(BaseModel):
 
 
 def discover_document_uris(base_uri: str) -> list[str]:
+    return crawl(base_uri)[0]
+
+
+def crawl(base_uri: str) -> tuple[list[str], list[str]]:
+    """
+    The documents and the containers found under `base_uri`
+    """
     found_uris = []
+    containers = []
+
+    with span("solid.crawl", base_uri=base_uri) as crawl_span:
+        worklist = deque([base_uri])
+        while len(worklist):
+            uri = worklist.popleft()
+            res = register_retrieval_service().head(
+                uri,
+                allow_redirects=True,
+            )
 
-    worklist = deque([base_uri])
-    while len(worklist):
-        uri = worklist.popleft()
-        res = session.head(
-            uri,
-            allow_redirects=True,
-        )
+            if res.headers.get("Content-Type", None) != "text/turtle":
+                # not an RDF resource, so don't look inside
+                found_uris.append(uri)
+                continue
+
+            if ldp_ns.BasicContainer.n3() not in res.headers.get("Link", ""):
+                # not a Solid container, so don't look inside
+                found_uris.append(uri)
+                continue
+
+            # otherwise it is a container, so explore all included resources
+            containers.append(uri)
+            content = Graph()
+            content.bind("ldp", ldp_ns)
+            res = register_retrieval_service().get(
+                uri,
+                headers={
+                    "Content-Type": "text/turtle",
+                },
+            )
+            content.parse(data=res.text, publicID=uri)
+            # plain strings, as URIRefs never compare equal to the indexed URIs
+            worklist.extend(
+                str(member)
+                for member in content.objects(URIRef(uri), ldp_ns.contains, unique=True)
+            )
+        if crawl_span is not None:
+            crawl_span.set_attribute("resources", len(found_uris))
 
-        if res.headers.get("Content-Type", None) != "text/turtle":
-            # not an RDF resource, so don't look inside
-            found_uris.append(uri)
-            continue
-
-        if ldp_ns.BasicContainer.n3() not in res.headers.get("Link", ""):
-            # not a Solid container, so don't look inside
-            found_uris.append(uri)
-            continue
-
-        # otherwise it is a container, so explore all included resources
-        content = Graph()
-        content.bind("ldp", ldp_ns)
-        res = session.get(
-            uri,
-            headers={
-                "Content-Type": "text/turtle",
-            },
-        )
-        content.parse(data=res.text, publicID=uri)
-        worklist.extend(content.objects(URIRef(uri), ldp_ns.contains, unique=True))
+    return found_uris, containers
 
-    return found_uris
 
+notify_ns = Namespace("http://www.w3.org/ns/solid/notifications#")
+STORAGE_DESCRIPTION_REL = "http://www.w3.org/ns/solid/terms#storageDescription"
 
-def get_item_name(url: str) -> str:
-    if url[-1] == "/":
-        url = url[:-1]
 
-    if url.count("/") == 2:  # is base url, no item name
-        return "index.ttl"
+def find_subscription_services(uri: str) -> dict[str, str]:
+    """
+    Subscription services of the storage holding `uri` (from its storage
+    description), by the name of their channel type, e.g. WebSocketChannel2023
+    """
+    res = register_retrieval_service().head(uri, allow_redirects=True)
+    res.raise_for_status()
+    description_link = res.links.get(STORAGE_DESCRIPTION_REL)
+    if description_link is None:
+        return {}
+
+    res = register_retrieval_service().get(
+        description_link["url"], headers={"Accept": "text/turtle"}
+    )
+    res.raise_for_status()
+    description = Graph()
+    description.parse(data=res.text, format="turtle", publicID=res.url)
+    return {
+        str(channel_type).removeprefix(str(notify_ns)): str(service)
+        for service in description.objects(None, notify_ns.subscription)
+        for channel_type in description.objects(service, notify_ns.channelType)
+    }
+
+
+def subscribe(
+    subscription_service: str,
+    channel_type: str,
+    topic: str,
+    send_to: Optional[str] = None,
+) -> dict:
+    """
+    Opens a notification channel on `topic`, returning its description (with the
+    channel `id`, and `receiveFrom` for WebSocket channels)
+    """
+    channel = {
+        "@context": ["https://www.w3.org/ns/solid/notification/v1"],
+        "type": channel_type,
+        "topic": topic,
+    }
+    if send_to is not None:
+        channel["sendTo"] = send_to
+    res = register_retrieval_service().post(
+        subscription_service,
+        json=channel,
+        headers={
+            "Content-Type": "application/ld+json",
+            "Accept": "application/ld+json",
+        },
+    )
+    res.raise_for_status()
+    return res.json()
+
+
+def unsubscribe(channel_id: str) -> None:
+    register_retrieval_service().delete(channel_id)
+
+
+# Extensions for resources whose URI does not have one, by Content-Type
+CONTENT_TYPE_EXTENSIONS = {
+    "application/epub+zip": ".epub",
+    "application/msword": ".doc",
+    "application/pdf": ".pdf",
+    "application/vnd.ms-powerpoint": ".ppt",
+    "application/vnd.oasis.opendocument.text": ".odt",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+    "message/rfc822": ".eml",
+    "text/csv": ".csv",
+    "text/html": ".html",
+    "text/markdown": ".md",
+    "text/plain": ".txt",
+    "text/turtle": ".ttl",
+}
 
-    i = url.rindex("/")
-    return url[i + 1 :]
 
+def get_extension(uri: str, content_type: Optional[str]) -> Optional[str]:
+    name = urlparse(uri).path.rstrip("/").rsplit("/", 1)[-1]
+    if "." in name:
+        return "." + name.rsplit(".", 1)[-1].lower()
+    return CONTENT_TYPE_EXTENSIONS.get(content_type)
 
-def download_resource(uri: str, save_dir: str):
-    res = session.get(uri, stream=True)
-    filename = get_item_name(uri)
 
-    with open(os.path.join(save_dir, filename), mode="wb") as f:
-        for chunk in res.iter_content(chunk_size=2048):
-            if chunk:
-                f.write(chunk)
+class DownloadedResource:
+    """
+    Body of a pod resource, kept in memory unless it was larger than the spill
+    threshold, in which case it was streamed to a temporary file at `path`
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        content_type: Optional[str],
+        content_hash: str,
+        content: Optional[bytes] = None,
+        path: Optional[str] = None,
+    ) -> None:
+        self.uri = uri
+        self.content_type = content_type
+        self.content_hash = content_hash
+        self.content = content
+        self.path = path
+
+
+def download_resource(uri: str, spill_threshold: int) -> DownloadedResource:
+    with span("solid.download", uri=uri) as download_span:
+        resource = _download_resource(uri, spill_threshold)
+        if download_span is not None:
+            download_span.set_attribute("spilled", resource.path is not None)
+        return resource
+
+
+def _download_resource(uri: str, spill_threshold: int) -> DownloadedResource:
+    res = register_retrieval_service().get(uri, stream=True)
+    res.raise_for_status()
+    content_type = res.headers.get("Content-Type")
+    if content_type is not None:
+        content_type = content_type.split(";", 1)[0].strip()
+
+    sha256 = hashlib.sha256()
+    buffer = io.BytesIO()
+    spill_file = None
+    try:
+        for chunk in res.iter_content(chunk_size=1 << 16):
+            if not chunk:
+                continue
+            sha256.update(chunk)
+            if spill_file is None and buffer.tell() + len(chunk) > spill_threshold:
+                # keep the extension, for loaders that go by the file name
+                spill_file = tempfile.NamedTemporaryFile(
+                    prefix="genpod-",
+                    suffix=get_extension(uri, content_type),
+                    delete=False,
+                )
+                spill_file.write(buffer.getvalue())
+                buffer = None
+            if spill_file is not None:
+                spill_file.write(chunk)
+            else:
+                buffer.write(chunk)
+    except BaseException:
+        if spill_file is not None:
+            spill_file.close()
+            os.remove(spill_file.name)
+        raise
+
+    if spill_file is not None:
+        spill_file.close()
+        return DownloadedResource(
+            uri, content_type, sha256.hexdigest(), path=spill_file.name
+        )
+    return DownloadedResource(
+        uri, content_type, sha256.hexdigest(), content=buffer.getvalue()
+    )
 
 
 def webid_to_filepath(webid: str) -> str:
@@ -225,5 +383,5 @@ def webid_to_filepath(webid: str) -> str:
 
 
 def check_uri_access(uri: str) -> bool:
-    res = session.get(uri)
+    res = register_retrieval_service().get(uri)
     return res.ok
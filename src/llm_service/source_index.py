@@ -0,0 +1,365 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+SOURCE_INDEX_FILENAME = "sources.sqlite3"
+
+
+class SourceIndex:
+    """
+    Per-WebID table of the ingested sources (by pod URI), their content hashes and the
+    ids of their chunks in the vector store, so that deciding what to skip or delete
+    does not need to read the vector store. Also keeps the centroid of every source's
+    chunk embeddings, for shortlisting documents before searching their chunks.
+
+    Ingestion jobs are journaled here too: the outcome of every resource of a job is
+    recorded as its checkpoint is committed, so that an interrupted job can be found
+    and resumed, and resources that failed to load are quarantined with their error.
+
+    Args:
+        persist_directory: Directory of the WebID's vector store
+    """
+
+    def __init__(self, persist_directory: str):
+        os.makedirs(persist_directory, exist_ok=True)
+        self.connection = sqlite3.connect(
+            os.path.join(persist_directory, SOURCE_INDEX_FILENAME),
+            isolation_level=None,
+        )
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                ingested_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                chunk_id TEXT NOT NULL,
+                source TEXT NOT NULL,
+                PRIMARY KEY (chunk_id, source)
+            );
+            CREATE INDEX IF NOT EXISTS chunks_by_source ON chunks (source);
+            CREATE TABLE IF NOT EXISTS centroids (
+                source TEXT PRIMARY KEY,
+                vector BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                webid TEXT NOT NULL,
+                docs_location TEXT NOT NULL,
+                state TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                instance TEXT,
+                resources INTEGER NOT NULL,
+                started_at TEXT NOT NULL,
+                finished_at TEXT,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS journal (
+                job_id INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (job_id, source)
+            );
+            CREATE TABLE IF NOT EXISTS quarantine (
+                source TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                error TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                failed_at TEXT NOT NULL
+            );
+            """
+        )
+        # journals written before jobs recorded the instance of their process
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")]
+        if "instance" not in columns:
+            self.connection.execute("ALTER TABLE jobs ADD COLUMN instance TEXT")
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "SourceIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Groups updates, so that they are only committed if the vector store writes
+        inside the block succeed
+        """
+        self.connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def get_hashes(self) -> Dict[str, str]:
+        return dict(self.connection.execute("SELECT source, content_hash FROM sources"))
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+
+    def count_chunks(self) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(DISTINCT chunk_id) FROM chunks"
+        ).fetchone()[0]
+
+    def get_chunk_ids(self, source: str) -> List[str]:
+        return [
+            chunk_id
+            for (chunk_id,) in self.connection.execute(
+                "SELECT chunk_id FROM chunks WHERE source = ?", (source,)
+            )
+        ]
+
+    def get_sources(self, chunk_id: str) -> List[str]:
+        """The sources a (deduplicated) chunk stands for"""
+        return [
+            source
+            for (source,) in self.connection.execute(
+                "SELECT source FROM chunks WHERE chunk_id = ?", (chunk_id,)
+            )
+        ]
+
+    def record(self, source: str, content_hash: str, chunk_ids: List[str]) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+            (source, content_hash, datetime.now(timezone.utc).isoformat()),
+        )
+        self.connection.execute("DELETE FROM chunks WHERE source = ?", (source,))
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO chunks VALUES (?, ?)",
+            [(chunk_id, source) for chunk_id in chunk_ids],
+        )
+
+    def set_centroid(self, source: str, centroid: np.ndarray) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO centroids VALUES (?, ?)",
+            (source, np.asarray(centroid, dtype=np.float32).tobytes()),
+        )
+
+    def get_centroids(self) -> Tuple[List[str], np.ndarray]:
+        """
+        The sources with a centroid and their centroids, one row per source
+        """
+        rows = self.connection.execute(
+            "SELECT source, vector FROM centroids"
+        ).fetchall()
+        if not rows:
+            return [], np.empty((0, 0), dtype=np.float32)
+        return [source for source, _ in rows], np.stack(
+            [np.frombuffer(vector, dtype=np.float32) for _, vector in rows]
+        )
+
+    def get_sources_without_centroid(self) -> List[str]:
+        return [
+            source
+            for (source,) in self.connection.execute(
+                "SELECT source FROM sources WHERE source NOT IN "
+                "(SELECT source FROM centroids)"
+            )
+        ]
+
+    def remove(self, source: str) -> List[str]:
+        """
+        Forgets a source. Returns the ids of its chunks that no other source refers to,
+        which should be deleted from the vector store.
+        """
+        chunk_ids = self.get_chunk_ids(source)
+        self.connection.execute("DELETE FROM sources WHERE source = ?", (source,))
+        self.connection.execute("DELETE FROM chunks WHERE source = ?", (source,))
+        self.connection.execute("DELETE FROM centroids WHERE source = ?", (source,))
+        return [
+            chunk_id
+            for chunk_id in chunk_ids
+            if self.connection.execute(
+                "SELECT 1 FROM chunks WHERE chunk_id = ?", (chunk_id,)
+            ).fetchone()
+            is None
+        ]
+
+    def start_job(self, webid: str, docs_location: str, resources: int) -> int:
+        """
+        Journals a new ingestion job, which supersedes any unfinished one
+        """
+        self.connection.execute(
+            "UPDATE jobs SET state = 'interrupted' "
+            "WHERE state IN ('running', 'resuming')"
+        )
+        return self.connection.execute(
+            "INSERT INTO jobs (webid, docs_location, state, pid, instance, "
+            "resources, started_at) VALUES (?, ?, 'running', ?, ?, ?, ?)",
+            (
+                webid,
+                docs_location,
+                os.getpid(),
+                _get_instance(os.getpid()),
+                resources,
+                _now(),
+            ),
+        ).lastrowid
+
+    def finish_job(self, job_id: int, state: str, error: Optional[str] = None) -> None:
+        self.connection.execute(
+            "UPDATE jobs SET state = ?, finished_at = ?, error = ? WHERE job_id = ?",
+            (state, _now(), error, job_id),
+        )
+
+    def log(
+        self, job_id: int, source: str, status: str, error: Optional[str] = None
+    ) -> None:
+        """Records the outcome of a resource of a job"""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)",
+            (job_id, source, status, error, _now()),
+        )
+
+    def get_jobs(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """The latest jobs, with how many of their resources ended in every status"""
+        jobs = []
+        for row in self.connection.execute(
+            "SELECT job_id, webid, docs_location, state, resources, started_at, "
+            "finished_at, error FROM jobs ORDER BY job_id DESC LIMIT ?",
+            (limit,),
+        ).fetchall():
+            job = dict(
+                zip(
+                    [
+                        "job_id",
+                        "webid",
+                        "docs_location",
+                        "state",
+                        "resources",
+                        "started_at",
+                        "finished_at",
+                        "error",
+                    ],
+                    row,
+                )
+            )
+            job["statuses"] = dict(
+                self.connection.execute(
+                    "SELECT status, COUNT(*) FROM journal WHERE job_id = ? "
+                    "GROUP BY status",
+                    (job["job_id"],),
+                )
+            )
+            jobs.append(job)
+        return jobs
+
+    def get_interrupted_jobs(self) -> List[Tuple[int, str, str]]:
+        """
+        Jobs still marked as running whose process stopped before they finished, as
+        (job id, WebID, docs location)
+        """
+        return [
+            (job_id, webid, docs_location)
+            for job_id, webid, docs_location, pid, instance in self.connection.execute(
+                "SELECT job_id, webid, docs_location, pid, instance FROM jobs "
+                "WHERE state = 'running'"
+            ).fetchall()
+            if not _is_running(pid, instance)
+        ]
+
+    def get_location(self) -> Optional[Tuple[str, str]]:
+        """The WebID and docs location of the latest job, if any"""
+        return self.connection.execute(
+            "SELECT webid, docs_location FROM jobs ORDER BY job_id DESC LIMIT 1"
+        ).fetchone()
+
+    def claim_job(self, job_id: int) -> bool:
+        """
+        Marks an interrupted job as being resumed, unless another process already did
+        """
+        return (
+            self.connection.execute(
+                "UPDATE jobs SET state = 'resuming' "
+                "WHERE job_id = ? AND state = 'running'",
+                (job_id,),
+            ).rowcount
+            == 1
+        )
+
+    def quarantine(self, source: str, content_hash: str, error: str) -> None:
+        self.connection.execute(
+            "INSERT INTO quarantine VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT (source) DO UPDATE SET content_hash = excluded.content_hash, "
+            "error = excluded.error, attempts = attempts + 1, "
+            "failed_at = excluded.failed_at",
+            (source, content_hash, error, _now()),
+        )
+
+    def get_quarantined(self) -> Dict[str, str]:
+        """The content hashes of the quarantined sources"""
+        return dict(
+            self.connection.execute("SELECT source, content_hash FROM quarantine")
+        )
+
+    def get_quarantine(self) -> List[Dict[str, Any]]:
+        return [
+            dict(zip(["source", "content_hash", "error", "attempts", "failed_at"], row))
+            for row in self.connection.execute(
+                "SELECT source, content_hash, error, attempts, failed_at "
+                "FROM quarantine ORDER BY source"
+            )
+        ]
+
+    def release(self, source: str) -> None:
+        """Takes a source out of quarantine"""
+        self.connection.execute("DELETE FROM quarantine WHERE source = ?", (source,))
+
+
+def find_source_indexes(root: str) -> List[str]:
+    """Directories under `root` holding a source index"""
+    return [
+        directory
+        for directory, _, filenames in os.walk(root)
+        if SOURCE_INDEX_FILENAME in filenames
+    ]
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _get_instance(pid: int) -> Optional[str]:
+    """
+    Tells a process apart from later ones reusing its pid: the boot and the start time
+    of the process (Linux only, None elsewhere)
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name may contain spaces, the fields after it do not
+            start_time = f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+    return f"{boot_id}:{start_time}"
+
+
+def _is_running(pid: int, instance: Optional[str] = None) -> bool:
+    if instance is not None:
+        # the pid may have been reused since, by this process too
+        return _get_instance(pid) == instance
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. owned by another user
+        return True
+    return True
@@ -0,0 +1,201 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional
+
+SERVICE_NAME = "llm_service"
+
+# https://www.w3.org/TR/trace-context/#traceparent-header
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# Returned by span() while tracing is off, so that disabled spans cost one check
+_DISABLED_SPAN = nullcontext()
+
+
+class Span:
+    """
+    A timed operation of a trace. Spans started while another span is current become
+    its children, also across threads of the executors and, through the traceparent
+    header, across services. The chat app traces its requests with these spans too.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = "ok"
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def end(self) -> None:
+        self.duration_ms = (time.perf_counter() - self._started) * 1000
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "service": _service_name,
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class RemoteSpan:
+    """Parent span of another service, read from a traceparent header"""
+
+    def __init__(self, trace_id: str, span_id: str):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+_current_span: ContextVar[Optional[Any]] = ContextVar("current_span", default=None)
+_export: Optional[Callable[[Span], None]] = None
+_service_name = SERVICE_NAME
+
+
+def console_exporter() -> Callable[[Span], None]:
+    def export(span: Span) -> None:
+        attributes = " ".join(
+            f"{key}={value}" for key, value in span.attributes.items()
+        )
+        print(
+            f"[trace {span.trace_id[:8]}] {span.name} {span.duration_ms:.1f}ms "
+            f"{span.status} {attributes}"
+        )
+
+    return export
+
+
+def jsonl_exporter(path: str) -> Callable[[Span], None]:
+    lock = threading.Lock()
+
+    def export(span: Span) -> None:
+        line = json.dumps(span.as_dict(), default=str)
+        with lock, open(path, "a") as f:
+            f.write(line + "\n")
+
+    return export
+
+
+def configure_tracing(config: Dict[str, Any], service_name: str = SERVICE_NAME) -> None:
+    """
+    Exports spans as configured under `tracing`: to the console, to a JSON lines file,
+    or nowhere (the default), in which case tracing is off. Exported spans are
+    attributed to `service_name`.
+    """
+    global _export, _service_name
+    _service_name = service_name
+    options = config.get("tracing") or {}
+    exporter = options.get("exporter")
+    if not exporter:
+        _export = None
+    elif exporter == "console":
+        _export = console_exporter()
+    elif exporter == "jsonl":
+        _export = jsonl_exporter(options.get("path") or "traces.jsonl")
+    else:
+        raise ValueError(f"Unsupported tracing exporter: {exporter}")
+
+
+@contextmanager
+def _span(name: str, attributes: Dict[str, Any]) -> Iterator[Span]:
+    parent = _current_span.get()
+    span = Span(
+        name,
+        trace_id=parent.trace_id if parent is not None else os.urandom(16).hex(),
+        parent_id=parent.span_id if parent is not None else None,
+        attributes=attributes,
+    )
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "error"
+        span.attributes["error"] = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+        export = _export
+        if export is not None:
+            export(span)
+
+
+def span(name: str, **attributes: Any):
+    """
+    Context manager timing `name` as a child of the current span. Yields the span, or
+    None while tracing is off.
+    """
+    if _export is None:
+        return _DISABLED_SPAN
+    return _span(name, attributes)
+
+
+@contextmanager
+def remote_parent(traceparent: Optional[str]) -> Iterator[None]:
+    """
+    Makes spans started inside children of the span of another service, given by its
+    traceparent header
+    """
+    match = TRACEPARENT_PATTERN.match(traceparent or "")
+    if match is None:
+        yield
+        return
+    token = _current_span.set(RemoteSpan(match.group(1), match.group(2)))
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware tracing every HTTP request, continuing the trace of the caller if
+    the request has a traceparent header
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _export is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        traceparent = headers.get(b"traceparent", b"").decode("latin-1")
+        with remote_parent(traceparent):
+            with span(
+                f"{scope['method']} {scope['path']}",
+                webid=headers.get(b"webid", b"").decode("latin-1") or None,
+            ) as request_span:
+
+                async def send_with_status(message):
+                    if message["type"] == "http.response.start":
+                        request_span.set_attribute("status_code", message["status"])
+                    await send(message)
+
+                await self.app(scope, receive, send_with_status)
@@ -0,0 +1,965 @@
+import glob
+import itertools
+import json
+import os
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import chromadb
+import numpy as np
+from chromadb.config import Settings
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.chroma import Chroma
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.vectorstores import VectorStore
+
+from .manifest import get_configured_manifest, read_manifest, write_manifest
+from .source_index import SOURCE_INDEX_FILENAME, SourceIndex
+
+# (id, document, embedding) of a stored chunk
+StoredChunk = Tuple[str, Document, Optional[List[float]]]
+
+
+def _matches_filter(metadata: Dict[str, Any], filter: Any) -> bool:
+    """
+    Supports callables and Chroma-style `{key: value}` / `{key: {"$in": [...]}}` filters
+    """
+    if filter is None:
+        return True
+    if callable(filter):
+        return filter(metadata)
+    for key, condition in filter.items():
+        if isinstance(condition, dict) and "$in" in condition:
+            if metadata.get(key) not in condition["$in"]:
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def get_int8_scale(normalized: np.ndarray) -> np.ndarray:
+    """Per-dimension scales mapping the range of normalized vectors to [-127, 127]"""
+    return (np.maximum(np.abs(normalized).max(axis=0), 1e-12) / 127).astype(np.float32)
+
+
+def quantize_vectors(
+    vectors: np.ndarray, precision: str, scale: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Normalizes vectors and stores them as float32, float16 or int8 (symmetric per-dimension
+    scalar quantization). Returns the compact vectors and, for int8, the per-dimension scales,
+    which are derived from the vectors unless given.
+    """
+    normalized = normalize_vectors(vectors)
+    if precision == "float32":
+        return normalized, None
+    if precision == "float16":
+        return normalized.astype(np.float16), None
+    if precision == "int8":
+        if scale is None:
+            scale = get_int8_scale(normalized)
+        quantized = np.clip(np.round(normalized / scale), -127, 127).astype(np.int8)
+        return quantized, scale
+    raise ValueError(f"Unsupported vector precision: {precision}")
+
+
+def dequantize_vectors(compact: np.ndarray, scale: Optional[np.ndarray]) -> np.ndarray:
+    vectors = np.asarray(compact, dtype=np.float32)
+    return vectors * scale if scale is not None else vectors
+
+
+def approximate_similarities(
+    compact: np.ndarray,
+    scale: Optional[np.ndarray],
+    query: np.ndarray,
+    block_size: int = 65536,
+) -> np.ndarray:
+    """
+    Cosine similarities between a query and quantized vectors, converting one block of
+    vectors at a time to float32 to keep the memory overhead bounded
+    """
+    query = query / max(np.linalg.norm(query), 1e-12)
+    if scale is not None:
+        # (v * scale) . q == v . (q * scale)
+        query = query * scale
+    similarities = np.empty(len(compact), dtype=np.float32)
+    for start in range(0, len(compact), block_size):
+        block = np.asarray(compact[start : start + block_size], dtype=np.float32)
+        similarities[start : start + block_size] = block @ query
+    return similarities
+
+
+def exact_similarities(vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return (vectors @ query) / (
+        np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12
+    )
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Brute-force cosine similarity search over memory-mapped NumPy arrays.
+    Suited for small tenants, where building an approximate index does not pay off.
+
+    With a reduced `precision` (float16 or int8), only the compact vectors are stored,
+    which cuts their size by 2 or 4. With `keep_full_precision`, the float32 vectors are
+    kept on disk as well, to re-score the best `rescore_factor * k` candidates exactly:
+    searches still only scan the compact vectors, but the store takes more disk space.
+
+    Args:
+        embedding: Embeddings used for queries and for `add_texts`
+        persist_directory: Directory with the vectors and `documents.json`
+        precision: float32, float16 or int8
+        rescore_factor: How many candidates per result to re-score exactly
+        keep_full_precision: Whether to keep the float32 vectors on disk
+    """
+
+    VECTORS_FILENAME = "vectors.npy"
+    COMPACT_VECTORS_FILENAME = "vectors.{precision}.npy"
+    SCALES_FILENAME = "scales.npy"
+    DOCUMENTS_FILENAME = "documents.json"
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        persist_directory: str,
+        precision: str = "float32",
+        rescore_factor: int = 4,
+        keep_full_precision: bool = False,
+    ):
+        self._embedding = embedding
+        self.persist_directory = persist_directory
+        self.precision = precision
+        self.rescore_factor = rescore_factor
+        self.keep_full_precision = keep_full_precision
+        self._vectors: Optional[np.ndarray] = None
+        self._compact: Optional[np.ndarray] = None
+        self._scale: Optional[np.ndarray] = None
+        self._ids: List[str] = []
+        self._documents: List[Document] = []
+
+        documents_path = os.path.join(persist_directory, self.DOCUMENTS_FILENAME)
+        if os.path.exists(documents_path):
+            with open(documents_path) as f:
+                for entry in json.load(f):
+                    self._ids.append(entry["id"])
+                    self._documents.append(
+                        Document(page_content=entry["text"], metadata=entry["metadata"])
+                    )
+            self._load_vectors()
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.persist_directory, filename)
+
+    def _load_vectors(self) -> None:
+        self._vectors = self._compact = self._scale = None
+        if os.path.exists(self._path(self.VECTORS_FILENAME)):
+            self._vectors = np.load(self._path(self.VECTORS_FILENAME), mmap_mode="r")
+        if self.precision == "float32":
+            return
+        compact_path = self._path(
+            self.COMPACT_VECTORS_FILENAME.format(precision=self.precision)
+        )
+        if os.path.exists(compact_path):
+            self._compact = np.load(compact_path, mmap_mode="r")
+            if os.path.exists(self._path(self.SCALES_FILENAME)):
+                self._scale = np.load(self._path(self.SCALES_FILENAME))
+
+    def _ensure_compact(self) -> None:
+        if self._compact is None and self._vectors is not None:
+            self._compact, self._scale = quantize_vectors(
+                np.asarray(self._vectors, dtype=np.float32), self.precision
+            )
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def full_precision(self) -> bool:
+        """Whether the exact float32 vectors are available"""
+        return self.precision == "float32" or self._vectors is not None
+
+    def _keeps_compact_only(self) -> bool:
+        return self.precision != "float32" and not self.keep_full_precision
+
+    def _append_compact(self, vectors: np.ndarray) -> None:
+        """
+        Quantizes only the new vectors, so that the stored ones are not quantized again
+        on every ingestion. Existing int8 dimensions are only re-rounded when the new
+        vectors exceed their range.
+        """
+        self._ensure_compact()
+        self._vectors = None
+        if self._compact is None or not len(self._compact):
+            self._compact, self._scale = quantize_vectors(vectors, self.precision)
+            return
+        compact = np.asarray(self._compact)
+        scale = self._scale
+        if scale is not None:
+            needed = get_int8_scale(normalize_vectors(vectors))
+            # values within half a step of the range are clipped instead
+            changed = needed > scale * 127.5 / 127
+            grown = np.where(changed, needed, scale)
+            if changed.any():
+                compact = compact.copy()
+                compact[:, changed] = np.round(
+                    compact[:, changed] * (scale[changed] / grown[changed])
+                ).astype(np.int8)
+            scale = grown
+        new_compact, _ = quantize_vectors(vectors, self.precision, scale)
+        self._compact = np.concatenate([compact, new_compact])
+        self._scale = scale
+
+    def get_vectors(self) -> np.ndarray:
+        if self._vectors is not None:
+            return np.asarray(self._vectors, dtype=np.float32)
+        if self._compact is not None:
+            return dequantize_vectors(self._compact, self._scale)
+        return np.empty((0, 0), dtype=np.float32)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        vectors: List[List[float]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        new_vectors = np.asarray(vectors, dtype=np.float32)
+        if self._keeps_compact_only():
+            self._append_compact(new_vectors)
+        else:
+            self._vectors = (
+                np.concatenate([self.get_vectors(), new_vectors])
+                if len(self._ids)
+                else new_vectors
+            )
+            self._compact = self._scale = None
+        self._ids.extend(ids)
+        self._documents.extend(
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(texts, metadatas)
+        )
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(
+            texts, self._embedding.embed_documents(texts), metadatas, ids
+        )
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids or not len(self._ids):
+            return False
+        ids = set(ids)
+        keep = [i for i, id in enumerate(self._ids) if id not in ids]
+        if self._keeps_compact_only():
+            # keep the quantized rows as they are
+            self._ensure_compact()
+            self._vectors = None
+            self._compact = np.asarray(self._compact)[keep]
+        else:
+            self._vectors = self.get_vectors()[keep]
+            self._compact = self._scale = None
+        self._ids = [self._ids[i] for i in keep]
+        self._documents = [self._documents[i] for i in keep]
+        return True
+
+    def iter_chunks(self, include_vectors: bool = True) -> Iterator[StoredChunk]:
+        vectors = self.get_vectors() if include_vectors else None
+        for i, (id, document) in enumerate(zip(self._ids, self._documents)):
+            yield id, document, vectors[i].tolist() if include_vectors else None
+
+    def _get_rows(self, rows: List[int]) -> np.ndarray:
+        if self._vectors is not None:
+            return np.asarray(self._vectors[rows], dtype=np.float32)
+        self._ensure_compact()
+        return dequantize_vectors(self._compact[rows], self._scale)
+
+    def get_chunks(self, ids: List[str]) -> List[StoredChunk]:
+        wanted = set(ids)
+        # read only the requested rows, in file order
+        rows = [i for i, id in enumerate(self._ids) if id in wanted]
+        if not rows:
+            return []
+        vectors = self._get_rows(rows)
+        return [
+            (self._ids[i], self._documents[i], vector.tolist())
+            for i, vector in zip(rows, vectors)
+        ]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, filter: Any = None
+    ) -> List[Tuple[Document, float]]:
+        return [
+            # report cosine distances, like the other backends report distances
+            (self._documents[i], 1 - similarity)
+            for i, similarity in self._search(embedding, k, filter)
+        ]
+
+    def _search(
+        self, embedding: List[float], k: int, filter: Any
+    ) -> List[Tuple[int, float]]:
+        """
+        Rows of the `k` chunks most similar to the query, with their similarities
+        """
+        if not len(self._ids):
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+
+        if self.precision == "float32":
+            similarities = exact_similarities(self._vectors, query)
+            candidates = np.argsort(-similarities)
+        else:
+            self._ensure_compact()
+            approximate = approximate_similarities(self._compact, self._scale, query)
+            candidates = np.argsort(-approximate)
+            similarities = approximate
+            if self._vectors is not None and self.rescore_factor:
+                shortlist = list(
+                    itertools.islice(
+                        (
+                            i
+                            for i in candidates
+                            if _matches_filter(self._documents[i].metadata, filter)
+                        ),
+                        k * self.rescore_factor,
+                    )
+                )
+                if not shortlist:
+                    return []
+                # read the full precision rows in file order
+                rows = np.sort(shortlist)
+                similarities = dict(
+                    zip(rows, exact_similarities(self._vectors[rows], query))
+                )
+                candidates = sorted(shortlist, key=lambda i: -similarities[i])
+
+        results = []
+        for i in candidates:
+            if _matches_filter(self._documents[i].metadata, filter):
+                results.append((int(i), float(similarities[i])))
+                if len(results) == k:
+                    break
+        return results
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Any = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        rows = [i for i, _ in self._search(embedding, fetch_k, filter)]
+        if not rows:
+            return []
+        selected = maximal_marginal_relevance(
+            np.asarray(embedding, dtype=np.float32),
+            self._get_rows(rows),
+            lambda_mult=lambda_mult,
+            k=k,
+        )
+        return [self._documents[rows[i]] for i in selected]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Any = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self._embedding.embed_query(query), k, fetch_k, lambda_mult, filter
+        )
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Any = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self._embedding.embed_query(query), k, filter
+        )
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Any = None, **kwargs: Any
+    ) -> List[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_with_score(query, k, filter)
+        ]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return self._cosine_relevance_score_fn
+
+    def _save_array(self, filename: str, array: np.ndarray) -> None:
+        # write to a temporary file first, so that a crash never leaves a half-written store
+        with open(self._path(filename) + ".tmp", "wb") as f:
+            np.save(f, array)
+        os.replace(self._path(filename) + ".tmp", self._path(filename))
+
+    def persist(self) -> None:
+        os.makedirs(self.persist_directory, exist_ok=True)
+        if self.precision != "float32":
+            self._ensure_compact()
+            self._save_array(
+                self.COMPACT_VECTORS_FILENAME.format(precision=self.precision),
+                np.asarray(self._compact),
+            )
+            if self._scale is not None:
+                self._save_array(self.SCALES_FILENAME, self._scale)
+        if self.precision == "float32" or self.keep_full_precision:
+            self._save_array(self.VECTORS_FILENAME, self.get_vectors())
+        elif os.path.exists(self._path(self.VECTORS_FILENAME)):
+            os.remove(self._path(self.VECTORS_FILENAME))
+
+        documents_path = self._path(self.DOCUMENTS_FILENAME)
+        with open(documents_path + ".tmp", "w") as f:
+            json.dump(
+                [
+                    {"id": id, "text": doc.page_content, "metadata": doc.metadata}
+                    for id, doc in zip(self._ids, self._documents)
+                ],
+                f,
+            )
+        os.replace(documents_path + ".tmp", documents_path)
+        self._load_vectors()
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        persist_directory: str = "db",
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(embedding, persist_directory, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+
+class VectorStoreBackend(ABC):
+    """
+    Creates, loads and maintains the per-WebID vector stores of one storage engine
+
+    Args:
+        config: The llm_service configuration
+    """
+
+    name = ""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.options = (config.get("vectorstore") or {}).get(self.name) or {}
+
+    @abstractmethod
+    def exists(self, persist_directory: str) -> bool:
+        """Whether the backend has any files in `persist_directory`"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def destroy(self, persist_directory: str) -> None:
+        """Deletes the store in `persist_directory`"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load(self, embeddings: Embeddings, persist_directory: str) -> VectorStore:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(
+        self,
+        store: VectorStore,
+        documents: List[Document],
+        vectors: List[List[float]],
+        ids: List[str],
+    ) -> None:
+        """Adds documents with already computed embeddings"""
+        raise NotImplementedError
+
+    def delete(self, store: VectorStore, ids: List[str]) -> None:
+        if ids:
+            store.delete(ids)
+
+    @abstractmethod
+    def iter_chunks(
+        self, store: VectorStore, include_vectors: bool = True
+    ) -> Iterator[StoredChunk]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_chunks(self, store: VectorStore, ids: List[str]) -> List[StoredChunk]:
+        """Looks up chunks with their vectors by id, skipping ids that are not stored"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def persist(self, store: VectorStore, persist_directory: str) -> None:
+        raise NotImplementedError
+
+    def has_exact_vectors(self, store: VectorStore) -> bool:
+        """Whether the stored vectors are the embeddings as computed, not quantized"""
+        return True
+
+    def distances(
+        self, store: VectorStore, vectors: np.ndarray, query: np.ndarray
+    ) -> np.ndarray:
+        """
+        Distances of `vectors` from `query` as the store's own searches report them,
+        which its relevance score function expects
+        """
+        return 1 - exact_similarities(vectors, query)
+
+
+class ChromaBackend(VectorStoreBackend):
+    name = "chroma"
+
+    def distances(self, store, vectors, query):
+        space = (store._collection.metadata or {}).get("hnsw:space", "l2")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if space == "l2":
+            # hnswlib reports squared euclidean distances
+            return ((vectors - query) ** 2).sum(axis=1)
+        if space == "ip":
+            return 1 - vectors @ query
+        return super().distances(store, vectors, query)
+
+    def exists(self, persist_directory: str) -> bool:
+        if os.path.exists(os.path.join(persist_directory, "chroma.sqlite3")):
+            # the database is left behind when the collection is deleted
+            settings = {**self.config["chroma"], "persist_directory": persist_directory}
+            client = chromadb.Client(Settings(**settings))
+            return any(
+                getattr(collection, "name", collection)
+                == Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME
+                for collection in client.list_collections()
+            )
+        # legacy (duckdb+parquet) on-disk layout
+        return os.path.exists(
+            os.path.join(persist_directory, "chroma-collections.parquet")
+        )
+
+    def destroy(self, persist_directory: str) -> None:
+        if not self.exists(persist_directory):
+            return
+        if os.path.exists(os.path.join(persist_directory, "chroma.sqlite3")):
+            # go through the client, which caches open stores
+            self.load(None, persist_directory).delete_collection()
+        for filename in ["chroma-collections.parquet", "chroma-embeddings.parquet"]:
+            if os.path.exists(os.path.join(persist_directory, filename)):
+                os.remove(os.path.join(persist_directory, filename))
+        shutil.rmtree(os.path.join(persist_directory, "index"), ignore_errors=True)
+
+    def load(self, embeddings: Embeddings, persist_directory: str) -> Chroma:
+        settings = {**self.config["chroma"], "persist_directory": persist_directory}
+        return Chroma(
+            embedding_function=embeddings,
+            client_settings=Settings(**settings),
+            # e.g. hnsw:M, hnsw:construction_ef, hnsw:search_ef (applied on creation)
+            collection_metadata=self.options.get("collection_metadata"),
+        )
+
+    def add(self, store, documents, vectors, ids):
+        if not documents:
+            return
+        store._collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            documents=[doc.page_content for doc in documents],
+            metadatas=[doc.metadata for doc in documents],
+        )
+
+    def iter_chunks(self, store, include_vectors=True, page_size=1000):
+        include = ["documents", "metadatas"]
+        if include_vectors:
+            include.append("embeddings")
+        offset = 0
+        while True:
+            page = store._collection.get(
+                include=include, limit=page_size, offset=offset
+            )
+            if not page["ids"]:
+                return
+            for i, id in enumerate(page["ids"]):
+                document = Document(
+                    page_content=page["documents"][i], metadata=page["metadatas"][i]
+                )
+                vector = list(page["embeddings"][i]) if include_vectors else None
+                yield id, document, vector
+            offset += len(page["ids"])
+
+    def get_chunks(self, store, ids):
+        if not ids:
+            return []
+        found = store._collection.get(
+            ids=ids, include=["documents", "metadatas", "embeddings"]
+        )
+        return [
+            (
+                id,
+                Document(
+                    page_content=found["documents"][i],
+                    metadata=found["metadatas"][i],
+                ),
+                list(found["embeddings"][i]),
+            )
+            for i, id in enumerate(found["ids"])
+        ]
+
+    def persist(self, store, persist_directory):
+        store.persist()
+
+
+class FaissBackend(VectorStoreBackend):
+    """
+    FAISS indexes built with `index_factory` (e.g. "HNSW32" or "Flat"), tuned with
+    `ef_construction` and `search_parameters` (e.g. `efSearch` or `nprobe`). A reduced
+    `precision` stores the vectors with a float16 or int8 scalar quantizer.
+    """
+
+    name = "faiss"
+    INDEX_FILENAME = "index.faiss"
+    # scalar quantizers of the reduced precisions
+    QUANTIZERS = {"float16": "SQfp16", "int8": "SQ8"}
+
+    def _faiss(self):
+        try:
+            import faiss
+        except ImportError as e:
+            raise ImportError(
+                "The faiss vectorstore backend requires faiss: pip install faiss-cpu"
+            ) from e
+        return faiss
+
+    def exists(self, persist_directory: str) -> bool:
+        return os.path.exists(os.path.join(persist_directory, self.INDEX_FILENAME))
+
+    def destroy(self, persist_directory: str) -> None:
+        for filename in [self.INDEX_FILENAME, "index.pkl"]:
+            if os.path.exists(os.path.join(persist_directory, filename)):
+                os.remove(os.path.join(persist_directory, filename))
+
+    def _apply_search_parameters(self, index) -> None:
+        faiss = self._faiss()
+        parameters = faiss.ParameterSpace()
+        for name, value in (self.options.get("search_parameters") or {}).items():
+            parameters.set_index_parameter(index, name, value)
+
+    def get_index_factory(self) -> str:
+        """The configured index_factory, with the vector encoding of `precision`"""
+        index_factory = self.options.get("index_factory", "HNSW32")
+        precision = self.options.get("precision", "float32")
+        if precision == "float32":
+            return index_factory
+        if precision not in self.QUANTIZERS:
+            raise ValueError(f"Unsupported vector precision: {precision}")
+        quantizer = self.QUANTIZERS[precision]
+        if index_factory == "Flat":
+            return quantizer
+        if index_factory.endswith(",Flat"):
+            return index_factory.removesuffix("Flat") + quantizer
+        if "," in index_factory:
+            raise ValueError(
+                f"index_factory {index_factory} already sets an encoding, "
+                "leave vectorstore.faiss.precision at float32"
+            )
+        return f"{index_factory},{quantizer}"
+
+    def _new_index(self, dimension: int):
+        faiss = self._faiss()
+        index = faiss.index_factory(dimension, self.get_index_factory())
+        if hasattr(index, "hnsw"):
+            index.hnsw.efConstruction = self.options.get("ef_construction", 200)
+        self._apply_search_parameters(index)
+        return index
+
+    def load(self, embeddings: Embeddings, persist_directory: str):
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        from langchain_community.vectorstores.faiss import FAISS
+
+        if self.exists(persist_directory):
+            store = FAISS.load_local(
+                persist_directory, embeddings, allow_dangerous_deserialization=True
+            )
+            self._apply_search_parameters(store.index)
+            return store
+
+        dimension = len(embeddings.embed_query("dimension"))
+        return FAISS(
+            embedding_function=embeddings,
+            index=self._new_index(dimension),
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+        )
+
+    def add(self, store, documents, vectors, ids):
+        if not documents:
+            return
+        index = store.index
+        if not index.is_trained:
+            index.train(np.asarray(vectors, dtype=np.float32))
+        store.add_embeddings(
+            zip([doc.page_content for doc in documents], vectors),
+            metadatas=[doc.metadata for doc in documents],
+            ids=ids,
+        )
+
+    def delete(self, store, ids):
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+
+        # FAISS raises on ids it does not have
+        known_ids = set(store.index_to_docstore_id.values())
+        ids = [id for id in ids if id in known_ids]
+        if not ids:
+            return
+        try:
+            store.delete(ids)
+        except RuntimeError:
+            # graph-based indexes (HNSW) do not support removal, so rebuild without the ids
+            ids = set(ids)
+            remaining = [
+                chunk for chunk in self.iter_chunks(store) if chunk[0] not in ids
+            ]
+            store.index = self._new_index(store.index.d)
+            store.index_to_docstore_id = {}
+            store.docstore = InMemoryDocstore()
+            add_chunks(self, store, remaining)
+
+    def has_exact_vectors(self, store):
+        faiss = self._faiss()
+        index = faiss.downcast_index(store.index)
+        if hasattr(index, "storage"):
+            # graph indexes (HNSW) keep the vectors in a separate index
+            index = faiss.downcast_index(index.storage)
+        return isinstance(index, (faiss.IndexFlat, faiss.IndexIVFFlat))
+
+    def iter_chunks(self, store, include_vectors=True):
+        for i, id in store.index_to_docstore_id.items():
+            vector = (
+                store.index.reconstruct(int(i)).tolist() if include_vectors else None
+            )
+            yield id, store.docstore.search(id), vector
+
+    def get_chunks(self, store, ids):
+        positions = {id: i for i, id in store.index_to_docstore_id.items()}
+        return [
+            (
+                id,
+                store.docstore.search(id),
+                store.index.reconstruct(int(positions[id])).tolist(),
+            )
+            for id in ids
+            if id in positions
+        ]
+
+    def distances(self, store, vectors, query):
+        from langchain_community.vectorstores.utils import DistanceStrategy
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if store.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+            return vectors @ query
+        if store.distance_strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
+            if store._normalize_L2:
+                vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+                query = query / np.linalg.norm(query)
+            # L2 indexes report squared euclidean distances
+            return ((vectors - query) ** 2).sum(axis=1)
+        return super().distances(store, vectors, query)
+
+    def persist(self, store, persist_directory):
+        store.save_local(persist_directory)
+
+
+class NumpyBackend(VectorStoreBackend):
+    name = "numpy"
+
+    def exists(self, persist_directory: str) -> bool:
+        return os.path.exists(
+            os.path.join(persist_directory, NumpyVectorStore.DOCUMENTS_FILENAME)
+        )
+
+    def destroy(self, persist_directory: str) -> None:
+        for filename in [
+            NumpyVectorStore.DOCUMENTS_FILENAME,
+            NumpyVectorStore.VECTORS_FILENAME,
+            NumpyVectorStore.SCALES_FILENAME,
+            *map(
+                os.path.basename,
+                glob.glob(os.path.join(persist_directory, "vectors.*.npy")),
+            ),
+        ]:
+            path = os.path.join(persist_directory, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load(self, embeddings: Embeddings, persist_directory: str) -> NumpyVectorStore:
+        return NumpyVectorStore(
+            embeddings,
+            persist_directory,
+            precision=self.options.get("precision", "float32"),
+            rescore_factor=self.options.get("rescore_factor", 4),
+            keep_full_precision=self.options.get("keep_full_precision", False),
+        )
+
+    def add(self, store, documents, vectors, ids):
+        store.add_embeddings(
+            [doc.page_content for doc in documents],
+            vectors,
+            [doc.metadata for doc in documents],
+            ids,
+        )
+
+    def has_exact_vectors(self, store):
+        return store.full_precision
+
+    def iter_chunks(self, store, include_vectors=True):
+        return store.iter_chunks(include_vectors)
+
+    def get_chunks(self, store, ids):
+        return store.get_chunks(ids)
+
+    def persist(self, store, persist_directory):
+        store.persist()
+
+
+# Map backend names to vector store backends
+VECTORSTORE_BACKENDS = {
+    "chroma": ChromaBackend,
+    "faiss": FaissBackend,
+    "numpy": NumpyBackend,
+}
+
+
+def add_chunks(
+    backend: VectorStoreBackend, store: VectorStore, chunks: List[StoredChunk]
+) -> None:
+    backend.add(
+        store,
+        [document for _, document, _ in chunks],
+        [vector for _, _, vector in chunks],
+        [id for id, _, _ in chunks],
+    )
+
+
+def get_vectorstore_backend(
+    config: Dict[str, Any], name: Optional[str] = None
+) -> VectorStoreBackend:
+    name = name or (config.get("vectorstore") or {}).get("backend", "chroma")
+    if name not in VECTORSTORE_BACKENDS:
+        raise ValueError(f"Unsupported vectorstore backend: {name}")
+    return VECTORSTORE_BACKENDS[name](config)
+
+
+def migrate_vectorstore(
+    config: Dict[str, Any],
+    embeddings: Embeddings,
+    persist_directory: str,
+    source: str,
+    target: str,
+    batch_size: int = 1000,
+) -> int:
+    """
+    Copies all chunks and their embeddings from one backend to another without re-embedding,
+    then records the target backend in the store's manifest.
+    Returns the number of migrated chunks.
+    """
+    source_backend = get_vectorstore_backend(config, source)
+    target_backend = get_vectorstore_backend(config, target)
+    if not source_backend.exists(persist_directory):
+        return 0
+
+    source_store = source_backend.load(embeddings, persist_directory)
+    target_store = target_backend.load(embeddings, persist_directory)
+    migrated = 0
+    dimension = None
+    batch = []
+    for chunk in source_backend.iter_chunks(source_store):
+        if dimension is None and chunk[2] is not None:
+            dimension = len(chunk[2])
+        batch.append(chunk)
+        if len(batch) == batch_size:
+            add_chunks(target_backend, target_store, batch)
+            migrated += len(batch)
+            batch = []
+    add_chunks(target_backend, target_store, batch)
+    migrated += len(batch)
+    target_backend.persist(target_store, persist_directory)
+
+    manifest = read_manifest(persist_directory) or get_configured_manifest(config)
+    manifest.backend = target
+    manifest.dimension = dimension or manifest.dimension
+    if os.path.exists(os.path.join(persist_directory, SOURCE_INDEX_FILENAME)):
+        with SourceIndex(persist_directory) as source_index:
+            manifest.document_count = source_index.count()
+    write_manifest(persist_directory, manifest)
+    return migrated
+
+
+def precision_recall_report(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 4,
+    rescore_factor: int = 4,
+    precisions: Iterable[str] = ("float32", "float16", "int8"),
+    exact_baseline: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Compares top-k search over reduced precision vectors with exact float32 search, with and
+    without exact re-scoring of the best `rescore_factor * k` candidates. Without
+    `exact_baseline`, `vectors` were already quantized by the store, so the baseline is
+    not the float32 index and the recall is overestimated.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    exact = [
+        set(np.argsort(-exact_similarities(vectors, query))[:k]) for query in queries
+    ]
+
+    report = []
+    for precision in precisions:
+        compact, scale = quantize_vectors(vectors, precision)
+        hits = rescored_hits = 0
+        for query, expected in zip(queries, exact):
+            candidates = np.argsort(-approximate_similarities(compact, scale, query))
+            hits += len(expected & set(candidates[:k]))
+            shortlist = candidates[: k * rescore_factor]
+            rescored = shortlist[
+                np.argsort(-exact_similarities(vectors[shortlist], query))
+            ]
+            rescored_hits += len(expected & set(rescored[:k]))
+        total = max(len(queries) * min(k, len(vectors)), 1)
+        report.append(
+            {
+                "precision": precision,
+                "bytes_per_vector": compact.itemsize * vectors.shape[1],
+                "index_bytes": compact.nbytes
+                + (scale.nbytes if scale is not None else 0),
+                f"recall@{k}": hits / total,
+                f"recall@{k}_rescored": rescored_hits / total,
+                "exact_baseline": exact_baseline,
+            }
+        )
+    return report
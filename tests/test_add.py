@@ -0,0 +1,163 @@
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+pytest.importorskip("solid_client_credentials")
+# the chunks are measured with the embedding model's tokenizer
+pytest.importorskip("transformers")
+
+import llm_service.add as add_module
+import llm_service.embeddings as embeddings_module
+from llm_service.add import _add, add, migrate_legacy_location
+from llm_service.config import get_config
+from llm_service.embeddings import (
+    get_partition_directory,
+    get_persist_directory,
+    get_vectorstore,
+    retrieve_documents,
+)
+from llm_service.manifest import read_manifest
+from llm_service.solid_utils import DownloadedResource
+from llm_service.vectorstores import get_vectorstore_backend
+
+WEBID = "https://alice.example/profile#me"
+LOCATION = "https://pod.example/docs/"
+OTHER_LOCATION = "https://pod.example/notes/"
+
+
+@pytest.fixture
+def pod(tmp_path, monkeypatch):
+    """Documents of a fake pod, ingested with fake embeddings into a numpy store"""
+    documents = {}
+    embeddings = DeterministicFakeEmbedding(size=16)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(add_module, "get_ingestion_embeddings", lambda c: embeddings)
+    monkeypatch.setattr(add_module, "get_embeddings", lambda c: embeddings)
+    monkeypatch.setattr(embeddings_module, "get_embeddings", lambda c: embeddings)
+    monkeypatch.setattr(
+        add_module,
+        "discover_document_uris",
+        lambda location: [uri for uri in documents if uri.startswith(location)],
+    )
+    monkeypatch.setattr(
+        add_module,
+        "download_resource",
+        lambda uri, spill_threshold: DownloadedResource(
+            uri, "text/plain", str(hash(documents[uri])), content=documents[uri]
+        ),
+    )
+    return documents
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = get_config()
+    config["chroma"]["persist_directory"] = str(tmp_path / "db")
+    config["embedding_cache"]["enabled"] = False
+    config["vectorstore"]["backend"] = "numpy"
+    config["dedup"]["enabled"] = True
+    return config
+
+
+def stored_chunks(config, docs_location=LOCATION):
+    persist_directory = get_partition_directory(config, WEBID, docs_location)
+    store = get_vectorstore(config, persist_directory)
+    return [
+        document
+        for _, document, _ in get_vectorstore_backend(config).iter_chunks(store)
+    ]
+
+
+def test_duplicate_is_attributed_to_the_remaining_source(pod, config):
+    text = b"Turtles can live for more than a hundred years in the wild."
+    pod[LOCATION + "a.txt"] = text
+    pod[LOCATION + "b.txt"] = text
+    add(config, LOCATION, WEBID)
+    (chunk,) = stored_chunks(config)
+    assert chunk.metadata["source"] == LOCATION + "a.txt"
+    assert chunk.metadata["duplicate_sources"] == LOCATION + "b.txt"
+
+    del pod[LOCATION + "a.txt"]
+    add(config, LOCATION, WEBID)
+    (chunk,) = stored_chunks(config)
+    assert chunk.metadata["source"] == LOCATION + "b.txt"
+    assert "duplicate_sources" not in chunk.metadata
+
+
+def add_notes(pod):
+    for i, text in enumerate(
+        [
+            b"Turtles can live for more than a hundred years in the wild.",
+            b"The meeting was moved to Thursday afternoon.",
+            b"Solid pods store their data in decentralized data stores.",
+        ]
+    ):
+        pod[f"{LOCATION}{i}.txt"] = text
+        pod[f"{OTHER_LOCATION}{i}.txt"] = text.replace(b".", b" again.")
+
+
+@pytest.mark.parametrize(
+    "retriever",
+    [
+        {"search_type": "similarity", "search_kwargs": {"k": 4}},
+        {
+            "search_type": "mmr",
+            "search_kwargs": {"k": 4, "fetch_k": 6, "lambda_mult": 0.5},
+        },
+    ],
+)
+def test_query_over_several_locations(pod, config, retriever):
+    add_notes(pod)
+    add(config, LOCATION, WEBID)
+    add(config, OTHER_LOCATION, WEBID)
+    config["retriever"] = retriever
+    docs = retrieve_documents(config, WEBID, [LOCATION, OTHER_LOCATION], "turtles")
+    assert len(docs) == 4
+    sources = [doc.metadata["source"] for doc in docs]
+    assert len(set(sources)) == 4
+    assert {source.rsplit("/", 1)[0] + "/" for source in sources} == {
+        LOCATION,
+        OTHER_LOCATION,
+    }
+
+
+def test_legacy_store_is_split_by_location(pod, config):
+    add_notes(pod)
+    webid_directory = get_persist_directory(config, WEBID)
+    # older versions kept the documents of all locations in one store
+    _add(config, "https://pod.example/", WEBID, webid_directory, None, None)
+    assert read_manifest(webid_directory).document_count == 6
+
+    add(config, LOCATION, WEBID)
+    assert read_manifest(webid_directory).document_count == 3
+    docs = retrieve_documents(config, WEBID, [OTHER_LOCATION], "turtles")
+    assert docs == []
+    migrate_legacy_location(config, WEBID, OTHER_LOCATION)
+    assert read_manifest(webid_directory) is None
+    for docs_location in [LOCATION, OTHER_LOCATION]:
+        chunks = stored_chunks(config, docs_location)
+        assert sorted(chunk.metadata["source"] for chunk in chunks) == sorted(
+            uri for uri in pod if uri.startswith(docs_location)
+        )
+    docs = retrieve_documents(config, WEBID, [OTHER_LOCATION], "turtles")
+    assert docs
+
+
+def test_duplicates_are_found_across_checkpoints(pod, config):
+    config["ingestion"]["checkpoint_resources"] = 1
+    text = b"Turtles can live for more than a hundred years in the wild."
+    copies = [LOCATION + "a.txt", LOCATION + "b.txt"]
+    pod[copies[0]] = text
+    pod[copies[1]] = text.upper()
+    pod[LOCATION + "c.txt"] = b"The meeting was moved to Thursday afternoon."
+    add(config, LOCATION, WEBID)
+    chunks = {chunk.metadata["source"]: chunk for chunk in stored_chunks(config)}
+    assert len(chunks) == 2
+    (kept,) = set(chunks) & set(copies)
+    (dropped,) = set(copies) - {kept}
+    assert chunks[kept].metadata["duplicate_sources"] == dropped
+
+    del pod[kept]
+    add(config, LOCATION, WEBID)
+    chunks = {chunk.metadata["source"]: chunk for chunk in stored_chunks(config)}
+    assert sorted(chunks) == [dropped, LOCATION + "c.txt"]
+    assert "duplicate_sources" not in chunks[dropped].metadata
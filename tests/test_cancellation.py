@@ -0,0 +1,116 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+import llm_service.cancellation as cancellation_module
+from llm_service.cancellation import (
+    CLIENT_DISCONNECTED,
+    DEADLINE_EXCEEDED,
+    CancellationCallback,
+    RequestCancelled,
+    request_cancellation,
+)
+from llm_service.executors import MonitoredExecutor
+from llm_service.scheduler import FairScheduler
+
+
+class FakeRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self) -> bool:
+        return self.disconnected
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(cancellation_module, "DISCONNECT_POLL_INTERVAL", 0.01)
+
+
+def test_disconnect_cancels_the_request():
+    async def main():
+        request = FakeRequest()
+        async with request_cancellation(request) as token:
+            await asyncio.sleep(0.05)
+            assert not token.cancelled
+            request.disconnected = True
+            await asyncio.sleep(0.05)
+        return token
+
+    token = asyncio.run(main())
+    assert token.cancelled
+    assert token.reason == CLIENT_DISCONNECTED
+    assert not token.exception().deadline_exceeded
+
+
+def test_timeout_cancels_the_request():
+    async def main():
+        async with request_cancellation(FakeRequest(), "0.05") as token:
+            await asyncio.sleep(0.01)
+            assert not token.cancelled
+            await asyncio.sleep(0.1)
+        return token
+
+    token = asyncio.run(main())
+    assert token.reason == DEADLINE_EXCEEDED
+    with pytest.raises(RequestCancelled) as e:
+        token.raise_if_cancelled()
+    assert e.value.deadline_exceeded
+
+
+def test_finished_request_is_not_cancelled():
+    async def main():
+        async with request_cancellation(FakeRequest(), "0.05") as token:
+            pass
+        await asyncio.sleep(0.1)
+        return token
+
+    assert not asyncio.run(main()).cancelled
+
+
+def test_invalid_timeout_is_rejected():
+    async def main():
+        async with request_cancellation(FakeRequest(), "tomorrow"):
+            pass
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(main())
+    assert e.value.status_code == 400
+
+
+def test_cancelled_generation_stops_at_the_next_token():
+    async def main():
+        async with request_cancellation(FakeRequest(), "0") as token:
+            await asyncio.sleep(0.01)
+        return token
+
+    callback = CancellationCallback(asyncio.run(main()))
+    with pytest.raises(RequestCancelled):
+        callback.on_llm_new_token("token")
+
+
+def test_cancelled_request_leaves_the_queue():
+    async def main():
+        scheduler = FairScheduler({}, MonitoredExecutor("test", max_workers=1))
+        release = threading.Event()
+        blocker = asyncio.create_task(scheduler.run("a", release.wait, 5))
+        request = FakeRequest()
+        async with request_cancellation(request) as token:
+            started = []
+            queued = asyncio.create_task(
+                scheduler.run("b", started.append, True, cancellation=token)
+            )
+            await asyncio.sleep(0.02)
+            request.disconnected = True
+            with pytest.raises(RequestCancelled):
+                await queued
+        release.set()
+        await blocker
+        return started, scheduler.stats()["b"]
+
+    started, stats = asyncio.run(main())
+    assert started == []
+    assert stats["cancelled"] == 1
+    assert stats["queued"] == 0
@@ -0,0 +1,52 @@
+import yaml
+
+from llm_service.config import get_config, validate_config
+
+DEFAULT_MODEL = "TheBloke/orca_mini_3B-GGML"
+
+
+def write_config(tmp_path, config):
+    path = tmp_path / "genpod.yml"
+    path.write_text(yaml.safe_dump(config))
+    return path
+
+
+def test_user_model_replaces_the_default_model_of_the_same_name(tmp_path):
+    path = write_config(
+        tmp_path,
+        {
+            "llms": [
+                {
+                    "model_framework": "ctransformers",
+                    "model": DEFAULT_MODEL,
+                    "model_file": "orca-mini-3b.ggmlv3.q8_0.bin",
+                    "model_type": "llama",
+                    "replicas": 2,
+                }
+            ]
+        },
+    )
+    config = get_config(path)
+    (spec,) = config["llms"]
+    assert spec["model_file"] == "orca-mini-3b.ggmlv3.q8_0.bin"
+    assert spec["replicas"] == 2
+    validate_config(config)
+
+
+def test_other_user_models_are_added_to_the_defaults(tmp_path):
+    path = write_config(
+        tmp_path,
+        {"llms": [{"model_framework": "openai", "model": "gpt-3.5-turbo-instruct"}]},
+    )
+    config = get_config(path)
+    assert [spec["model"] for spec in config["llms"]] == [
+        DEFAULT_MODEL,
+        "gpt-3.5-turbo-instruct",
+    ]
+
+
+def test_default_config_without_user_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = get_config()
+    assert [spec["model"] for spec in config["llms"]] == [DEFAULT_MODEL]
+    validate_config(config)
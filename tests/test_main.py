@@ -0,0 +1,147 @@
+import asyncio
+import copy
+import importlib
+import signal
+import time
+
+import pytest
+
+import llm_service.registry as registry_module
+import llm_service.solid_utils as solid_utils
+from llm_service.registry import LLMRegistry
+
+
+@pytest.fixture(scope="module")
+def main():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # the service registers with its identity provider when it is imported
+        monkeypatch.setattr(solid_utils, "register_retrieval_service", lambda: None)
+        return importlib.import_module("llm_service.main")
+
+
+def get_config(main, *models):
+    config = copy.deepcopy(main.config)
+    config["llms"] = [{"model_framework": "openai", "model": m} for m in models]
+    config["rephrase"]["llms"] = []
+    return config
+
+
+@pytest.fixture
+def failing():
+    """Models that fail to load"""
+    return set()
+
+
+@pytest.fixture
+def states():
+    """States the reloads went through"""
+    return []
+
+
+@pytest.fixture
+def service(main, monkeypatch, failing, states):
+    """The service running a configuration with model "a", with stand-in models"""
+
+    def load_llm(spec, *, download):
+        if spec["model"] in failing:
+            raise RuntimeError(f"Cannot load {spec['model']}")
+        return spec["model"]
+
+    monkeypatch.setattr(registry_module, "load_llm", load_llm)
+    monkeypatch.setattr(main, "get_embeddings", lambda config: None)
+    monkeypatch.setattr(main, "unload_embeddings", lambda config: None)
+    config = get_config(main, "a")
+    monkeypatch.setattr(main, "config", config)
+    monkeypatch.setattr(main, "llm_registry", LLMRegistry(config))
+    monkeypatch.setattr(main, "reload_status", {"state": "idle"})
+
+    update_reload_status = main._update_reload_status
+
+    def record(**fields):
+        states.append(fields["state"])
+        update_reload_status(**fields)
+
+    monkeypatch.setattr(main, "_update_reload_status", record)
+    return main
+
+
+def wait_for_state(main, state, timeout=10):
+    deadline = time.monotonic() + timeout
+    while main.reload_status["state"] != state:
+        assert time.monotonic() < deadline, main.reload_status
+        time.sleep(0.01)
+
+
+def test_reload_loads_switches_then_unloads(service, states, monkeypatch):
+    old_pool = service.llm_registry.get("a")
+    new_config = get_config(service, "b")
+    monkeypatch.setattr(service, "get_config", lambda: new_config)
+
+    with old_pool.acquire():
+        diff = service.reload_config()
+        assert diff["added_models"] == ["b"]
+        assert diff["removed_models"] == ["a"]
+        wait_for_state(service, "unloading")
+        # new requests use the new models while the old model finishes its request
+        assert service.config is new_config
+        assert service.llm_registry.model_names() == ["b"]
+        assert list(service.llm_registry.pools()) == ["b"]
+        assert old_pool.busy == 1
+    wait_for_state(service, "done")
+    assert states == ["loading", "unloading", "done"]
+
+
+def test_failed_reload_keeps_the_running_configuration(
+    service, failing, states, monkeypatch
+):
+    config = service.config
+    service.llm_registry.get("a")
+    monkeypatch.setattr(service, "get_config", lambda: get_config(service, "b", "c"))
+    failing.add("c")
+
+    service.reload_config()
+    wait_for_state(service, "failed")
+    assert states == ["loading", "failed"]
+    assert "Cannot load c" in service.reload_status["error"]
+    assert service.config is config
+    # the model loaded for the new configuration is forgotten again
+    assert list(service.llm_registry.pools()) == ["a"]
+
+
+def test_invalid_configuration_is_not_applied(service, states, monkeypatch):
+    invalid = get_config(service, "a", "a")
+    monkeypatch.setattr(service, "get_config", lambda: invalid)
+    with pytest.raises(ValueError):
+        service.reload_config()
+    assert states == []
+    # the lock was released
+    monkeypatch.setattr(service, "get_config", lambda: get_config(service, "b"))
+    service.reload_config()
+    wait_for_state(service, "done")
+
+
+def test_one_reload_at_a_time(service):
+    with service._reload_lock:
+        with pytest.raises(RuntimeError):
+            service.reload_config()
+
+
+def test_forked_worker_signals_its_parent(service, states, monkeypatch):
+    signals = []
+    monkeypatch.setattr(service, "get_parent_pid", lambda: 1234)
+    monkeypatch.setattr(service.os, "kill", lambda *args: signals.append(args))
+    monkeypatch.setattr(service, "get_config", lambda: get_config(service, "b"))
+
+    response = asyncio.run(service.reload_configuration())
+    assert response["state"] == "signalled"
+    assert response["diff"]["added_models"] == ["b"]
+    assert signals == [(1234, signal.SIGHUP)]
+    # every worker, this one included, reloads when the parent forwards the signal
+    assert states == []
+
+    monkeypatch.setattr(
+        service, "get_worker_states", lambda name: {1: {"state": "done"}, 2: None}
+    )
+    assert asyncio.run(service.get_reload_status()) == {
+        "workers": {1: {"state": "done"}, 2: {"state": "idle"}}
+    }
@@ -0,0 +1,46 @@
+import pytest
+
+from llm_service.config import get_config
+from llm_service.manifest import (
+    IncompatibleVectorStoreError,
+    check_query_compatibility,
+    get_configured_manifest,
+    get_rebuild_reason,
+    read_manifest,
+    write_manifest,
+)
+
+
+def with_embeddings(config, **options):
+    return {**config, "embeddings": {**config["embeddings"], **options}}
+
+
+def test_store_built_with_other_instructions_is_incompatible(tmp_path):
+    config = get_config()
+    write_manifest(str(tmp_path), get_configured_manifest(config))
+    manifest = read_manifest(str(tmp_path))
+
+    check_query_compatibility(manifest, config)
+    for options in [
+        {"embed_instruction": "Represent the document: "},
+        {"encode_kwargs": {"normalize_embeddings": True}},
+    ]:
+        with pytest.raises(IncompatibleVectorStoreError):
+            check_query_compatibility(manifest, with_embeddings(config, **options))
+        assert get_rebuild_reason(manifest, with_embeddings(config, **options))
+
+
+def test_manifests_without_instructions_stay_compatible(tmp_path):
+    config = get_config()
+    manifest = get_configured_manifest(config)
+    (tmp_path / "manifest.json").write_text(
+        manifest.model_dump_json(exclude={"embed_instruction", "encode_kwargs"})
+    )
+    manifest = read_manifest(str(tmp_path))
+    config = with_embeddings(config, embed_instruction="Represent the document: ")
+
+    check_query_compatibility(manifest, config)
+    assert get_rebuild_reason(manifest, config) is None
+    manifest.document_count = 1
+    write_manifest(str(tmp_path), manifest)
+    assert "embed_instruction" not in (tmp_path / "manifest.json").read_text()
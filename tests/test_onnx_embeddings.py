@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("InstructorEmbedding")
+pytest.importorskip("sentence_transformers")
+
+from langchain_community.embeddings import (
+    HuggingFaceEmbeddings,
+    HuggingFaceInstructEmbeddings,
+)
+
+from llm_service.onnx_embeddings import (
+    VALIDATION_TEXTS,
+    OnnxEmbeddings,
+    export_onnx_model,
+)
+
+
+def cosine_similarities(expected, actual):
+    expected, actual = np.array(expected), np.array(actual)
+    return (expected * actual).sum(1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    )
+
+
+def assert_parity(reference, embeddings):
+    assert (
+        cosine_similarities(
+            reference.embed_documents(VALIDATION_TEXTS),
+            embeddings.embed_documents(VALIDATION_TEXTS),
+        ).min()
+        > 0.999
+    )
+    assert (
+        cosine_similarities(
+            [reference.embed_query(VALIDATION_TEXTS[2])],
+            [embeddings.embed_query(VALIDATION_TEXTS[2])],
+        ).min()
+        > 0.999
+    )
+
+
+def test_instructor_parity(tmp_path):
+    reference = HuggingFaceInstructEmbeddings(model_name="hkunlp/instructor-base")
+    export_onnx_model(reference, tmp_path, quantize=False)
+    embeddings = OnnxEmbeddings(tmp_path)
+
+    assert not embeddings.pool_instruction
+    assert_parity(reference, embeddings)
+
+
+def test_sentence_transformers_parity_with_normalization(tmp_path):
+    reference = HuggingFaceEmbeddings(
+        model_name="sentence-transformers/all-MiniLM-L6-v2",
+        encode_kwargs={"normalize_embeddings": True},
+    )
+    export_onnx_model(reference, tmp_path, quantize=False)
+    embeddings = OnnxEmbeddings(tmp_path)
+
+    assert_parity(reference, embeddings)
+    norms = np.linalg.norm(embeddings.embed_documents(VALIDATION_TEXTS), axis=1)
+    assert np.allclose(norms, 1, atol=1e-4)
@@ -0,0 +1,95 @@
+import pytest
+
+import llm_service.registry as registry_module
+from llm_service.registry import LLMRegistry
+
+
+def get_spec(model, **options):
+    return {"model_framework": "openai", "model": model, **options}
+
+
+def get_config(*models, rephrase=()):
+    return {
+        "llms": [get_spec(model) for model in models],
+        "rephrase": {"llms": [get_spec(model) for model in rephrase]},
+        "download": False,
+    }
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    """Models loaded by the registry, which get a stand-in for each replica"""
+    loaded = []
+
+    def load_llm(spec, *, download):
+        loaded.append(spec["model"])
+        return f"{spec['model']} #{loaded.count(spec['model'])}"
+
+    monkeypatch.setattr(registry_module, "load_llm", load_llm)
+    return loaded
+
+
+def test_models_are_loaded_once(loaded):
+    registry = LLMRegistry(get_config("a"))
+    with registry.acquire("a") as llm:
+        assert llm == "a #1"
+    with registry.acquire("a") as llm:
+        assert llm == "a #1"
+    assert loaded == ["a"]
+
+
+def test_replicas_are_loaded_per_pool(loaded):
+    config = get_config()
+    config["llms"] = [get_spec("a", replicas=2)]
+    registry = LLMRegistry(config)
+    pool = registry.get("a")
+    assert pool.size == 2
+    with pool.acquire() as first, pool.acquire() as second:
+        assert {first, second} == {"a #1", "a #2"}
+        assert pool.stats()["busy"] == 2
+
+
+def test_prepare_loads_only_new_models(loaded):
+    registry = LLMRegistry(get_config("a", "b"))
+    registry.get("a")
+    registry.get("b")
+    registry.prepare(get_config("b", "c", rephrase=["d"]))
+    assert loaded == ["a", "b", "c", "d"]
+    # requests are still routed by the current configuration
+    assert registry.model_names() == ["a", "b"]
+
+
+def test_switch_returns_the_pools_no_longer_used(loaded):
+    registry = LLMRegistry(get_config("a", "b"))
+    pool_a, pool_b = registry.get("a"), registry.get("b")
+    new_config = get_config("b", "c")
+    registry.prepare(new_config)
+    assert registry.switch(new_config) == [pool_a]
+    assert registry.model_names() == ["b", "c"]
+    assert registry.get("b") is pool_b
+    assert sorted(registry.pools()) == ["b", "c"]
+    with pytest.raises(KeyError):
+        registry.get("a")
+    assert loaded == ["a", "b", "c"]
+
+
+def test_switch_back_forgets_prepared_models(loaded):
+    config = get_config("a")
+    registry = LLMRegistry(config)
+    registry.get("a")
+    registry.prepare(get_config("a", "b"))
+    # e.g. after a failed reload
+    (pool,) = registry.switch(config)
+    assert pool.name == "b"
+    assert sorted(registry.pools()) == ["a"]
+
+
+def test_changed_spec_is_loaded_as_a_new_pool(loaded):
+    registry = LLMRegistry(get_config("a"))
+    old_pool = registry.get("a")
+    new_config = get_config()
+    new_config["llms"] = [get_spec("a", temperature=0)]
+    registry.prepare(new_config)
+    assert registry.switch(new_config) == [old_pool]
+    assert registry.get("a") is not old_pool
+    assert loaded == ["a", "a"]
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+import pytest
+
+from llm_service.executors import MonitoredExecutor
+from llm_service.scheduler import FairScheduler, TenantLimitExceeded
+
+
+def get_scheduler(**scheduler_config):
+    config = {"scheduler": scheduler_config}
+    return FairScheduler(config, MonitoredExecutor("test", max_workers=1))
+
+
+async def occupy(scheduler, tenant="busy"):
+    """Starts a task holding the only worker until the returned event is set"""
+    release = threading.Event()
+    started = threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+
+    task = asyncio.create_task(scheduler.run(tenant, work))
+    await asyncio.to_thread(started.wait, 5)
+    return task, release
+
+
+def test_tenants_take_turns():
+    async def main():
+        scheduler = get_scheduler()
+        blocker, release = await occupy(scheduler)
+        order = []
+        tasks = [
+            asyncio.create_task(scheduler.run(tenant, order.append, name))
+            for tenant, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        return order
+
+    # b's request goes before a's backlog instead of waiting behind it
+    assert asyncio.run(main()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_weight_gives_a_larger_share():
+    async def main():
+        scheduler = get_scheduler(tenants={"b": {"weight": 2}})
+        blocker, release = await occupy(scheduler)
+        order = []
+        tasks = [
+            asyncio.create_task(scheduler.run(tenant, order.append, name))
+            for tenant, name in [
+                ("a", "a1"),
+                ("a", "a2"),
+                ("b", "b1"),
+                ("b", "b2"),
+                ("b", "b3"),
+                ("b", "b4"),
+            ]
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        return order
+
+    assert asyncio.run(main()) == ["b1", "a1", "b2", "b3", "a2", "b4"]
+
+
+def test_requests_over_max_queued_are_rejected():
+    async def main():
+        scheduler = get_scheduler(default_tenant={"max_queued": 1})
+        blocker, release = await occupy(scheduler)
+        queued = asyncio.create_task(scheduler.run("a", lambda: "done"))
+        await asyncio.sleep(0)
+        with pytest.raises(TenantLimitExceeded):
+            await scheduler.run("a", lambda: "rejected")
+        # other tenants have queues of their own
+        other = asyncio.create_task(scheduler.run("b", lambda: "other"))
+        await asyncio.sleep(0)
+        release.set()
+        await blocker
+        return await queued, await other, scheduler.stats()["a"]
+
+    queued, other, stats = asyncio.run(main())
+    assert (queued, other) == ("done", "other")
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 1
+
+
+def test_cancelled_caller_keeps_its_slot_until_the_work_finishes():
+    async def main():
+        scheduler = get_scheduler()
+        blocker, release = await occupy(scheduler, "a")
+        blocker.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await blocker
+        # the thread is still busy, so nothing else may start
+        waiting = asyncio.create_task(scheduler.run("b", lambda: "b"))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        assert scheduler.stats()["a"]["running"] == 1
+        release.set()
+        return await waiting, scheduler.stats()["a"]
+
+    result, stats = asyncio.run(main())
+    assert result == "b"
+    assert stats["running"] == 0
@@ -0,0 +1,81 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+import llm_service.serving as serving
+from llm_service.serving import get_worker_states
+
+pytestmark = pytest.mark.skipif(
+    not os.path.isdir("/proc") or not hasattr(signal, "SIGHUP"),
+    reason="needs /proc and SIGHUP",
+)
+
+# Serves an app whose workers publish their state on startup and on SIGHUP
+SERVER = textwrap.dedent("""
+    import asyncio
+    import signal
+
+    from llm_service.serving import publish_worker_state, serve_forked
+
+    async def app(scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                hups = []
+
+                def on_sighup():
+                    hups.append(1)
+                    publish_worker_state("test", {"hups": len(hups)})
+
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, on_sighup)
+                publish_worker_state("test", {"hups": 0})
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if __name__ == "__main__":
+        serve_forked(app, "127.0.0.1", 0, 2, lambda: None)
+    """)
+
+
+def wait_for_states(expected, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        states = get_worker_states("test")
+        if len(states) == 2 and all(state == expected for state in states.values()):
+            return states
+        time.sleep(0.1)
+    raise AssertionError(f"Worker states are {get_worker_states('test')}")
+
+
+def test_sighup_is_forwarded_to_every_worker(tmp_path, monkeypatch):
+    script = tmp_path / "server.py"
+    script.write_text(SERVER)
+    src = os.path.join(os.path.dirname(__file__), os.pardir, "src")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([src, *sys.path])}
+    process = subprocess.Popen([sys.executable, str(script)], env=env)
+    try:
+        # as seen from one of its workers
+        monkeypatch.setattr(serving, "_parent_pid", process.pid)
+        started = wait_for_states({"hups": 0})
+        os.kill(process.pid, signal.SIGHUP)
+        assert wait_for_states({"hups": 1}).keys() == started.keys()
+    finally:
+        process.terminate()
+        process.wait(20)
+    assert not os.path.exists(serving._get_state_directory(process.pid))
+
+
+def test_worker_without_published_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(serving.tempfile, "gettempdir", lambda: str(tmp_path))
+    # this process is one of the children of its parent
+    monkeypatch.setattr(serving, "_parent_pid", os.getppid())
+    assert get_worker_states("test")[os.getpid()] is None
+    serving.publish_worker_state("test", {"state": "done"})
+    assert get_worker_states("test")[os.getpid()] == {"state": "done"}
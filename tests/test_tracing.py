@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from llm_service.tracing import configure_tracing, remote_parent, span
+
+
+@pytest.fixture
+def path(tmp_path):
+    """File the spans are exported to"""
+    path = tmp_path / "traces.jsonl"
+    configure_tracing({"tracing": {"exporter": "jsonl", "path": str(path)}})
+    yield path
+    configure_tracing({})
+
+
+def read_spans(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_spans_continue_the_trace_of_the_caller(path):
+    # e.g. a chat turn of the chat app calling the service
+    with span("chat.turn") as caller:
+        traceparent = caller.traceparent()
+    with remote_parent(traceparent):
+        with span("POST /completions/"):
+            with span("generate"):
+                pass
+    turn, generate, request = read_spans(path)
+    assert turn["parent_id"] is None
+    assert request["trace_id"] == generate["trace_id"] == turn["trace_id"]
+    assert request["parent_id"] == turn["span_id"]
+    assert generate["parent_id"] == request["span_id"]
+
+
+@pytest.mark.parametrize("traceparent", [None, "", "00-abc-def-01", "garbage"])
+def test_invalid_traceparent_starts_a_new_trace(path, traceparent):
+    with remote_parent(traceparent):
+        with span("request"):
+            pass
+    (request,) = read_spans(path)
+    assert request["parent_id"] is None
+
+
+def test_spans_are_attributed_to_the_service(path):
+    with span("request"):
+        pass
+    configure_tracing(
+        {"tracing": {"exporter": "jsonl", "path": str(path)}}, service_name="chat_app"
+    )
+    with span("chat.turn"):
+        pass
+    assert [exported["service"] for exported in read_spans(path)] == [
+        "llm_service",
+        "chat_app",
+    ]
+
+
+def test_disabled_spans_yield_nothing():
+    with span("request") as request_span:
+        assert request_span is None
@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from llm_service.vectorstores import (
+    FaissBackend,
+    NumpyVectorStore,
+    migrate_vectorstore,
+)
+
+
+def directory_size(path):
+    return sum(f.stat().st_size for f in path.iterdir() if f.suffix == ".npy")
+
+
+def test_quantized_search_with_filter_matching_nothing(tmp_path):
+    store = NumpyVectorStore(
+        DeterministicFakeEmbedding(size=8), str(tmp_path), precision="int8"
+    )
+    store.add_embeddings(
+        ["a", "b"], np.eye(2, 8).tolist(), [{"source": "a"}, {"source": "b"}]
+    )
+
+    assert (
+        store.similarity_search_by_vector_with_score(
+            np.ones(8).tolist(), k=2, filter={"source": "missing"}
+        )
+        == []
+    )
+    assert (
+        len(
+            store.similarity_search_by_vector_with_score(
+                np.ones(8).tolist(), k=2, filter={"source": "a"}
+            )
+        )
+        == 1
+    )
+
+
+def test_reduced_precision_saves_disk_space(tmp_path):
+    vectors = np.random.default_rng(0).normal(size=(200, 64)).tolist()
+    texts = [str(i) for i in range(len(vectors))]
+    sizes = {}
+    for precision in ["float32", "float16", "int8"]:
+        store = NumpyVectorStore(
+            DeterministicFakeEmbedding(size=64), str(tmp_path / precision), precision
+        )
+        store.add_embeddings(texts, vectors)
+        store.persist()
+        sizes[precision] = directory_size(tmp_path / precision)
+
+    assert sizes["float16"] < sizes["float32"] * 0.6
+    assert sizes["int8"] < sizes["float32"] * 0.35
+
+
+def test_stored_vectors_are_not_quantized_again(tmp_path):
+    rng = np.random.default_rng(0)
+    embedding = DeterministicFakeEmbedding(size=16)
+    store = NumpyVectorStore(embedding, str(tmp_path), "int8")
+    vectors = rng.normal(size=(2, 16))
+    store.add_embeddings(["a", "b"], vectors.tolist())
+    store.persist()
+    first = np.array(NumpyVectorStore(embedding, str(tmp_path), "int8").get_vectors())
+
+    for i in range(5):
+        store = NumpyVectorStore(embedding, str(tmp_path), "int8")
+        # vectors within the range of the stored ones
+        store.add_embeddings([str(i)], (vectors[i % 2 :][:1] * (i + 2)).tolist())
+        store.persist()
+
+    store = NumpyVectorStore(embedding, str(tmp_path), "int8")
+    assert not store.full_precision
+    np.testing.assert_array_equal(store.get_vectors()[:2], first)
+
+
+def test_faiss_reduced_precision(tmp_path):
+    pytest.importorskip("faiss")
+    from langchain.docstore.document import Document
+
+    vectors = np.random.default_rng(0).normal(size=(200, 64)).tolist()
+    documents = [Document(page_content=str(i)) for i in range(len(vectors))]
+    embedding = DeterministicFakeEmbedding(size=64)
+    sizes, exact = {}, {}
+    for precision in ["float32", "int8"]:
+        backend = FaissBackend(
+            {
+                "vectorstore": {
+                    "faiss": {"index_factory": "Flat", "precision": precision}
+                }
+            }
+        )
+        store = backend.load(embedding, str(tmp_path / precision))
+        backend.add(store, documents, vectors, [str(i) for i in range(len(vectors))])
+        backend.persist(store, str(tmp_path / precision))
+        sizes[precision] = (
+            (tmp_path / precision / backend.INDEX_FILENAME).stat().st_size
+        )
+        exact[precision] = backend.has_exact_vectors(store)
+
+    assert sizes["int8"] < sizes["float32"] * 0.35
+    assert exact == {"float32": True, "int8": False}
+
+
+def test_migrated_store_can_be_queried_and_added_to(tmp_path, monkeypatch):
+    pytest.importorskip("faiss")
+    pytest.importorskip("solid_client_credentials")
+    # the chunks are measured with the embedding model's tokenizer
+    pytest.importorskip("transformers")
+    import llm_service.add as add_module
+    import llm_service.embeddings as embeddings_module
+    from llm_service.add import add
+    from llm_service.config import get_config
+    from llm_service.embeddings import get_partition_directory, get_retriever_for_webid
+    from llm_service.manifest import read_manifest
+    from llm_service.solid_utils import DownloadedResource
+
+    documents = {
+        "https://pod.example/docs/a.txt": b"Turtles can live for more than a century.",
+        "https://pod.example/docs/b.txt": b"The meeting was moved to Thursday.",
+    }
+    embeddings = DeterministicFakeEmbedding(size=16)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(add_module, "get_ingestion_embeddings", lambda c: embeddings)
+    monkeypatch.setattr(embeddings_module, "get_embeddings", lambda c: embeddings)
+    monkeypatch.setattr(
+        add_module,
+        "discover_document_uris",
+        lambda location: [uri for uri in documents if uri.startswith(location)],
+    )
+    monkeypatch.setattr(
+        add_module,
+        "download_resource",
+        lambda uri, spill_threshold: DownloadedResource(
+            uri, "text/plain", uri, content=documents[uri]
+        ),
+    )
+    config = get_config()
+    config["chroma"]["persist_directory"] = str(tmp_path / "db")
+    config["embedding_cache"]["enabled"] = False
+    config["vectorstore"]["backend"] = "numpy"
+    webid, location = "https://alice.example/profile#me", "https://pod.example/docs/"
+    persist_directory = get_partition_directory(config, webid, location)
+
+    add(config, location, webid)
+    assert migrate_vectorstore(config, embeddings, persist_directory, "numpy", "faiss")
+
+    config["vectorstore"]["backend"] = "faiss"
+    manifest = read_manifest(persist_directory)
+    assert manifest.backend == "faiss"
+    assert manifest.dimension == 16
+    assert manifest.document_count == 2
+    retriever = get_retriever_for_webid(config, webid, location)
+    assert len(retriever.invoke("turtles")) == 2
+
+    documents["https://pod.example/docs/c.txt"] = b"Solid pods store data."
+    add(config, location, webid)
+    assert read_manifest(persist_directory).document_count == 3
+    retriever = get_retriever_for_webid(config, webid, location)
+    assert len(retriever.invoke("turtles")) == 3
+
+
+def test_destroyed_chroma_store_does_not_exist(tmp_path):
+    from langchain.docstore.document import Document
+
+    from llm_service.config import get_config
+    from llm_service.vectorstores import ChromaBackend
+
+    backend = ChromaBackend(get_config())
+    embedding = DeterministicFakeEmbedding(size=4)
+    store = backend.load(embedding, str(tmp_path))
+    backend.add(
+        store,
+        [Document(page_content="a", metadata={"source": "a"})],
+        [[1, 0, 0, 0]],
+        ["1"],
+    )
+    assert backend.exists(str(tmp_path))
+
+    backend.destroy(str(tmp_path))
+    assert not backend.exists(str(tmp_path))
+    store = backend.load(embedding, str(tmp_path))
+    assert list(backend.iter_chunks(store)) == []